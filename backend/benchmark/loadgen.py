@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import json
+import re
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+# This is a load generator for the backend. It simulates N users, each of whom creates
+# a user and a conversation, and then chats for a number of turns, just like the
+# frontend does. It measures what users would see: time to first token (TTFT), the
+# time between streamed chunks (inter-token latency), and how many chat turns per
+# second the backend completes. It also reads each backend worker's CPU and memory use
+# from /api/metrics before and after the run.
+# For repeatable numbers, run the backend against the mock inference server in
+# inference/mock_server.py, which has a fixed TTFT and token rate. Then any change in
+# the results is down to the backend.
+#
+# Usage (from the backend directory):
+#   python -m benchmark.loadgen --url http://localhost:8001 --users 50 --turns 5
+# Add `--save results.json` to keep the results, e.g. as a baseline, and
+# `--baseline results.json` to compare a later run against them. The comparison fails
+# (with exit code 1) if any metric got worse by more than `--tolerance`.
+
+
+@dataclass
+class TurnResult:
+    """Timings of one chat turn, in seconds."""
+
+    ttft: Optional[float] = None
+    inter_token: List[float] = field(default_factory=list)
+    duration: float = 0.0
+    status: int = 0
+
+
+@dataclass
+class BenchmarkResult:
+    """Summary of a benchmark run."""
+
+    users: int
+    turns: int
+    wall_seconds: float
+    completed: int
+    failed: int
+    rejected: int
+    requests_per_second: float
+    ttft_p50: float
+    ttft_p99: float
+    inter_token_p50: float
+    inter_token_p99: float
+    duration_p50: float
+    duration_p99: float
+    workers: Dict[str, Dict[str, float]] = field(default_factory=dict)
+
+
+# For each metric, whether higher values are better. We use this to decide what
+# counts as a regression.
+HIGHER_IS_BETTER = {
+    "requests_per_second": True,
+    "ttft_p50": False,
+    "ttft_p99": False,
+    "inter_token_p50": False,
+    "inter_token_p99": False,
+    "duration_p50": False,
+    "duration_p99": False,
+}
+
+
+def percentile(values: List[float], p: float) -> float:
+    """The p-th percentile (0-100) of `values`, by the nearest-rank method."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+async def chat_turn(client: httpx.AsyncClient, conversation_id: int, content: str):
+    result = TurnResult()
+    start = time.perf_counter()
+    last = None
+    message = {"conversation_id": conversation_id, "role": "user", "content": content}
+    async with client.stream("POST", "/api/chat", json=message) as response:
+        result.status = response.status_code
+        if response.status_code != 200:
+            await response.aread()
+            return result
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            frame = json.loads(line)
+            if frame["type"] != "content":
+                continue
+            now = time.perf_counter()
+            if last is None:
+                result.ttft = now - start
+            else:
+                result.inter_token.append(now - last)
+            last = now
+    result.duration = time.perf_counter() - start
+    return result
+
+
+async def simulate_user(
+    client: httpx.AsyncClient, turns: int, think_time: float, message: str
+) -> List[TurnResult]:
+    async with client:
+        user = (await client.post("/api/new_user")).json()
+        conversation = (
+            await client.post("/api/new_conversation", json={"id": user["id"]})
+        ).json()
+        results = []
+        for _ in range(turns):
+            results.append(await chat_turn(client, conversation["id"], message))
+            if think_time:
+                await asyncio.sleep(think_time)
+        return results
+
+
+async def worker_stats(client_factory, samples: int) -> Dict[str, Dict[str, float]]:
+    """
+    Read CPU and memory use of the backend workers from /api/metrics.
+
+    Requests go to whichever worker accepts them, so we sample several times to
+    (most likely) reach every worker.
+    """
+    workers: Dict[str, Dict[str, float]] = {}
+    pattern = re.compile(r"^tacheles_process_(\w+) (\S+)$", re.MULTILINE)
+    async with client_factory() as client:
+        for _ in range(samples):
+            try:
+                response = await client.get("/api/metrics")
+            except httpx.HTTPError:
+                continue
+            stats = {key: float(value) for key, value in pattern.findall(response.text)}
+            if "pid" in stats:
+                workers[str(int(stats.pop("pid")))] = stats
+    return workers
+
+
+async def run_benchmark(
+    url: str = "http://localhost:8001",
+    users: int = 10,
+    turns: int = 3,
+    think_time: float = 0.0,
+    message: str = "Hello! Tell me about tacheles.",
+    client_factory: Optional[Callable[[], httpx.AsyncClient]] = None,
+) -> BenchmarkResult:
+    """
+    Run a benchmark against a backend.
+
+    Args:
+        url (str): The backend's base URL.
+        users (int): Number of concurrent simulated users.
+        turns (int): Number of chat turns per user.
+        think_time (float): Seconds each user waits between turns.
+        message (str): The message users send.
+        client_factory (Callable[[], httpx.AsyncClient], optional): Creates the
+            HTTP client for each user. Each user needs their own client, as the
+            backend identifies users by session cookie.
+
+    Returns:
+        BenchmarkResult: The results.
+    """
+    if client_factory is None:
+
+        def client_factory():
+            return httpx.AsyncClient(
+                base_url=url,
+                timeout=httpx.Timeout(300.0),
+                limits=httpx.Limits(max_connections=10),
+            )
+
+    samples = min(max(users, 4), 32)
+    before = await worker_stats(client_factory, samples)
+    start = time.perf_counter()
+    per_user = await asyncio.gather(
+        *[
+            simulate_user(client_factory(), turns, think_time, message)
+            for _ in range(users)
+        ]
+    )
+    wall = time.perf_counter() - start
+    after = await worker_stats(client_factory, samples)
+
+    results = [result for user in per_user for result in user]
+    completed = [result for result in results if result.status == 200]
+    ttfts = [result.ttft for result in completed if result.ttft is not None]
+    inter_token = [gap for result in completed for gap in result.inter_token]
+    durations = [result.duration for result in completed]
+
+    # CPU use is the share of one core each worker used during the run.
+    workers = {}
+    for pid, stats in after.items():
+        cpu = stats.get("cpu_seconds", 0.0) - before.get(pid, {}).get("cpu_seconds", 0)
+        workers[pid] = {
+            "cpu_utilization": cpu / wall if wall else 0.0,
+            "resident_memory_bytes": stats.get("resident_memory_bytes", 0.0),
+            "max_resident_memory_bytes": stats.get("max_resident_memory_bytes", 0.0),
+        }
+
+    return BenchmarkResult(
+        users=users,
+        turns=turns,
+        wall_seconds=wall,
+        completed=len(completed),
+        failed=sum(1 for r in results if r.status not in (200, 429, 503)),
+        rejected=sum(1 for r in results if r.status in (429, 503)),
+        requests_per_second=len(completed) / wall if wall else 0.0,
+        ttft_p50=percentile(ttfts, 50),
+        ttft_p99=percentile(ttfts, 99),
+        inter_token_p50=percentile(inter_token, 50),
+        inter_token_p99=percentile(inter_token, 99),
+        duration_p50=percentile(durations, 50),
+        duration_p99=percentile(durations, 99),
+        workers=workers,
+    )
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Compare results against a baseline.
+
+    Args:
+        result (dict): The new results.
+        baseline (dict): The baseline results.
+        tolerance (float): Allowed relative change for the worse, e.g. 0.1 for 10%.
+
+    Returns:
+        List[str]: A description of each metric that regressed.
+    """
+    regressions = []
+    for key, higher_is_better in HIGHER_IS_BETTER.items():
+        old, new = baseline.get(key), result.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(f"{key}: {old:.4f} -> {new:.4f} ({change:+.1%})")
+    return regressions
+
+
+def print_result(result: BenchmarkResult):
+    print(f"{result.users} users x {result.turns} turns in {result.wall_seconds:.1f}s")
+    print(
+        f"  completed: {result.completed}, rejected: {result.rejected}, "
+        f"failed: {result.failed}, {result.requests_per_second:.2f} turns/s"
+    )
+    for name in ["ttft", "inter_token", "duration"]:
+        p50 = getattr(result, f"{name}_p50") * 1000
+        p99 = getattr(result, f"{name}_p99") * 1000
+        print(f"  {name}: p50 {p50:.1f}ms, p99 {p99:.1f}ms")
+    for pid, stats in result.workers.items():
+        print(
+            f"  worker {pid}: {stats['cpu_utilization']:.0%} CPU, "
+            f"{stats['resident_memory_bytes'] / 2**20:.0f} MiB resident"
+        )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the tacheles backend.")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--message", default="Hello! Tell me about tacheles.")
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare against results in this file.")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(
+        run_benchmark(args.url, args.users, args.turns, args.think_time, args.message)
+    )
+    print_result(result)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(asdict(result), f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(asdict(result), json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
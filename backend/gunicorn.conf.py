@@ -0,0 +1,55 @@
+import multiprocessing
+import os
+import sys
+
+# This is a configuration for running the backend in several worker processes, so that
+# it can use every CPU core of a machine. gunicorn manages the workers (restarting any
+# that crash), and each worker is a regular uvicorn server. Run it with:
+#   gunicorn -c gunicorn.conf.py tacheles_backend.tacheles_backend:app
+# All workers need to accept each other's sessions, so set SESSION_SECRET_KEY (or
+# STATE_BACKEND, see utils/state.py, through which they then agree on a key). And
+# rather than having every worker create the database tables on startup, set up the
+# database once with `python -m tacheles_backend.models.database`, and set
+# DB_SCHEMA_CHECK_ONLY=1, so that workers only check the schema version.
+# We preload the app: gunicorn imports the backend once, and then forks the workers.
+# Workers then start (and restart) in a fraction of a second, and share the memory of
+# everything loaded on import, e.g. a tokenizer. This is safe because the backend only
+# opens connections (to the database, inference servers or caches) when it first
+# needs them, i.e. in the workers.
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8001)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn_worker.UvicornWorker"
+preload_app = True
+# On restart, we give streaming responses some time to finish.
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 60))
+
+
+def on_starting(server):
+    shared_state = os.environ.get("STATE_BACKEND", "memory") != "memory"
+    if workers > 1 and not os.environ.get("SESSION_SECRET_KEY") and not shared_state:
+        server.log.error("Set SESSION_SECRET_KEY to run several workers.")
+        sys.exit(1)
+    # Each worker has its own history cache. Without a shared state backend, workers
+    # don't hear about conversations that changed on another worker, and their caches
+    # go stale. So in that case, we turn the cache off.
+    history_cache_bytes = int(os.environ.get("HISTORY_CACHE_BYTES", 0))
+    if workers > 1 and history_cache_bytes > 0 and not shared_state:
+        server.log.warning(
+            "Disabling the history cache: With several workers, HISTORY_CACHE_BYTES "
+            "needs a shared STATE_BACKEND."
+        )
+        os.environ["HISTORY_CACHE_BYTES"] = "0"
+        # The app is preloaded, so the cache already exists.
+        from tacheles_backend.api.routes import history_cache
+
+        history_cache.max_bytes = 0
+
+
+def post_fork(server, worker):
+    # Just in case anything used the database before forking, we make sure each
+    # worker opens its own database connections, rather than sharing its parent's.
+    from tacheles_backend.models.database import engine, read_engine
+
+    engine.sync_engine.dispose(close=False)
+    read_engine.sync_engine.dispose(close=False)
@@ -1,15 +1,45 @@
-import json
+import asyncio
+import hashlib
+import hmac
+import logging
 import os
-from typing import List
+import time
+from typing import AsyncIterator, List, Optional, Tuple
 
-from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import StreamingResponse
-from openai import OpenAI, OpenAIError
-from sqlmodel import Session, select
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy.orm import selectinload
+from sqlmodel import and_, or_, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.background import BackgroundTask
 
-from ..models.database import get_db
-from ..models.models import Conversation, ConversationWithMessagesList, Message, User
+from ..models import database
+from ..models.archive import archive, rehydrate
+from ..models.compression import compressor
+from ..models.database import get_db, get_read_db
+from ..models.models import (
+    Conversation,
+    ConversationSummary,
+    ConversationWithMessagesList,
+    Message,
+    MessageSearchResult,
+    User,
+)
+from ..models.search import index_messages, search_messages
+from ..models.transfer import export_ndjson
+from ..models.writer import MessageWriter
+from ..utils.cache import CachedConversation, HistoryCache
+from ..utils.context import ContextBuilder
+from ..utils.generations import Generation, GenerationRegistry
+from ..utils.inference import InferencePool
 from ..utils.logging import get_logger
+from ..utils.metrics import metrics
+from ..utils.prewarm import Prewarmer
+from ..utils.profiler import Profiler
+from ..utils.response_cache import ResponseCache
+from ..utils.scheduler import Scheduler, SchedulerRejected
+from ..utils.state import StateBackend
+from ..utils.streaming import Coalescer, encode_frame
 
 # This file defines all the API endpoints for the backend.
 
@@ -28,20 +58,139 @@ router = APIRouter()
 # But you could define more sophisticated logging here.
 logger = get_logger(__name__)
 
-# Finally, we set up an OpenAI library client.
-# We use this even for vllm and sglang as well as the mock inference backend, as all
-# of them support the same OpenAI API. However, it would be fairly simple to switch
-# this out for a different library if needed, it's really only used once in chat().
-# For now, we keep this here for simplicity and to not scare you away with a backend
-# spread across dozens of files. However, if you were to do more sophisticated things
-# here, e.g. multiple models or even different inference APIs, prompt re-writing, etc.,
-# you might want to move this to a separate file similarly to the logger.
-client = OpenAI(
-    api_key=os.environ.get("OPENAI_API_KEY", "123"),
-    base_url=os.environ.get("INFERENCE_API_URI", None),
-)
+# Finally, we set up our connection to the inference server(s).
+# We use the OpenAI library even for vllm and sglang as well as the mock inference
+# backend, as all of them support the same OpenAI API. However, it would be fairly
+# simple to switch this out for a different library if needed, it's really only used
+# once in chat().
+# Have a look at utils/inference.py for details. By default, this is a pool with just
+# one inference server, set by INFERENCE_API_URI. If you run several replicas of the
+# inference server, list them in INFERENCE_API_URIS, and the pool will send all turns
+# of a conversation to the same replica, so it can re-use its prefix cache.
+# Note that we use the async client: While a response is streaming, we're mostly
+# waiting on the inference server, and the async client lets a single backend worker
+# wait on thousands of those streams at once instead of tying up a thread for each.
+inference_pool = InferencePool.from_env()
 model = os.environ.get("MODEL", "model")
 system_prompt = "You are a helpful assistant."
+max_tokens = int(os.environ.get("MAX_TOKENS", 2000))
+
+# Some of the state below is worth sharing between backend replicas. We keep that in
+# a state backend, which by default is simply this worker's memory. Have a look at
+# utils/state.py for details, and set STATE_BACKEND to share it, e.g. through Redis.
+state = StateBackend.from_env()
+
+# We also set up a context builder, which decides how much of a conversation's history
+# we send to the LLM. Have a look at utils/context.py for details. By default, this
+# sends the entire history. Set CONTEXT_TOKEN_BUDGET to only keep the most recent
+# messages, and CONTEXT_SUMMARIZE to replace older messages by a rolling summary.
+context_builder = ContextBuilder.from_env()
+
+# Optionally, each worker keeps recently used conversation histories in memory, so we
+# don't need to re-read the entire history from the database on every turn. Have a look
+# at utils/cache.py for details, and set HISTORY_CACHE_BYTES to enable this.
+history_cache = HistoryCache.from_env()
+
+# And optionally, we don't write new chat messages to the database right away, but
+# queue them up and write them in batches in the background. Have a look at
+# models/writer.py for details, and set WRITE_BEHIND to enable this.
+message_writer = MessageWriter.from_env()
+
+# With a shared state backend, each replica tells the others about the conversations
+# it changed, so they drop them from their caches. With write-behind, we tell them
+# again once the new messages have been written: Until then, another replica that
+# reloads the conversation from the database would cache it without them.
+if history_cache.max_bytes > 0 and state.shared:
+
+    def publish_history(conversation_id: int):
+        state.publish("history", str(conversation_id))
+
+    history_cache.subscribe(publish_history)
+    message_writer.subscribe(publish_history)
+    state.subscribe(
+        "history", lambda message: history_cache.invalidate(int(message), notify=False)
+    )
+
+# Finally, we can optionally coalesce the tokens we receive from the LLM into fewer,
+# larger chunks before we send them on to the client. Have a look at
+# utils/streaming.py for details, and set STREAM_COALESCE_MS to enable this.
+coalescer = Coalescer.from_env()
+
+# Responses are generated in the background, independent of the connection to the
+# client, so clients can resume a response after a dropped connection. Have a look at
+# utils/generations.py for details.
+generations = GenerationRegistry.from_env(state)
+
+# And we can limit how many responses are generated at once, queueing up the rest
+# fairly between users, and rate limit each user. Have a look at utils/scheduler.py for
+# details, and set SCHEDULER_MAX_CONCURRENT and USER_RATE_PER_MINUTE to enable this.
+scheduler = Scheduler.from_env(state)
+
+# Optionally, we cache complete responses, and replay them when the exact same prompt
+# comes in again. Have a look at utils/response_cache.py for details, and set
+# RESPONSE_CACHE to enable this.
+response_cache = ResponseCache.from_env(state)
+
+# And optionally, when a user opens a conversation, we send its history to the
+# inference server ahead of the next chat turn, so the prefix is already cached by the
+# time the user has typed their message. Have a look at utils/prewarm.py for details,
+# and set PREWARM to enable this.
+prewarmer = Prewarmer.from_env()
+
+# A few endpoints are for administrators only, e.g. exporting the entire database.
+# These need the ADMIN_TOKEN in an `Authorization: Bearer ...` header, and are
+# disabled unless ADMIN_TOKEN is set.
+admin_token = os.environ.get("ADMIN_TOKEN", "")
+
+# Admins can also profile requests, to see where a worker spends its CPU time. Have a
+# look at utils/profiler.py for details, and set PROFILE_SAMPLE_RATE to profile a
+# fraction of all requests.
+profiler = Profiler.from_env()
+
+# Lastly, we record how long each stage of a chat request takes, and serve these
+# metrics (along with the statistics of the components above) on /api/metrics. Have a
+# look at utils/metrics.py for details.
+chat_db_load = metrics.histogram(
+    "tacheles_chat_db_load_seconds", "Time to load the conversation history."
+)
+chat_queue_wait = metrics.histogram(
+    "tacheles_chat_queue_wait_seconds", "Time waiting for the scheduler to admit."
+)
+chat_upstream_first_token = metrics.histogram(
+    "tacheles_chat_upstream_first_token_seconds",
+    "Time from sending the request to the inference server to its first token.",
+)
+chat_first_token = metrics.histogram(
+    "tacheles_chat_first_token_seconds",
+    "Time from receiving a chat request to having the first token ready to send.",
+)
+chat_stream = metrics.histogram(
+    "tacheles_chat_stream_seconds",
+    "Time from sending the request to the inference server to its last token.",
+)
+chat_tokens_per_second = metrics.histogram(
+    "tacheles_chat_tokens_per_second",
+    "Tokens per second of each response, after the first token.",
+    buckets=(1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500),
+)
+chat_commit = metrics.histogram(
+    "tacheles_chat_commit_seconds", "Time to save a conversation turn."
+)
+chat_responses = metrics.counter(
+    "tacheles_chat_responses_total",
+    "Chat responses by outcome (complete, aborted, error or duplicate).",
+    ["outcome"],
+)
+metrics.gauges("tacheles_history_cache", lambda: history_cache.stats())
+metrics.gauges("tacheles_message_writer", lambda: message_writer.stats())
+metrics.gauges("tacheles_scheduler", lambda: scheduler.stats())
+metrics.gauges("tacheles_response_cache", lambda: response_cache.stats())
+metrics.gauges("tacheles_prewarm", lambda: prewarmer.stats())
+metrics.gauges("tacheles_inference", lambda: inference_pool.stats())
+metrics.gauges("tacheles_compression", lambda: compressor.stats())
+metrics.gauges("tacheles_archive", lambda: archive.stats())
+metrics.gauges("tacheles_state", lambda: state.stats())
+metrics.gauges("tacheles_profiler", lambda: profiler.stats())
 
 
 # --------------------
@@ -62,13 +211,29 @@ async def healthcheck():
     return "OK"
 
 
+# Similarly, this endpoint is for monitoring: Point Prometheus at it to collect
+# latency and throughput metrics. You may want to make it unreachable from outside
+# your deployment, e.g. in your reverse proxy.
+@router.get("/api/metrics", response_class=PlainTextResponse, tags=["Healthcheck"])
+async def get_metrics():
+    """
+    Metrics endpoint for the backend.
+
+    Returns:
+        str: All metrics of this worker, in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 # This is our first "real" endpoint.
 # Notice how thanks to FastAPI and SQLModel adding a new user is as simple as
 # saying `db.add(user)`. SQLModel takes care of the rest. Notice also how the same
 # User class is used to return the output to the client, without any additional effort
 # on our part.
 @router.post("/api/new_user", response_model=User, tags=["Users"])
-async def new_user(request: Request, db: Session = Depends(get_db)) -> User:
+async def new_user(request: Request, db: AsyncSession = Depends(get_db)) -> User:
     """
     Create a new user and return the user ID.
 
@@ -78,8 +243,8 @@ async def new_user(request: Request, db: Session = Depends(get_db)) -> User:
     try:
         user = User()
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
         logger.debug(f"New user created: {user}")
         # We use a session middleware to provide some very basic security.
         # Here we store the user ID in the session, so we can check it in later
@@ -108,7 +273,7 @@ async def new_user(request: Request, db: Session = Depends(get_db)) -> User:
     tags=["Conversations"],
 )
 async def new_conversation(
-    user: User, request: Request, db: Session = Depends(get_db)
+    user: User, request: Request, db: AsyncSession = Depends(get_db)
 ) -> Conversation:
     """
     Create a new conversation for a user and return the conversation ID.
@@ -124,8 +289,10 @@ async def new_conversation(
     try:
         conversation = Conversation(user_id=user.id)
         db.add(conversation)
-        db.commit()
-        db.refresh(conversation)
+        await db.commit()
+        # We explicitly load the (empty) list of messages here, as relationships
+        # can't be lazy-loaded on attribute access with an async session.
+        await db.refresh(conversation, attribute_names=["messages"])
         logger.debug(f"New conversation created: {conversation}")
         logger.debug(f"Conversation messages: {conversation.messages}")
         return conversation
@@ -137,13 +304,16 @@ async def new_conversation(
 
 
 @router.post("/api/chat", tags=["Chat"])
-def chat(
-    usermessage: Message, request: Request, db: Session = Depends(get_db)
+async def chat(
+    usermessage: Message, request: Request, db: AsyncSession = Depends(get_db)
 ) -> StreamingResponse:
     """
     Receive a chat message from the user, process it using an LLM,
     and return the response as a streamed text.
 
+    The response has an X-Generation-Id header. If the connection drops, the client
+    can continue reading the response from /api/chat/{generation_id}.
+
     Args:
         usermessage (Message): The user's chat message.
 
@@ -154,79 +324,580 @@ def chat(
         f"New chat request: ID {usermessage.conversation_id},\
              message: {usermessage.content}"
     )
+    started = time.perf_counter()
+    # Whatever role the client sends, this is the user's message. Otherwise, a client
+    # could e.g. add instructions of its own as a system message.
+    usermessage.role = "user"
 
     # This is the chat endpoint that lets users send a message and receive a streaming
     # response from the LLM. Because of the token-by-token streaming, this endpoint
     # is slightly more complex than the others.
 
-    # First, we must wrap the actual processing in a generator function that yields
-    # the response in chunks. We can then later pass this function to FastAPI's
-    # StreamingResponse, which will handle the streaming for us.
-
-    def generate(db: Session):
-        try:
-            # First we get the conversation and do some standard checks and error
-            # handling including basic authentication.
-            conversation = db.get(Conversation, int(usermessage.conversation_id))
-            if conversation is None:
-                logger.warning(f"Conversation {usermessage.conversation_id} not found")
-                raise HTTPException(status_code=404, detail="Conversation not found.")
+    generation = None
+    try:
+        # First we get the conversation history and do some standard checks and
+        # error handling including basic authentication.
+        conversation_id = int(usermessage.conversation_id)
+        conversation = await load_history(db, conversation_id)
+        chat_db_load.observe(time.perf_counter() - started)
+        if conversation is None:
+            logger.warning(f"Conversation {usermessage.conversation_id} not found")
+            raise HTTPException(status_code=404, detail="Conversation not found.")
 
-            if conversation.user_id != request.session.get("user_id"):
-                raise HTTPException(status_code=403, detail="Unauthorized")
+        if conversation.user_id != request.session.get("user_id"):
+            raise HTTPException(status_code=403, detail="Unauthorized")
 
+        # Formatting the whole conversation is expensive, so we only do it if it's
+        # actually logged.
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"Conversation messages: {conversation.messages}")
+        history = list(conversation.messages)
+
+        # If this request repeats one we're already answering (or have just answered),
+        # e.g. after a double-click or a retry, we don't generate a second response,
+        # and don't save the message a second time. Instead, we stream the existing
+        # response.
+        key, explicit = idempotency_key(request, usermessage, conversation.user_id)
+        duplicate = find_duplicate(key, explicit, history)
+        if duplicate is not None:
+            await db.close()
+            chat_responses.inc("duplicate")
+            return StreamingResponse(
+                replay_generation(duplicate),
+                media_type="application/x-ndjson",
+                headers={"X-Generation-Id": duplicate.id},
+            )
+        # Otherwise, we register the response right away, so that any duplicate
+        # request finds it, even while we're still waiting for the scheduler.
+        generation = generations.create(
+            conversation.user_id, conversation_id, key=key, parent=len(history)
+        )
+        # With several replicas, the earlier request may be running on another one.
+        # We can't stream its response from here, so we turn the repeat away.
+        owner = await generations.claim(generation)
+        if owner is not None:
+            raise HTTPException(
+                status_code=409,
+                detail="This request is already being answered.",
+                headers={"X-Generation-Id": owner},
+            )
 
-            # Then, we format the user's conversation using a system prompt message,
-            # the prior conversation history, and the user's current message, and
-            # send it to the LLM for completion.
+        # Then, we format the user's conversation using a system prompt message,
+        # the prior conversation history, and the user's current message. If we're
+        # on a token budget, older messages may be left out (or summarized) here.
+        window = context_builder.build(
+            system_prompt,
+            history,
+            {"role": "user", "content": usermessage.content},
+            conversation.summary,
+            conversation.summary_through,
+        )
+        # We're done with the database until the response is complete, so we give
+        # the connection back to the pool rather than holding on to it while we
+        # stream (or wait for our turn below).
+        await db.close()
+
+        # If the response cache is on, and we've answered this exact prompt before,
+        # we replay that response instead of asking the inference server again.
+        cache_key = response_cache.key(model, window.messages, max_tokens=max_tokens)
+        cached = await response_cache.get(cache_key) if cache_key else None
+
+        # Otherwise, before we go to the inference server, we wait for the scheduler
+        # to admit the request. If the user is sending too many requests, or there
+        # are too many waiting already, we turn the request away and tell the client
+        # when to try again. (Replays don't use the inference server, so they don't
+        # need to wait.)
+        admitted_at = None
+        if cached is None:
             try:
-                completion = client.chat.completions.create(
-                    model=model,
-                    messages=[{"role": "system", "content": system_prompt}]
-                    + conversation.to_list()
-                    + [{"role": "user", "content": usermessage.content}],
-                    stream=True,
-                    max_tokens=2000,
-                )
-            except OpenAIError as e:
-                logger.error(f"Error communicating with LLM backend: {str(e)}")
+                queued_at = time.perf_counter()
+                admitted_at = await scheduler.admit(conversation.user_id)
+                chat_queue_wait.observe(time.perf_counter() - queued_at)
+            except SchedulerRejected as e:
+                logger.info(f"Chat request rejected: {e.detail}")
                 raise HTTPException(
-                    status_code=500, detail="Error processing chat message"
+                    status_code=e.status_code,
+                    detail=e.detail,
+                    headers={"Retry-After": str(e.retry_after)},
                 )
+    except BaseException as e:
+        # There won't be a response, so a retry shouldn't wait for this one. That
+        # includes the request being cancelled (e.g. the client went away while we
+        # waited for the scheduler), so we catch everything here, not just errors.
+        if generation is not None:
+            generation.finish(e)
+            await asyncio.shield(generations.release(generation))
+        if isinstance(e, HTTPException) or not isinstance(e, Exception):
+            raise
+        logger.error(f"Error processing chat request: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
 
-            # Then, we pass on each received chunk to the client as we receive it.
-            llmmessage = ""
-            for chunk in completion:
-                cur_message = chunk.choices[0].delta
-                if cur_message.content is not None:
-                    llmmessage += cur_message.content
-                    response = json.dumps(
-                        {"type": "content", "data": cur_message.content}
-                    )
-                    logger.debug(f"Sending chunk: {response}")
-                    yield f"{response} \n"
+    # We also keep track of whether the conversation's rolling summary needs updating.
+    # We do this after the response has been sent, so the user doesn't wait for it.
+    summary_update = {}
+
+    # The response itself is generated in the background: The generate() function
+    # below runs as its own task, and writes the response frame by frame into a
+    # buffer. The HTTP response then just reads from that buffer. That way, the
+    # generation isn't tied to this particular connection, and a client that lost
+    # its connection can pick up where it left off. Have a look at
+    # utils/generations.py for details.
+    # We make generate() async, so that while we wait for the next token from the
+    # inference server, the event loop is free to serve other requests.
+    async def generate():
+        # We keep the chunks we've streamed so far (in the generation, so duplicate
+        # requests can catch up), so that we can still save them if the generation is
+        # aborted before the response is complete.
+        llmchunks = generation.text
+        completion = None
+        complete = False
+        error = None
+        tokens = 0
+
+        # We pass on each chunk of the response to the client as soon as we have it.
+        # This runs once per token, so we keep it lean: We only format debug messages
+        # if debug logging is actually on.
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        def send(content: str):
+            if not llmchunks:
+                chat_first_token.observe(time.perf_counter() - started)
+            llmchunks.append(content)
+            response = encode_frame("content", content)
+            if debug:
+                logger.debug(f"Sending chunk: {response}")
+            generation.append(response)
 
-            logger.debug(f"Entire message: {llmmessage}")
+        try:
+            if cached is not None:
+                async for content in response_cache.replay(cached):
+                    send(content)
+            else:
+                # We send the conversation to the LLM for completion. We pick the
+                # inference replica based on the conversation, and hold on to it until
+                # the response is complete. If hedging is on, the pool may also send
+                # the request to other replicas, and gives us whichever answers first.
+                requested_at = time.perf_counter()
+                async with inference_pool.stream(
+                    conversation_id,
+                    model=model,
+                    messages=window.messages,
+                    max_tokens=max_tokens,
+                ) as completion:
+                    # We count the chunks we receive from the inference server, which
+                    # for vllm and sglang are single tokens, and time the first one.
+                    async def counted(deltas):
+                        nonlocal tokens, first_token_at
+                        async for content in deltas:
+                            if not tokens:
+                                first_token_at = time.perf_counter()
+                                chat_upstream_first_token.observe(
+                                    first_token_at - requested_at
+                                )
+                            tokens += 1
+                            yield content
+
+                    # Then, we pass on each received chunk to the client as we receive
+                    # it.
+                    first_token_at = None
+                    deltas = counted(content_deltas(completion))
+                    async for content in coalescer.coalesce(deltas):
+                        send(content)
+                    finished_at = time.perf_counter()
+                    chat_stream.observe(finished_at - requested_at)
+                    if tokens > 1 and finished_at > first_token_at:
+                        chat_tokens_per_second.observe(
+                            (tokens - 1) / (finished_at - first_token_at)
+                        )
+
+            llmmessage = "".join(llmchunks)
+            if debug:
+                logger.debug(f"Entire message: {llmmessage}")
 
             # Finally, we let the client know that the response is complete.
-            response = json.dumps({"type": "end", "data": ""})
-            logger.debug(f"Sending chunk: {response}")
-            yield f"{response} \n"
+            generation.append(encode_frame("end", ""))
+            complete = True
 
             # Afterwards, we save the user's message and the LLM's response to the
-            # database, so we can use them in future requests.
-            conversation.messages.append(usermessage)
-            conversation.messages.append(Message(role="assistant", content=llmmessage))
-            db.commit()
+            # database, so we can use them in future requests. We shield this from
+            # cancellation, as the response is complete at this point.
+            saving_at = time.perf_counter()
+            await asyncio.shield(save_turn(usermessage, llmmessage))
+            chat_commit.observe(time.perf_counter() - saving_at)
+            chat_responses.inc("complete")
 
+            # If this was a new response, we add it to the cache for next time.
+            if cache_key is not None and cached is None:
+                try:
+                    await response_cache.put(cache_key, llmmessage)
+                except Exception as e:
+                    logger.warning(f"Could not cache response: {str(e)}")
+
+            if window.unsummarized:
+                summary_update.update(
+                    conversation_id=conversation_id,
+                    history=history,
+                    summary=conversation.summary,
+                    summary_through=conversation.summary_through,
+                    start=window.start,
+                )
+        except asyncio.CancelledError:
+            # If nobody is reading the response anymore (e.g. the user closed the
+            # tab or hit stop, and didn't reconnect), the registry cancels this task.
+            # We then close the stream from the inference server right away, which
+            # makes vllm or sglang abort the request instead of generating tokens
+            # nobody will read. We still save what we have so far, marked as
+            # truncated.
+            if not complete:
+                logger.info(f"Aborting response in conversation {conversation_id}")
+                if completion is not None:
+                    await completion.close()
+                await asyncio.shield(
+                    save_turn(usermessage, "".join(llmchunks), truncated=True)
+                )
+                chat_responses.inc("aborted")
+            raise
         except Exception as e:
-            if isinstance(e, HTTPException):
-                raise e
             logger.error(f"Error processing chat request: {str(e)}")
-            raise HTTPException(status_code=500, detail="Internal Server Error")
+            chat_responses.inc("error")
+            error = e
+        finally:
+            if admitted_at is not None:
+                scheduler.release(admitted_at)
+            generation.finish(error)
+            await generations.release(
+                generation, keep=explicit and complete and error is None
+            )
+
+    async def update_summary():
+        if summary_update:
+            await update_conversation_summary(**summary_update)
+
+    generation.task = asyncio.create_task(generate())
+    return StreamingResponse(
+        generations.stream(generation),
+        media_type="application/x-ndjson",
+        headers={"X-Generation-Id": generation.id},
+        background=BackgroundTask(update_summary),
+    )
+
+
+# If a client loses its connection in the middle of a response, it can reconnect here
+# with the generation ID from the X-Generation-Id header, and the number of frames
+# (i.e., lines) it has already received as `offset`. We then stream the rest of the
+# response, starting from that frame. This works for as long as the generation is
+# still running or was completed recently (RESUME_RETENTION_SECONDS), and the frames
+# are still buffered (RESUME_BUFFER_FRAMES). If you run several backend workers, this
+# needs to reach the same worker as the original request, unless they share a state
+# backend (STATE_BACKEND), which then holds a copy of the buffer.
+@router.get("/api/chat/{generation_id}", tags=["Chat"])
+async def resume_chat(
+    generation_id: str, request: Request, offset: int = Query(0, ge=0)
+) -> StreamingResponse:
+    """
+    Continue streaming a response after a dropped connection.
+
+    Args:
+        generation_id (str): The ID from the X-Generation-Id response header.
+        offset (int): Number of frames the client has already received.
+
+    Returns:
+        StreamingResponse: The rest of the response, streamed as in /api/chat.
+    """
+    generation = generations.get(generation_id)
+    if generation is None:
+        generation = await generations.get_shared(generation_id)
+    if generation is None:
+        raise HTTPException(status_code=404, detail="Generation not found.")
+    if generation.user_id != request.session.get("user_id"):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    if offset < generation.first_offset:
+        raise HTTPException(status_code=410, detail="Response no longer available.")
+    return StreamingResponse(
+        generations.stream(generation, offset),
+        media_type="application/x-ndjson",
+        headers={"X-Generation-Id": generation.id},
+    )
+
+
+async def save_turn(usermessage: Message, llmmessage: str, truncated: bool = False):
+    """
+    Save a user message and the LLM's response to it.
+
+    In the same transaction, we update the conversation's message count, title, etc.
+    We also append the messages to the cached history, so the next turn doesn't have
+    to reload it. As this runs in the background task generating the response, which
+    may outlive the request, we use a database session of our own.
+
+    Args:
+        usermessage (Message): The user's message.
+        llmmessage (str): The LLM's response.
+        truncated (bool): Whether the response was cut short by a disconnect.
+    """
+    try:
+        conversation_id = int(usermessage.conversation_id)
+        llmresponse = Message(
+            conversation_id=conversation_id,
+            role="assistant",
+            content=llmmessage,
+            truncated=truncated,
+        )
+        if message_writer.enabled:
+            await message_writer.submit([usermessage, llmresponse])
+        else:
+            async with database.new_session() as db:
+                db.add_all([usermessage, llmresponse])
+                # The messages need their IDs for the search index.
+                await db.flush()
+                await index_messages(
+                    await db.connection(),
+                    [usermessage.model_dump(), llmresponse.model_dump()],
+                )
+                await db.exec(
+                    Conversation.activity_update(
+                        conversation_id, [usermessage, llmresponse]
+                    )
+                )
+                await db.commit()
+        history_cache.append(
+            conversation_id, [usermessage.to_dict(), llmresponse.to_dict()]
+        )
+    except Exception as e:
+        if not truncated:
+            raise
+        # When saving a truncated response, we're cleaning up after a disconnect,
+        # and there's no one left to report errors to.
+        logger.error(f"Error saving truncated response: {str(e)}")
+
+
+def idempotency_key(
+    request: Request, usermessage: Message, user_id: int
+) -> Tuple[str, bool]:
+    """
+    The key that identifies repeats of a chat request.
+
+    Clients can send a key of their own in an Idempotency-Key header, and then all
+    requests with that key are the same request. Otherwise, we use a hash of the
+    message, see find_duplicate().
+
+    Returns:
+        Tuple[str, bool]: The key, and whether it came from the client.
+    """
+    scope = f"{user_id}:{usermessage.conversation_id}"
+    client_key = request.headers.get("Idempotency-Key")
+    if client_key:
+        return f"{scope}:key:{client_key}", True
+    message = f"{usermessage.role}\0{usermessage.content}".encode()
+    return f"{scope}:hash:{hashlib.sha256(message).hexdigest()}", False
+
+
+def find_duplicate(
+    key: str, explicit: bool, history: List[dict]
+) -> Optional[Generation]:
+    """
+    Find the generation started by an earlier request with the same idempotency key.
+
+    Without a key from the client, users may well send the same message twice on
+    purpose (think "Go on"). So we only count a message as a repeat while the earlier
+    one hasn't been saved yet, i.e. while its response is still being generated.
+    After that, only a client that sends an Idempotency-Key gets the saved response.
+
+    Args:
+        key (str): The request's idempotency key.
+        explicit (bool): Whether the client sent the key.
+        history (List[dict]): The conversation's messages before this one.
+
+    Returns:
+        Generation: The earlier request's generation, or None if there is none.
+    """
+    generation = generations.find(key)
+    if generation is None or explicit:
+        return generation
+    if generation.parent == len(history):
+        return generation
+    return None
+
+
+async def replay_generation(generation: Generation) -> AsyncIterator[bytes]:
+    """Stream an existing generation from the start, for a duplicate request."""
+    offset = 0
+    if generation.first_offset > 0:
+        # The first frames are no longer buffered, so we send the response so far
+        # as a single frame, and continue from there.
+        offset = len(generation.text)
+        yield encode_frame("content", "".join(generation.text[:offset]))
+    async for frame in generations.stream(generation, offset):
+        yield frame
+
+
+async def content_deltas(completion) -> AsyncIterator[str]:
+    """Yield the text content of each chunk of a streaming LLM response."""
+    async for chunk in completion:
+        # Some servers send chunks without choices, e.g. for usage statistics.
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def load_history(
+    db: AsyncSession, conversation_id: int
+) -> Optional[CachedConversation]:
+    """
+    Get a conversation's history, from the history cache if possible.
+
+    Args:
+        conversation_id (int): The conversation to load.
+
+    Returns:
+        CachedConversation: The conversation history, or None if the conversation
+            doesn't exist.
+    """
+    cached = history_cache.get(conversation_id)
+    if cached is not None:
+        return cached
+    await message_writer.flush_conversation(conversation_id)
+    # We load the messages together with the conversation, as we need them for the
+    # prompt and relationships can't be lazy-loaded in async code.
+    conversation = await db.get(
+        Conversation, conversation_id, options=[selectinload(Conversation.messages)]
+    )
+    if conversation is None:
+        return None
+    # If the conversation has been archived, we bring it back (see models/archive.py).
+    # If another request got there first, it may not have committed the messages by
+    # the time we read them. So we only cache what we read if we rehydrated the
+    # conversation ourselves, and then drop any copy other workers cached meanwhile.
+    archived = conversation.archive_segment is not None
+    rehydrated = archived and await rehydrate(db, conversation)
+    if archived:
+        if rehydrated:
+            history_cache.invalidate(conversation_id)
+        conversation = await db.get(
+            Conversation,
+            conversation_id,
+            options=[selectinload(Conversation.messages)],
+            populate_existing=True,
+        )
+    cached = CachedConversation(
+        user_id=conversation.user_id,
+        messages=conversation.to_list(),
+        summary=conversation.summary,
+        summary_through=conversation.summary_through,
+    )
+    if rehydrated or not archived:
+        history_cache.put(conversation_id, cached)
+    return cached
+
+
+async def prewarm_conversation(conversation_id: int):
+    """
+    Send a conversation's history to its inference replica, asking for a single
+    token, so that the replica has the history cached for the next chat turn.
+
+    Args:
+        conversation_id (int): The conversation to prewarm.
+    """
+    # If chat requests are already queueing up, we don't add to the inference
+    # server's load.
+    if scheduler.queued:
+        return
+    async with database.new_session() as db:
+        history = await load_history(db, conversation_id)
+    if history is None or not history.messages:
+        return
+    # We build the context just like chat() will, with a placeholder for the user's
+    # next message, which we then leave out. What remains is the prefix of the next
+    # prompt.
+    window = context_builder.build(
+        system_prompt,
+        list(history.messages),
+        {"role": "user", "content": ""},
+        history.summary,
+        history.summary_through,
+    )
+    async with inference_pool.acquire(conversation_id) as replica:
+        await replica.client.chat.completions.create(
+            model=model, messages=window.messages[:-1], max_tokens=1
+        )
+
+
+async def update_conversation_summary(
+    conversation_id: int,
+    history: List[dict],
+    summary: Optional[str],
+    summary_through: int,
+    start: int,
+):
+    """
+    Extend a conversation's rolling summary to cover all messages before `start`.
+
+    Args:
+        conversation_id (int): The conversation to update.
+        history (List[dict]): The conversation's messages, as sent to the LLM.
+        summary (str, optional): The summary the response was generated with.
+        summary_through (int): The number of messages that summary covers.
+        start (int): Index of the first message that is still sent verbatim.
+    """
+    try:
+        # Summarizing means another call to the LLM, which can take a while. We don't
+        # hold a database connection (let alone a transaction) open for that.
+        client = inference_pool.route(conversation_id).client
+        summary = await context_builder.summarize_messages(
+            client, model, history[summary_through:start], summary
+        )
+        # Two turns of the same conversation can both be summarizing at once. We
+        # only save our summary if nobody else has extended it in the meantime.
+        async with database.new_session() as db:
+            result = await db.exec(
+                update(Conversation)
+                .where(
+                    Conversation.id == conversation_id,
+                    Conversation.summary_through == summary_through,
+                )
+                .values(summary=summary, summary_through=start)
+            )
+            await db.commit()
+        if result.rowcount == 1:
+            history_cache.update(
+                conversation_id, summary=summary, summary_through=start
+            )
+    except Exception as e:
+        # If this fails, we'll simply try again on the next turn.
+        logger.error(f"Error updating conversation summary: {str(e)}")
 
-    return StreamingResponse(generate(db), media_type="application/x-ndjson")
+
+# Users with a long history can have thousands of conversations, and long conversations
+# thousands of messages. The two endpoints below therefore optionally return results
+# page by page: `limit` gives the page size, and `before_id` the cursor. Without a
+# cursor, we return the newest `limit` items. To get the page before that, pass the ID
+# of the oldest item on the current page as `before_id`. Items within a page are
+# sorted oldest to newest, just like the unpaginated results.
+# We use these "keyset" cursors rather than offsets, because the database can jump
+# straight to the cursor using the (user_id / conversation_id) index and primary key,
+# whereas an offset means reading and discarding all the skipped rows.
+MAX_PAGE_SIZE = 1000
+
+
+async def fetch_page(
+    db: AsyncSession, query, id_column, limit: Optional[int], before_id: Optional[int]
+) -> list:
+    """
+    Run a query with optional keyset pagination on an ID column.
+
+    Args:
+        query: The select query, already filtered to the items of interest.
+        id_column: The (primary key) column to paginate on.
+        limit (int, optional): Page size. None returns all items.
+        before_id (int, optional): Only return items with a smaller ID.
+
+    Returns:
+        list: The items on the page, sorted by ascending ID.
+    """
+    if before_id is not None:
+        query = query.where(id_column < before_id)
+    if limit is None:
+        return list((await db.exec(query.order_by(id_column))).all())
+    page = (await db.exec(query.order_by(id_column.desc()).limit(limit))).all()
+    return list(reversed(page))
 
 
 @router.get(
@@ -235,14 +906,22 @@ def chat(
     tags=["Conversations"],
 )
 async def get_conversations(
-    user_id: int, request: Request, db: Session = Depends(get_db)
+    user_id: int,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    before_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_read_db),
 ):
     try:
         if user_id != request.session.get("user_id"):
             raise HTTPException(status_code=403, detail="Unauthorized")
-        conversations = db.exec(
-            select(Conversation).where(Conversation.user_id == user_id)
-        ).all()
+        conversations = await fetch_page(
+            db,
+            select(Conversation).where(Conversation.user_id == user_id),
+            Conversation.id,
+            limit,
+            before_id,
+        )
 
         # We intentionally don't handle "empty" conversations specially in general,
         # as there are many possible design choices for dealing with them. E.g.,
@@ -282,33 +961,249 @@ async def get_conversations(
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
+# For the conversation list in the frontend sidebar, we only need each conversation's
+# title, message count and time of last activity. These are stored on the conversation
+# itself, so this endpoint never touches any messages. Conversations are sorted by most
+# recent activity first. Like the endpoints above, this can be paginated, with
+# `before_id` the ID of the last conversation on the previous page.
+@router.get(
+    "/api/conversations/{user_id}/summaries",
+    response_model=List[ConversationSummary],
+    tags=["Conversations"],
+)
+async def get_conversation_summaries(
+    user_id: int,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    before_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_read_db),
+):
+    try:
+        if user_id != request.session.get("user_id"):
+            raise HTTPException(status_code=403, detail="Unauthorized")
+        query = select(
+            Conversation.id,
+            Conversation.title,
+            Conversation.message_count,
+            Conversation.updated_at,
+            Conversation.last_message_role,
+        ).where(Conversation.user_id == user_id)
+        if before_id is not None:
+            cursor = await db.get(Conversation, before_id)
+            if cursor is None or cursor.user_id != user_id:
+                raise HTTPException(status_code=400, detail="Invalid cursor.")
+            query = query.where(
+                or_(
+                    Conversation.updated_at < cursor.updated_at,
+                    and_(
+                        Conversation.updated_at == cursor.updated_at,
+                        Conversation.id < cursor.id,
+                    ),
+                )
+            )
+        query = query.order_by(Conversation.updated_at.desc(), Conversation.id.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        rows = (await db.exec(query)).all()
+        return [ConversationSummary(**row._mapping) for row in rows]
+    except Exception as e:
+        if isinstance(e, HTTPException):
+            raise e
+        logger.error(f"Error retrieving conversation summaries: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
 @router.get(
     "/api/conversations/{conversation_id}/messages",
     response_model=List[Message],
     tags=["Conversations"],
 )
 async def get_conversation_messages(
-    conversation_id: int, request: Request, db: Session = Depends(get_db)
+    conversation_id: int,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    before_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_read_db),
 ):
     try:
-        conversation = db.get(Conversation, conversation_id)
-        if conversation is None:
-            raise HTTPException(status_code=404, detail="Conversation not found.")
-        if conversation.user_id != request.session.get("user_id"):
-            raise HTTPException(status_code=403, detail="Unauthorized")
-        messages = db.exec(
-            select(Message).where(Message.conversation_id == conversation_id)
-        ).all()
+        # The read replica may lag behind the primary database. Users fetch the
+        # latest page right after they've created a conversation or chatted in it, so
+        # we read it from the primary, where it's always up to date. Only older pages,
+        # which don't change, come from the replica.
+        async with database.new_session() as primary:
+            if before_id is None:
+                db = primary
+            conversation = await db.get(Conversation, conversation_id)
+            if conversation is None:
+                raise HTTPException(status_code=404, detail="Conversation not found.")
+            if conversation.user_id != request.session.get("user_id"):
+                raise HTTPException(status_code=403, detail="Unauthorized")
+            # If the latest messages are still queued for writing, write them first.
+            await message_writer.flush_conversation(conversation_id)
+            query = select(Message).where(Message.conversation_id == conversation_id)
+            if conversation.archive_segment is not None:
+                # The conversation has been archived, so we bring it back (see
+                # models/archive.py). This writes to the database, so we use the
+                # primary database, and also read from it, as the replica may not
+                # have the messages yet.
+                if await rehydrate(primary, conversation):
+                    history_cache.invalidate(conversation.id)
+                db = primary
+            messages = await fetch_page(db, query, Message.id, limit, before_id)
         # We can't have two user messages in a row, otherwise the inference backend
         # will throw an error.
         # In theory, the last message should always be from the assistant anyway.
         # But just in case, we remove the last message if it's from the user.
         # Otherwise, the frontend might call /api/chat again with another user message.
-        if len(messages) > 0 and messages[-1].role == "user":
+        # (This only concerns the latest page of messages, of course.)
+        if before_id is None and len(messages) > 0 and messages[-1].role == "user":
             messages.pop()
+        # Fetching the latest messages means the user has (re)opened the conversation,
+        # and will likely continue it soon. So we prewarm the inference server, if
+        # enabled. This runs in the background, and doesn't delay the response.
+        if before_id is None and len(messages) > 0:
+            prewarmer.schedule(
+                conversation_id, lambda: prewarm_conversation(conversation_id)
+            )
         return messages
     except Exception as e:
         if isinstance(e, HTTPException):
             raise e
         logger.error(f"Error retrieving conversation messages: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
+# Users can search all their messages. The search uses a full-text index (see
+# models/search.py), so it stays fast however many messages there are. Results are
+# ranked by relevance, so unlike the endpoints above, this is paginated with an
+# `offset` rather than a cursor.
+@router.get(
+    "/api/search",
+    response_model=List[MessageSearchResult],
+    tags=["Conversations"],
+)
+async def search(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=500),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_read_db),
+):
+    try:
+        user_id = request.session.get("user_id")
+        if user_id is None:
+            raise HTTPException(status_code=403, detail="Unauthorized")
+        return await search_messages(db, user_id, q, limit, offset)
+    except Exception as e:
+        if isinstance(e, HTTPException):
+            raise e
+        logger.error(f"Error searching messages: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
+# Administrator endpoints need the ADMIN_TOKEN, see above.
+def is_admin(authorization: str) -> bool:
+    """Whether an Authorization header has the ADMIN_TOKEN."""
+    # We compare in constant time, so the token can't be guessed from timings.
+    return bool(admin_token) and hmac.compare_digest(
+        authorization.encode(), f"Bearer {admin_token}".encode()
+    )
+
+
+def require_admin(request: Request):
+    if not admin_token:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled")
+    if not is_admin(request.headers.get("Authorization", "")):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+
+# This exports all users, conversations and messages as NDJSON, e.g. for backups or
+# analytics. The export is streamed straight from the database (see
+# models/transfer.py), so it takes the same memory for any size of database. As it
+# can run for a long time, we read from the read replica if there is one.
+@router.get("/api/admin/export", tags=["Admin"], dependencies=[Depends(require_admin)])
+async def export_database(compress: bool = False):
+    """
+    Export the entire database as NDJSON.
+
+    Args:
+        compress (bool): Whether to gzip the export.
+
+    Returns:
+        StreamingResponse: One JSON object per line, for each row of the database.
+    """
+    filename = "tacheles.ndjson.gz" if compress else "tacheles.ndjson"
+    return StreamingResponse(
+        export_ndjson(database.read_engine, compress=compress),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+# These serve the profiles of requests (see utils/profiler.py) of the worker that
+# handles the request, in the folded format that flame graph tools read, e.g.
+#   curl -H "Authorization: Bearer $ADMIN_TOKEN" .../api/admin/profiles/all > chat.txt
+#   flamegraph.pl chat.txt > chat.svg
+@router.get(
+    "/api/admin/profiles", tags=["Admin"], dependencies=[Depends(require_admin)]
+)
+async def list_profiles() -> List[dict]:
+    """
+    List the stored profiles, oldest first.
+
+    Returns:
+        List[dict]: The ID, endpoint, time and number of samples of each profile.
+    """
+    return [profile.summary() for profile in profiler.profiles()]
+
+
+@router.post(
+    "/api/admin/profiles/sample_rate",
+    tags=["Admin"],
+    dependencies=[Depends(require_admin)],
+)
+async def set_profile_sample_rate(rate: float = Query(..., ge=0, le=1)) -> dict:
+    """
+    Set the fraction of requests to profile.
+
+    Args:
+        rate (float): The fraction, between 0 (none) and 1 (all).
+    """
+    profiler.sample_rate = rate
+    return {"sample_rate": rate}
+
+
+@router.get(
+    "/api/admin/profiles/{profile_id}",
+    tags=["Admin"],
+    dependencies=[Depends(require_admin)],
+)
+async def download_profile(
+    profile_id: str, endpoint: Optional[str] = None
+) -> PlainTextResponse:
+    """
+    Download a profile as folded stacks.
+
+    Args:
+        profile_id (str): The profile's ID, or "all" for all stored profiles added up.
+        endpoint (str, optional): With "all", only add up the profiles of this
+            endpoint, e.g. "/api/chat".
+
+    Returns:
+        PlainTextResponse: One line per stack, followed by its number of samples.
+    """
+    if profile_id == "all":
+        profiles = [
+            profile
+            for profile in profiler.profiles()
+            if endpoint is None or profile.endpoint == endpoint
+        ]
+    else:
+        profile = profiler.get(profile_id)
+        if profile is None:
+            raise HTTPException(status_code=404, detail="Profile not found.")
+        profiles = [profile]
+    return PlainTextResponse(
+        profiler.folded(profiles),
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}.folded"'},
+    )
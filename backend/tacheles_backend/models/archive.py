@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlmodel import col, delete, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..utils.logging import get_logger
+from . import compression
+from .models import Conversation, Message, utcnow
+from .search import insert_messages
+
+# Here we implement an optional archive for conversations nobody has used in a long
+# time. Most conversations are never opened again after a few days, but their messages
+# stay in the message table (and its indexes) forever, and take up space in the
+# database's memory that active conversations could use.
+# The archive job (run it regularly, e.g. daily from cron) moves the messages of every
+# conversation that has been idle for ARCHIVE_AFTER_DAYS out of the database, into
+# files in ARCHIVE_DIR:
+#   python -m tacheles_backend.models.archive
+# Each conversation becomes one compressed record, appended to a "segment" file.
+# Segments are append-only: We only ever add records at the end, and start a new
+# segment once one reaches ARCHIVE_SEGMENT_BYTES. The conversation itself stays in the
+# database (so it still shows up in the user's list), and records where its record is.
+# The backend reads records through memory maps, so reading a record is just a copy
+# from the operating system's page cache. When a user opens an archived conversation,
+# or continues it, we "rehydrate" it: we put its messages back into the message table,
+# and from there on it's a normal conversation again. Its old record stays in the
+# segment, as nothing ever refers to it again. (To reclaim that space, you could
+# rewrite segments that hold few live records, but we don't bother.)
+# With several backend machines, ARCHIVE_DIR needs to be shared storage that all of
+# them can read. Archived messages can't be found by the full-text search.
+
+logger = get_logger(__name__)
+
+# Each record starts with the length of its data, and a CRC32 checksum of it.
+HEADER = struct.Struct("<II")
+
+
+class Archive:
+    """
+    Append-only segment files of compressed records, read through memory maps.
+
+    Args:
+        directory (str, optional): Where to keep the segments. If not set, the archive
+            is disabled.
+        segment_bytes (int): Start a new segment once one reaches this size.
+        max_open (int): Maximum number of segments to keep mapped at once.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        segment_bytes: int = 256 * 2**20,
+        max_open: int = 64,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_open = max_open
+        self._maps: "OrderedDict[int, mmap.mmap]" = OrderedDict()
+        # Records are read in worker threads, so only one may use the maps at a time.
+        self._lock = threading.Lock()
+        # Statistics, see stats().
+        self.reads = 0
+        self.rehydrated = 0
+
+    @classmethod
+    def from_env(cls) -> "Archive":
+        return cls(
+            directory=os.environ.get("ARCHIVE_DIR") or None,
+            segment_bytes=int(os.environ.get("ARCHIVE_SEGMENT_BYTES", 256 * 2**20)),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:08d}.seg")
+
+    def append(self, records: List[bytes]) -> List[Tuple[int, int]]:
+        """
+        Append records to the archive, and make sure they're on disk.
+
+        Args:
+            records (List[bytes]): The records to write.
+
+        Returns:
+            List[Tuple[int, int]]: The segment and offset of each record.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        # Only one process may append at a time, so we lock the archive.
+        with open(os.path.join(self.directory, "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            segments = [
+                int(name[:-4])
+                for name in os.listdir(self.directory)
+                if name.endswith(".seg")
+            ]
+            segment = max(segments, default=0)
+            f = open(self.path(segment), "ab")
+            locations = []
+            try:
+                for data in records:
+                    offset = f.tell()
+                    if (
+                        offset > 0
+                        and offset + HEADER.size + len(data) > self.segment_bytes
+                    ):
+                        f.flush()
+                        os.fsync(f.fileno())
+                        f.close()
+                        segment += 1
+                        f = open(self.path(segment), "ab")
+                        offset = 0
+                    f.write(HEADER.pack(len(data), zlib.crc32(data)))
+                    f.write(data)
+                    locations.append((segment, offset))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+        return locations
+
+    def read(self, segment: int, offset: int) -> bytes:
+        """Read the record at the given segment and offset."""
+        with self._lock:
+            mapped = self._map(segment, offset + HEADER.size)
+            length, crc = HEADER.unpack_from(mapped, offset)
+            start = offset + HEADER.size
+            end = start + length
+            data = self._map(segment, end)[start:end]
+            self.reads += 1
+        if zlib.crc32(data) != crc:
+            raise ValueError(f"Corrupt archive record at {segment}:{offset}")
+        return data
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "open_segments": len(self._maps),
+            "reads": self.reads,
+            "rehydrated": self.rehydrated,
+        }
+
+    def _map(self, segment: int, size: int) -> mmap.mmap:
+        mapped = self._maps.get(segment)
+        if mapped is not None and len(mapped) >= size:
+            self._maps.move_to_end(segment)
+            return mapped
+        if mapped is not None:
+            # The segment has grown since we mapped it, so we map it again.
+            del self._maps[segment]
+            mapped.close()
+        with open(self.path(segment), "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mapped) < size:
+            mapped.close()
+            raise ValueError(f"Archive segment {segment} is truncated")
+        self._maps[segment] = mapped
+        while len(self._maps) > self.max_open:
+            self._maps.popitem(last=False)[1].close()
+        return mapped
+
+
+archive = Archive.from_env()
+
+
+def read_messages(conversation: Conversation) -> List[dict]:
+    """The messages of an archived conversation, as columns of the message table."""
+    data = archive.read(conversation.archive_segment, conversation.archive_offset)
+    return json.loads(compression.compressor.decompress(data))
+
+
+async def rehydrate(db: AsyncSession, conversation: Conversation) -> bool:
+    """
+    Move an archived conversation's messages back into the message table.
+
+    This commits the session.
+
+    Args:
+        conversation (Conversation): The conversation. Nothing happens if it isn't
+            archived.
+
+    Returns:
+        bool: Whether this call put the messages back. False if the conversation
+            wasn't archived, or if another request is rehydrating it at the same time.
+    """
+    if conversation.archive_segment is None:
+        return False
+    # Reading, decompressing and parsing the record can take a while for a long
+    # conversation, so we do it in a thread rather than blocking the event loop.
+    messages = await asyncio.to_thread(read_messages, conversation)
+    # If the conversation is opened by two requests at once, both get here. Only the
+    # one that gets to clear the archive location puts back the messages.
+    result = await db.exec(
+        update(Conversation)
+        .where(
+            col(Conversation.id) == conversation.id,
+            col(Conversation.archive_segment) == conversation.archive_segment,
+            col(Conversation.archive_offset) == conversation.archive_offset,
+        )
+        .values(archive_segment=None, archive_offset=None)
+    )
+    rehydrated = result.rowcount == 1
+    if rehydrated and messages:
+        await insert_messages(
+            await db.connection(),
+            [{**message, "conversation_id": conversation.id} for message in messages],
+        )
+    await db.commit()
+    conversation.archive_segment = None
+    conversation.archive_offset = None
+    if rehydrated:
+        archive.rehydrated += 1
+    return rehydrated
+
+
+async def archive_idle_conversations(
+    db: AsyncSession, idle_for: timedelta, batch_size: int = 100
+) -> int:
+    """
+    Move the messages of all conversations idle for longer than `idle_for` into the
+    archive.
+
+    Args:
+        idle_for (timedelta): How long a conversation needs to be idle.
+        batch_size (int): Number of conversations to archive at once.
+
+    Returns:
+        int: The number of conversations archived.
+    """
+    cutoff = utcnow() - idle_for
+    archived = 0
+    last_id = 0
+    while True:
+        conversations = (
+            await db.exec(
+                select(Conversation.id, Conversation.updated_at)
+                .where(
+                    col(Conversation.id) > last_id,
+                    col(Conversation.archive_segment).is_(None),
+                    Conversation.updated_at < cutoff,
+                    Conversation.message_count > 0,
+                )
+                .order_by(Conversation.id)
+                .limit(batch_size)
+            )
+        ).all()
+        if not conversations:
+            return archived
+        last_id = conversations[-1].id
+        rows = (
+            await db.exec(
+                select(
+                    Message.id,
+                    Message.conversation_id,
+                    Message.role,
+                    Message.content,
+                    Message.truncated,
+                )
+                .where(col(Message.conversation_id).in_([c.id for c in conversations]))
+                .order_by(Message.id)
+            )
+        ).all()
+        messages: Dict[int, List[dict]] = {c.id: [] for c in conversations}
+        for row in rows:
+            message = dict(row._mapping)
+            messages[message.pop("conversation_id")].append(message)
+        conversations = [c for c in conversations if messages[c.id]]
+        records = [
+            compression.compressor.compress(json.dumps(messages[c.id]).encode())
+            for c in conversations
+        ]
+        # We write the records before touching the database. If anything fails after
+        # this, the records are simply never used.
+        locations = await asyncio.to_thread(archive.append, records)
+        for conversation, (segment, offset) in zip(conversations, locations):
+            # We only archive the conversation if it's still idle, i.e. nobody added
+            # messages since we read them.
+            result = await db.exec(
+                update(Conversation)
+                .where(
+                    col(Conversation.id) == conversation.id,
+                    Conversation.updated_at == conversation.updated_at,
+                    col(Conversation.archive_segment).is_(None),
+                )
+                .values(archive_segment=segment, archive_offset=offset)
+            )
+            if result.rowcount == 1:
+                await db.exec(
+                    delete(Message).where(
+                        col(Message.conversation_id) == conversation.id,
+                        col(Message.id) <= messages[conversation.id][-1]["id"],
+                    )
+                )
+                archived += 1
+        await db.commit()
+        logger.info(f"Archived {archived} conversations")
+
+
+async def main(argv: Optional[List[str]] = None):
+    # We import this here, so that importing this module doesn't set up a database.
+    from . import database
+
+    parser = argparse.ArgumentParser(
+        prog="python -m tacheles_backend.models.archive",
+        description="Move the messages of idle conversations into the archive.",
+    )
+    parser.add_argument(
+        "--idle-days",
+        type=float,
+        default=float(os.environ.get("ARCHIVE_AFTER_DAYS", 30)),
+        help="Archive conversations idle for this many days",
+    )
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args(argv)
+    if not archive.enabled:
+        parser.error("Set ARCHIVE_DIR to use the archive.")
+
+    async with database.new_session() as db:
+        count = await archive_idle_conversations(
+            db, timedelta(days=args.idle_days), args.batch_size
+        )
+    await database.engine.dispose()
+    print(f"Archived {count} conversations")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
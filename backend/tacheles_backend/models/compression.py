@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import os
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional, Sequence
+
+from sqlalchemy.types import TEXT, TypeDecorator
+
+# Here we implement optional compression of message content.
+# Messages are stored in a TEXT column, and long LLM responses (especially code) make
+# up most of the database. They also compress well, and even better with a shared
+# dictionary of text that's common across messages (e.g. boilerplate the LLM likes to
+# repeat, or common code). With MESSAGE_COMPRESSION set to "zlib" or "zstd" (which
+# needs the `zstandard` package), messages of at least MESSAGE_COMPRESSION_MIN_BYTES
+# are stored compressed, so tables, indexes and the database's buffer pool hold more
+# messages in the same memory.
+# This is transparent to the rest of the backend: The content column has a custom
+# type, CompressedText, which compresses values on their way into the database, and
+# decompresses them on their way out, whether they're written through the ORM or a
+# bulk INSERT. Each value says whether (and how) it was compressed, so compressed and
+# uncompressed messages can live side by side, and turning compression on or off
+# needs no migration. Compressed values start with MARKER, followed by the compressed
+# data, base64-encoded to fit into a TEXT column. Note that the database can't look
+# into compressed values, so on SQLite, the backend indexes their text for full-text
+# search itself, and other databases can't search them (see models/search.py).
+# Dictionaries are optional. Train one on your existing messages with
+#   python -m tacheles_backend.models.compression train messages.dict
+# and point MESSAGE_COMPRESSION_DICT to it. Each compressed value records the ID of its
+# dictionary, so to switch to a new dictionary, list both, new one first:
+# MESSAGE_COMPRESSION_DICT=new.dict,old.dict. New values then use the first, and old
+# values can still be read.
+
+# Compressed values start with this character, which we don't expect at the start of
+# a message. (Messages that do start with it are always stored compressed.)
+MARKER = "\x1b"
+
+# The methods, and the tags that identify them in compressed values.
+METHODS = {"zlib": b"z", "zstd": b"s"}
+
+# The dictionary ID of values compressed without a dictionary.
+NO_DICTIONARY = b"\0" * 4
+
+
+def dictionary_id(dictionary: bytes) -> bytes:
+    return hashlib.sha256(dictionary).digest()[:4]
+
+
+class Compressor:
+    """
+    Compresses and decompresses data, optionally with shared dictionaries.
+
+    Compressed data starts with a short header: the method (one byte) and the ID of
+    the dictionary (four bytes).
+
+    Args:
+        enabled (bool): Whether to compress message content. Data can always be
+            decompressed, and compress() always compresses.
+        method (str): "zlib" or "zstd".
+        dictionaries (Sequence[bytes]): Dictionaries to decompress with. The first is
+            also used to compress.
+        level (int, optional): The compression level. Defaults to the method's
+            default.
+        min_bytes (int): Only compress message content at least this long.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        method: str = "zlib",
+        dictionaries: Sequence[bytes] = (),
+        level: Optional[int] = None,
+        min_bytes: int = 512,
+    ):
+        if method not in METHODS:
+            raise ValueError(f"Unknown compression method: {method}")
+        self.enabled = enabled
+        self.method = method
+        self.level = level
+        self.min_bytes = min_bytes
+        self.dictionaries: Dict[bytes, bytes] = {
+            dictionary_id(d): d for d in dictionaries
+        }
+        self.dictionary = dictionaries[0] if dictionaries else None
+        self.header = METHODS[method] + (
+            dictionary_id(self.dictionary) if self.dictionary else NO_DICTIONARY
+        )
+        # Statistics, see stats().
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @classmethod
+    def from_env(cls) -> "Compressor":
+        method = os.environ.get("MESSAGE_COMPRESSION", "")
+        dictionaries = []
+        for path in os.environ.get("MESSAGE_COMPRESSION_DICT", "").split(","):
+            if path.strip():
+                with open(path.strip(), "rb") as f:
+                    dictionaries.append(f.read())
+        level = os.environ.get("MESSAGE_COMPRESSION_LEVEL")
+        return cls(
+            enabled=bool(method),
+            method=method or "zlib",
+            dictionaries=dictionaries,
+            level=int(level) if level else None,
+            min_bytes=int(os.environ.get("MESSAGE_COMPRESSION_MIN_BYTES", 512)),
+        )
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress data, with the header needed to decompress it."""
+        if self.method == "zstd":
+            import zstandard
+
+            dict_data = (
+                zstandard.ZstdCompressionDict(self.dictionary)
+                if self.dictionary
+                else None
+            )
+            compressor = zstandard.ZstdCompressor(
+                level=self.level or 3, dict_data=dict_data
+            )
+            return self.header + compressor.compress(data)
+        level = -1 if self.level is None else self.level
+        if self.dictionary:
+            compressor = zlib.compressobj(level, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(level)
+        return self.header + compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        """Decompress data compressed by compress(), with any method or dictionary."""
+        method, dict_id, payload = data[:1], data[1:5], data[5:]
+        dictionary = None
+        if dict_id != NO_DICTIONARY:
+            dictionary = self.dictionaries.get(dict_id)
+            if dictionary is None:
+                raise ValueError(
+                    f"Compressed with dictionary {dict_id.hex()}, which isn't in "
+                    "MESSAGE_COMPRESSION_DICT"
+                )
+        if method == METHODS["zstd"]:
+            import zstandard
+
+            dict_data = (
+                zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            )
+            decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+            return decompressor.decompressobj().decompress(payload)
+        if method == METHODS["zlib"]:
+            if dictionary:
+                return zlib.decompressobj(zdict=dictionary).decompress(payload)
+            return zlib.decompress(payload)
+        raise ValueError(f"Unknown compression method: {method!r}")
+
+    def encode_text(self, text: str) -> str:
+        """Prepare message content for storage, compressing it if worthwhile."""
+        escape = text.startswith(MARKER)
+        if not escape and (not self.enabled or len(text) < self.min_bytes):
+            return text
+        data = text.encode()
+        encoded = MARKER + base64.b64encode(self.compress(data)).decode()
+        # Short or random text may not get any shorter.
+        if len(encoded) >= len(data) and not escape:
+            return text
+        self.compressed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(encoded)
+        return encoded
+
+    def decode_text(self, value: str) -> str:
+        """Turn stored message content back into the original text."""
+        if not value.startswith(MARKER):
+            return value
+        return self.decompress(base64.b64decode(value[1:])).decode()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "compressed_messages": self.compressed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+compressor = Compressor.from_env()
+
+
+class CompressedText(TypeDecorator):
+    """A TEXT column whose values are compressed by `compressor`, see above."""
+
+    impl = TEXT
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else compressor.encode_text(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else compressor.decode_text(value)
+
+
+def train_dictionary(samples: List[bytes], size: int, method: str = "zlib") -> bytes:
+    """
+    Build a compression dictionary from sample messages.
+
+    Args:
+        samples (List[bytes]): The sample messages.
+        size (int): Size of the dictionary in bytes. zlib only uses up to 32 KiB.
+        method (str): The method the dictionary is for, "zlib" or "zstd".
+
+    Returns:
+        bytes: The dictionary.
+    """
+    if method == "zstd":
+        import zstandard
+
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    # zlib has no dictionary training, but a dictionary is simply text that the
+    # compressed data can refer back to. So we take the lines that save the most bytes
+    # across all samples, i.e. the longest lines that appear in the most messages.
+    size = min(size, 2**15)
+    counts: Counter = Counter()
+    for sample in samples:
+        counts.update(set(line for line in sample.splitlines() if len(line) > 3))
+    lines = sorted(
+        (line for line, count in counts.items() if count > 1),
+        key=lambda line: counts[line] * len(line),
+        reverse=True,
+    )
+    dictionary: List[bytes] = []
+    total = 0
+    for line in lines:
+        if total + len(line) + 1 > size:
+            continue
+        dictionary.append(line + b"\n")
+        total += len(line) + 1
+    # zlib finds matches near the end of the dictionary with shorter references, so
+    # the most useful lines go last.
+    return b"".join(reversed(dictionary))
+
+
+async def main(argv: Optional[List[str]] = None):
+    # We import these here, so that importing this module doesn't set up a database.
+    from sqlmodel import select
+
+    from .database import engine
+    from .models import Message
+
+    parser = argparse.ArgumentParser(
+        prog="python -m tacheles_backend.models.compression",
+        description="Train a message compression dictionary on recent messages.",
+    )
+    parser.add_argument("command", choices=["train"])
+    parser.add_argument("file", help="Where to write the dictionary")
+    parser.add_argument("--method", choices=list(METHODS), default="zlib")
+    parser.add_argument("--size", type=int, default=2**15)
+    parser.add_argument("--samples", type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    async with engine.connect() as conn:
+        query = (
+            select(Message.content)
+            .where(Message.role == "assistant")
+            .order_by(Message.id.desc())
+            .limit(args.samples)
+        )
+        samples = [content.encode() for content in (await conn.scalars(query))]
+    await engine.dispose()
+    dictionary = train_dictionary(samples, args.size, args.method)
+    with open(args.file, "wb") as f:
+        f.write(dictionary)
+    print(f"Wrote a {len(dictionary)} byte dictionary from {len(samples)} messages")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
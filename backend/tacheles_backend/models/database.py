@@ -1,27 +1,366 @@
+import argparse
+import asyncio
 from os import environ
+from typing import Any, Callable, Dict, List, Optional
 
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy import Table, event, insert, inspect, literal
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, col, func, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from ..utils.metrics import instrument_engine
 from .models import *  # noqa
+from .models import (
+    SCHEMA_VERSION,
+    TITLE_LENGTH,
+    Conversation,
+    Message,
+    SchemaVersion,
+    utcnow,
+)
+from .search import create_search_index
 
 # Here, we set up the database connection. We use the DATABASE_URL environment.
 # If the DATABASE_URL environment variable is not set, we default to a SQLite.
 # This is already very flexible, as it allows us to use any database supported
 # by SQLAlchemy, just by setting the DATABASE_URL environment variable.
-# But you could still wish to make changes here, e.g. to set up a connection pool.
+# Optionally, DATABASE_READ_URL points to a read replica of the database. Endpoints
+# that only read (listing conversations and their messages) then use the replica, and
+# everything else the primary database.
 
 DATABASE_URL = environ.get("DATABASE_URL", "sqlite:////database/database.db")
+DATABASE_READ_URL = environ.get("DATABASE_READ_URL", "")
+
+# The whole backend talks to the database asynchronously, so that a slow query (or
+# a long-running streaming chat response that commits at the end) never blocks a
+# thread. SQLAlchemy needs an asyncio-capable driver for this. To keep existing
+# DATABASE_URLs working, we swap the usual sync drivers for their async counterparts.
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+    "mysql+mysqldb": "mysql+aiomysql",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+
+
+def to_async_url(url: str) -> str:
+    """
+    Convert a database URL to use an asyncio-compatible driver.
+
+    Args:
+        url (str): A SQLAlchemy database URL, e.g. "mysql+pymysql://...".
+
+    Returns:
+        str: The same URL with the driver swapped, e.g. "mysql+aiomysql://...".
+            URLs that already use an async driver are returned unchanged.
+    """
+    parsed = make_url(url)
+    drivername = ASYNC_DRIVERS.get(parsed.drivername, parsed.drivername)
+    return parsed.set(drivername=drivername).render_as_string(hide_password=False)
+
+
+# Each kind of database gets an engine "profile" of sensible defaults, which can be
+# overridden through the environment:
+# - For networked databases (MySQL, PostgreSQL), we check that a pooled connection is
+#   still alive before using it (DB_POOL_PRE_PING), as the database or a proxy may
+#   have closed it in the meantime. MySQL closes idle connections after its
+#   wait_timeout, so for MySQL we also replace connections after an hour
+#   (DB_POOL_RECYCLE). DB_POOL_SIZE, DB_MAX_OVERFLOW and DB_POOL_TIMEOUT size the
+#   connection pool of each worker.
+# - By default, SQLite lets only one connection write at a time, and blocks readers
+#   while it does. We switch it to write-ahead logging (SQLITE_JOURNAL_MODE), where
+#   readers don't block writers and vice versa, which together with
+#   synchronous=NORMAL (SQLITE_SYNCHRONOUS) also makes commits much cheaper. We let
+#   writers wait for each other for a while (SQLITE_BUSY_TIMEOUT_MS) rather than fail
+#   right away, and memory-map the database file (SQLITE_MMAP_SIZE bytes).
+ENGINE_PROFILES: Dict[str, Dict[str, Any]] = {
+    "sqlite": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "mmap_size": 256 * 2**20,
+    },
+    "mysql": {"pool_pre_ping": True, "pool_recycle": 3600},
+    "postgresql": {"pool_pre_ping": True},
+}
+
+# Environment variables for each engine option, and how to parse them.
+ENGINE_OPTIONS = {
+    "pool_size": ("DB_POOL_SIZE", int),
+    "max_overflow": ("DB_MAX_OVERFLOW", int),
+    "pool_timeout": ("DB_POOL_TIMEOUT", float),
+    "pool_recycle": ("DB_POOL_RECYCLE", int),
+    "pool_pre_ping": ("DB_POOL_PRE_PING", lambda v: v.lower() in ("1", "true", "yes")),
+    "journal_mode": ("SQLITE_JOURNAL_MODE", str),
+    "synchronous": ("SQLITE_SYNCHRONOUS", str),
+    "busy_timeout": ("SQLITE_BUSY_TIMEOUT_MS", int),
+    "mmap_size": ("SQLITE_MMAP_SIZE", int),
+}
+SQLITE_PRAGMAS = ["journal_mode", "synchronous", "busy_timeout", "mmap_size"]
+
+
+def engine_options(url: str, env: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    The engine options for a database URL: its profile, overridden by the environment.
+
+    Args:
+        url (str): The database URL.
+        env (Dict[str, str], optional): The environment. Defaults to os.environ.
+
+    Returns:
+        Dict[str, Any]: The options, including SQLite pragmas for SQLite URLs.
+    """
+    env = environ if env is None else env
+    options = dict(ENGINE_PROFILES.get(make_url(url).get_backend_name(), {}))
+    for option, (variable, parse) in ENGINE_OPTIONS.items():
+        if env.get(variable):
+            options[option] = parse(env[variable])
+    return options
+
+
+def create_engine(url: str):
+    """Create an (async) engine for a database URL, configured by its profile."""
+    options = engine_options(url)
+    pragmas = {key: options.pop(key) for key in SQLITE_PRAGMAS if key in options}
+    engine = create_async_engine(to_async_url(url), **options)
+    if pragmas:
+
+        # SQLite pragmas are per connection, so we set them on every new connection.
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for key, value in pragmas.items():
+                cursor.execute(f"PRAGMA {key}={value}")
+            cursor.close()
+
+    # We record how long each query takes, see utils/metrics.py.
+    instrument_engine(engine)
+    return engine
+
 
 engine = create_engine(DATABASE_URL)
+read_engine = create_engine(DATABASE_READ_URL) if DATABASE_READ_URL else engine
+
+
+def new_session() -> AsyncSession:
+    # We don't expire objects on commit: In async code, accessing an expired
+    # attribute would need an implicit (and thus forbidden) database round trip.
+    return AsyncSession(engine, expire_on_commit=False)
 
 
-def get_db():
-    with Session(engine) as session:
+def new_read_session() -> AsyncSession:
+    return AsyncSession(read_engine, expire_on_commit=False)
+
+
+async def get_db():
+    async with new_session() as session:
+        yield session
+
+
+# Endpoints that only read from the database use this instead of get_db, so that they
+# can be served from the read replica (if there is one).
+async def get_read_db():
+    async with new_read_session() as session:
         yield session
 
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+def add_columns(conn, table: Table, names: List[str], default: Any = None):
+    """
+    Add columns of `table` to the existing table in the database.
+
+    Columns the table already has are skipped, so this can safely run again.
+
+    Args:
+        table (Table): The table, as defined in models/models.py.
+        names (List[str]): The columns to add.
+        default (Any, optional): If given, the columns are NOT NULL, and existing rows
+            get this value. Otherwise, they're nullable.
+    """
+    existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+    for name in names:
+        if name in existing:
+            continue
+        column = table.columns[name]
+        definition = f"{name} {column.type.compile(dialect=conn.dialect)}"
+        if default is not None:
+            value = literal(default, column.type).compile(
+                dialect=conn.dialect, compile_kwargs={"literal_binds": True}
+            )
+            definition += f" NOT NULL DEFAULT {value}"
+        conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {definition}")
+
+
+def migrate_from_baseline(conn):
+    # Version 1 is the first version we recorded. Databases from before then have the
+    # original schema, which lacks the conversation summary (see utils/context.py),
+    # the conversation overview columns, the indexes on foreign keys, and the flag for
+    # truncated messages.
+    conversation, message = Conversation.__table__, Message.__table__
+    add_columns(conn, conversation, ["summary", "title", "last_message_role"])
+    add_columns(conn, conversation, ["summary_through", "message_count"], default=0)
+    # Messages have no timestamps, so we don't know when a conversation was last
+    # used, and take the time of the migration instead.
+    add_columns(conn, conversation, ["updated_at"], default=utcnow())
+    add_columns(conn, message, ["truncated"], default=False)
+    for index in [*conversation.indexes, *message.indexes]:
+        index.create(conn, checkfirst=True)
+    # We fill in the overview columns from the messages, as activity_update() would
+    # have, had they been there all along.
+    messages = select(Message).where(
+        col(Message.conversation_id) == col(Conversation.id)
+    )
+    conn.execute(
+        update(Conversation).values(
+            message_count=messages.with_only_columns(func.count()).scalar_subquery(),
+            last_message_role=messages.with_only_columns(Message.role)
+            .order_by(col(Message.id).desc())
+            .limit(1)
+            .scalar_subquery(),
+            title=messages.with_only_columns(
+                func.substr(Message.content, 1, TITLE_LENGTH)
+            )
+            .where(Message.role == "user")
+            .order_by(Message.id)
+            .limit(1)
+            .scalar_subquery(),
+        )
+    )
+
+
+def migrate_to_archive(conn):
+    # Version 3 added the archive's columns, see models/archive.py. It also changed
+    # how the full-text index is kept up to date, so we build it from scratch.
+    add_columns(conn, Conversation.__table__, ["archive_segment", "archive_offset"])
+    create_search_index(conn, rebuild=True)
+
+
+# Migrations of existing databases, by the schema version they migrate to. Each takes
+# a synchronous connection, and only needs to change what create_all() doesn't, i.e.
+# existing tables. See migrate_database().
+MIGRATIONS: Dict[int, Callable[[Any], None]] = {
+    1: migrate_from_baseline,
+    # Version 2 added the full-text search index, which indexes existing messages.
+    2: create_search_index,
+    3: migrate_to_archive,
+}
+
+
+def recorded_schema_version(conn) -> Optional[int]:
+    """
+    The schema version recorded in the database.
+
+    Call this with a synchronous connection, e.g. via `conn.run_sync()`.
+
+    Returns:
+        Optional[int]: The version, 0 if the database has tables but no recorded
+            version (i.e. it has the original schema, from before we recorded
+            versions), or None if it hasn't been set up yet.
+    """
+    tables = inspect(conn)
+    if tables.has_table(SchemaVersion.__tablename__):
+        # If there's no version yet, another worker is setting up the database right
+        # now, and hasn't recorded it yet. We go ahead and set it up as well, which
+        # does no harm.
+        return conn.scalar(select(func.max(SchemaVersion.version)))
+    return 0 if tables.has_table(Conversation.__tablename__) else None
+
+
+async def create_db_and_tables():
+    """
+    Set up the database, if it hasn't been set up yet.
+
+    Raises:
+        RuntimeError: If the database has an older (or newer) schema version, and
+            needs to be migrated (or the backend updated).
+    """
+    async with engine.begin() as conn:
+        version = await conn.run_sync(recorded_schema_version)
+        if version is not None:
+            check_version(version)
+        await conn.run_sync(SQLModel.metadata.create_all)
+        # The full-text search index is specific to each database, so it's not
+        # part of the metadata. See models/search.py.
+        await conn.run_sync(create_search_index)
+    if version is not None:
+        return
+    # We only record the schema version for a database we've just set up, or migrated
+    # (see migrate_database()). Several workers may be setting up the database at the
+    # same time, in which case one of them wins.
+    async with new_session() as session:
+        if await session.get(SchemaVersion, SCHEMA_VERSION) is None:
+            session.add(SchemaVersion(version=SCHEMA_VERSION))
+            try:
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+
+
+async def migrate_database():
+    """
+    Migrate the database to the current schema version, one version at a time.
+
+    Each step is recorded in the schema_version table in the same transaction, so if
+    one fails, running this again continues from there. A database that hasn't been
+    set up yet is simply set up, and one from before we recorded schema versions is
+    migrated from the original schema.
+
+    Raises:
+        RuntimeError: If there is no migration for a version.
+    """
+    async with engine.begin() as conn:
+        version = await conn.run_sync(recorded_schema_version)
+    if version is None:
+        await create_db_and_tables()
+        return
+    for step in range(version + 1, SCHEMA_VERSION + 1):
+        if step not in MIGRATIONS:
+            raise RuntimeError(f"There is no migration to schema version {step}")
+        async with engine.begin() as conn:
+            # New tables first, as a migration may fill them.
+            await conn.run_sync(SQLModel.metadata.create_all)
+            await conn.run_sync(MIGRATIONS[step])
+            await conn.execute(insert(SchemaVersion).values(version=step))
+
+
+def check_version(version: Optional[int]):
+    """Raise a RuntimeError if `version` isn't the schema version we expect."""
+    if version == SCHEMA_VERSION:
+        return
+    if version is not None and version > SCHEMA_VERSION:
+        fix = "Update the backend."
+    elif version is not None:
+        fix = "Migrate it with `python -m tacheles_backend.models.database migrate`."
+    else:
+        fix = "Set it up with `python -m tacheles_backend.models.database`."
+    raise RuntimeError(
+        f"The database has schema version {version}, but this backend needs "
+        f"version {SCHEMA_VERSION}. {fix}"
+    )
+
+
+async def check_schema_version():
+    """
+    Check that the database has the schema this backend expects.
+
+    This is a single cheap query, and doesn't change the database, so it's a quick
+    alternative to create_db_and_tables() on startup once the database is set up.
+
+    Raises:
+        RuntimeError: If the database hasn't been set up, or has a different schema
+            version.
+    """
+    try:
+        async with engine.connect() as conn:
+            version = await conn.scalar(select(func.max(SchemaVersion.version)))
+    except DBAPIError:
+        # Most likely, the schema_version table doesn't exist.
+        version = None
+    check_version(version)
 
 
 if __name__ == "__main__":
@@ -29,5 +368,16 @@ if __name__ == "__main__":
     # By default this is run on uvicorn startup for convenience,
     # but in production environments you may wish to disable that,
     # and use this script to set up the database manually.
-    create_db_and_tables()
-    print("Database tables created")
+    # With `migrate`, it migrates an existing database to the current schema version.
+    parser = argparse.ArgumentParser(
+        prog="python -m tacheles_backend.models.database",
+        description="Set up the database, or migrate it to the current schema.",
+    )
+    parser.add_argument("command", nargs="?", choices=["create", "migrate"])
+    args = parser.parse_args()
+    if args.command == "migrate":
+        asyncio.run(migrate_database())
+        print("Database migrated")
+    else:
+        asyncio.run(create_db_and_tables())
+        print("Database tables created")
@@ -1,7 +1,21 @@
+from datetime import datetime, timezone
 from typing import List, Optional
 
 from pydantic import BaseModel
-from sqlmodel import TEXT, Column, Field, Relationship, SQLModel
+from sqlalchemy import BigInteger
+from sqlmodel import (
+    TEXT,
+    Column,
+    Field,
+    Index,
+    Relationship,
+    SQLModel,
+    col,
+    func,
+    update,
+)
+
+from .compression import CompressedText
 
 # Here we define the database schema using SQLModel.
 # You can think of the following classes as a sort of "dataclass" that automagically
@@ -9,6 +23,18 @@ from sqlmodel import TEXT, Column, Field, Relationship, SQLModel
 # even some data transforms (e.g., returning messages as part of a conversation) in
 # the API routes.
 
+# Length of the conversation title, taken from the start of the first user message.
+TITLE_LENGTH = 100
+
+# The version of the database schema. Bump this whenever you change the schema in a
+# way that needs the database to be migrated, so that backends started with
+# DB_SCHEMA_CHECK_ONLY refuse to run against a database that hasn't been migrated.
+SCHEMA_VERSION = 3
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
 
 # A conversation, identified by a unique ID, and linking back to a user, and a
 # list of messages. We also define a to_dict() method which allows us to convert
@@ -20,14 +46,66 @@ class Conversation(SQLModel, table=True):
     """
 
     id: Optional[int] = Field(default=None, primary_key=True)
-    user_id: int = Field(foreign_key="user.id")
-    messages: List["Message"] = Relationship(back_populates="conversation")
+    user_id: int = Field(foreign_key="user.id", index=True)
+    # A rolling summary of the oldest messages, used when the full conversation
+    # doesn't fit into the context budget (see utils/context.py), and the number of
+    # messages it covers.
+    summary: Optional[str] = Field(default=None, sa_column=Column(TEXT))
+    summary_through: int = 0
+    # The following are a denormalized overview of the conversation, so that we can
+    # list a user's conversations without touching any of their messages. They're
+    # updated whenever messages are added, see activity_update().
+    title: Optional[str] = Field(default=None, max_length=TITLE_LENGTH)
+    message_count: int = 0
+    updated_at: datetime = Field(default_factory=utcnow)
+    last_message_role: Optional[str] = None
+    # Conversations that haven't been used in a long time may be moved out of the
+    # message table into the archive, see models/archive.py. If so, this is where
+    # their messages are.
+    archive_segment: Optional[int] = None
+    archive_offset: Optional[int] = Field(default=None, sa_type=BigInteger)
+    messages: List["Message"] = Relationship(
+        back_populates="conversation",
+        sa_relationship_kwargs={"order_by": "Message.id"},
+    )
     user: Optional["User"] = Relationship(back_populates="conversations")
 
+    # This index serves the list of a user's conversations, most recent first.
+    __table_args__ = (
+        Index("ix_conversation_user_id_updated_at", "user_id", "updated_at"),
+    )
+
     def to_list(self):
         """Convert a conversation to a list of messages."""
         return [message.to_dict() for message in self.messages]
 
+    @classmethod
+    def activity_update(cls, conversation_id: int, messages: List["Message"]):
+        """
+        Build an UPDATE statement for the overview columns of a conversation.
+
+        Execute this in the same transaction that inserts the messages, so the
+        overview never disagrees with the messages themselves. We use a single
+        UPDATE with relative values, so we don't need to load the conversation
+        first and concurrent updates don't overwrite each other.
+
+        Args:
+            conversation_id (int): The conversation the messages were added to.
+            messages (List[Message]): The new messages, in order.
+        """
+        values = {
+            "message_count": col(cls.message_count) + len(messages),
+            "updated_at": utcnow(),
+            "last_message_role": messages[-1].role,
+        }
+        for message in messages:
+            if message.role == "user":
+                # The title is only set once, from the first user message.
+                preview = message.content[:TITLE_LENGTH]
+                values["title"] = func.coalesce(col(cls.title), preview)
+                break
+        return update(cls).where(col(cls.id) == conversation_id).values(**values)
+
 
 class User(SQLModel, table=True):
     """A single user identified by a unique ID."""
@@ -43,9 +121,12 @@ class Message(SQLModel, table=True):
     """
 
     id: Optional[int] = Field(default=None, primary_key=True)
-    conversation_id: int = Field(foreign_key="conversation.id")
+    conversation_id: int = Field(foreign_key="conversation.id", index=True)
     role: str
-    content: str = Field(sa_column=Column(TEXT))
+    # The content may be stored compressed, see models/compression.py.
+    content: str = Field(sa_column=Column(CompressedText))
+    # Set if the response was cut short, because the client disconnected.
+    truncated: bool = False
     conversation: Optional[Conversation] = Relationship(back_populates="messages")
 
     def to_dict(self):
@@ -53,6 +134,16 @@ class Message(SQLModel, table=True):
         return {"role": self.role, "content": self.content}
 
 
+# The schema versions the database has been set up or migrated to, see
+# models/database.py.
+class SchemaVersion(SQLModel, table=True):
+    """A schema version the database has been migrated to."""
+
+    __tablename__ = "schema_version"
+
+    version: int = Field(primary_key=True)
+
+
 # The following sets up a nice feature of FastAPI/SQLModel, where we can tell FastAPI
 # what data exactly to include or exclude in the response it sends to the client.
 # Here, we tell it that we'd like it to add the list of messages to the response,
@@ -66,3 +157,27 @@ class ConversationWithMessagesList(BaseModel):
 
     id: int
     messages: List[Message] = []
+
+
+# A lightweight overview of a conversation, for listing a user's conversations. This
+# only needs the columns of the conversation table itself.
+class ConversationSummary(BaseModel):
+    """A conversation's ID, title, message count and time of last activity."""
+
+    id: int
+    title: Optional[str] = None
+    message_count: int = 0
+    updated_at: datetime
+    last_message_role: Optional[str] = None
+
+
+# A message that matched a search, see models/search.py.
+class MessageSearchResult(BaseModel):
+    """A search result: a message, with an excerpt around the matching words."""
+
+    message_id: int
+    conversation_id: int
+    conversation_title: Optional[str] = None
+    role: str
+    snippet: str
+    score: float
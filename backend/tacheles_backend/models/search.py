@@ -0,0 +1,251 @@
+import re
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .compression import MARKER
+from .models import Message, MessageSearchResult
+
+# Here we implement full-text search over a user's messages.
+# Searching the message table with LIKE would read every message of every user, so we
+# keep a full-text index instead, using whatever the database provides:
+# - In SQLite, a separate FTS5 table, message_search, holds each message's text and
+#   the ID of the user it belongs to. Messages may be stored compressed (see
+#   models/compression.py), which only the backend can undo, so the backend adds each
+#   message to the index itself, in the transaction that writes it (see
+#   insert_messages() and index_messages(), which api/routes.py, models/writer.py,
+#   models/archive.py and models/transfer.py use). A database trigger removes deleted
+#   messages. We store the user as a token ("u123") in an indexed column, so that
+#   restricting results to one user is part of the index lookup, rather than a filter
+#   over all matching messages.
+# - In MySQL, a FULLTEXT index on message.content, which InnoDB maintains itself.
+# - Other databases fall back to a (slow) LIKE scan over the user's messages.
+# Results are ranked by relevance, and come with a snippet of the message around the
+# matching words, which are marked in **bold**.
+# Messages that have been moved to the archive (see models/archive.py) aren't
+# searchable. On MySQL and other databases, neither are compressed messages, as the
+# database only sees their compressed form.
+
+# Approximate number of words in a snippet.
+SNIPPET_WORDS = 16
+
+# Number of existing messages to index at once, when creating the index.
+INDEX_BATCH_SIZE = 1000
+
+# Adds a message to the SQLite index.
+INDEX_MESSAGE = (
+    "INSERT INTO message_search (rowid, content, user_id) "
+    "SELECT :id, :content, 'u' || user_id FROM conversation WHERE id = :conversation_id"
+)
+
+
+def create_search_index(conn, rebuild: bool = False):
+    """
+    Create the full-text index, if it doesn't exist yet.
+
+    This also indexes all existing messages, so it works as a migration for existing
+    databases. Call this with a synchronous connection, e.g. via `conn.run_sync()`.
+
+    Args:
+        rebuild (bool): Drop the index first, if it exists, and build it from scratch.
+    """
+    if conn.dialect.name == "sqlite":
+        if rebuild:
+            # Earlier versions also had triggers that indexed new messages.
+            for trigger in ["insert", "update", "delete"]:
+                conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS message_search_{trigger}")
+            conn.exec_driver_sql("DROP TABLE IF EXISTS message_search")
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE name = 'message_search'"
+        ).scalar()
+        if exists:
+            return
+        conn.exec_driver_sql(
+            "CREATE VIRTUAL TABLE message_search USING fts5(content, user_id)"
+        )
+        # Content is decompressed as it's read, so we index the text of every message.
+        last_id = 0
+        while True:
+            messages = conn.execute(
+                select(Message.id, Message.conversation_id, Message.content)
+                .where(col(Message.id) > last_id)
+                .order_by(Message.id)
+                .limit(INDEX_BATCH_SIZE)
+            ).all()
+            if not messages:
+                break
+            conn.execute(text(INDEX_MESSAGE), [dict(m._mapping) for m in messages])
+            last_id = messages[-1].id
+        conn.exec_driver_sql(
+            "CREATE TRIGGER message_search_delete AFTER DELETE ON message BEGIN "
+            "DELETE FROM message_search WHERE rowid = old.id; END"
+        )
+    elif conn.dialect.name == "mysql":
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM information_schema.statistics WHERE table_schema = "
+            "DATABASE() AND table_name = 'message' "
+            "AND index_name = 'ft_message_content' LIMIT 1"
+        ).scalar()
+        if not exists:
+            conn.exec_driver_sql(
+                "ALTER TABLE message ADD FULLTEXT INDEX ft_message_content (content)"
+            )
+
+
+async def index_messages(conn: AsyncConnection, messages: List[Dict[str, Any]]):
+    """
+    Add new messages to the full-text index, where the backend maintains it.
+
+    Call this in the transaction that writes the messages.
+
+    Args:
+        conn (AsyncConnection): The connection writing the messages.
+        messages (List[Dict[str, Any]]): The messages, each with its id,
+            conversation_id, and (uncompressed) content.
+    """
+    if conn.dialect.name != "sqlite" or not messages:
+        return
+    await conn.execute(
+        text(INDEX_MESSAGE),
+        [
+            {
+                "id": message["id"],
+                "conversation_id": message["conversation_id"],
+                "content": message["content"],
+            }
+            for message in messages
+        ],
+    )
+
+
+async def insert_messages(conn: AsyncConnection, messages: List[Dict[str, Any]]):
+    """
+    Insert messages with a single multi-row INSERT, and add them to the index.
+
+    Args:
+        conn (AsyncConnection): The connection to insert the messages with.
+        messages (List[Dict[str, Any]]): The messages' columns, with uncompressed
+            content. Either all of them have an id, or none do.
+    """
+    if conn.dialect.name != "sqlite":
+        await conn.execute(insert(Message), messages)
+        return
+    # The index needs the IDs of the new messages.
+    statement = insert(Message).returning(Message.id, sort_by_parameter_order=True)
+    ids = (await conn.execute(statement, messages)).scalars().all()
+    await index_messages(
+        conn, [{**message, "id": id} for message, id in zip(messages, ids)]
+    )
+
+
+def search_terms(query: str) -> List[str]:
+    """Split a search query into words, dropping any special characters."""
+    return re.findall(r"\w+", query)
+
+
+def make_snippet(content: str, terms: List[str], words: int = SNIPPET_WORDS) -> str:
+    """
+    A short excerpt of `content` around the first matching word, with matches in bold.
+
+    This is only used where the database can't make snippets itself.
+    """
+    tokens = content.split()
+    lowered = [term.lower() for term in terms]
+
+    def matches(token: str) -> bool:
+        token = token.lower()
+        return any(term in token for term in lowered)
+
+    first = next((i for i, token in enumerate(tokens) if matches(token)), 0)
+    start = max(0, first - words // 4)
+    end = start + words
+    excerpt = [
+        f"**{token}**" if matches(token) else token for token in tokens[start:end]
+    ]
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(tokens) else ""
+    return prefix + " ".join(excerpt) + suffix
+
+
+async def search_messages(
+    db: AsyncSession, user_id: int, query: str, limit: int = 20, offset: int = 0
+) -> List[MessageSearchResult]:
+    """
+    Search a user's messages.
+
+    Args:
+        user_id (int): The user whose messages to search.
+        query (str): The search query. Results contain all of its words, where the
+            last word may also be the start of a longer word.
+        limit (int): Maximum number of results.
+        offset (int): Number of results to skip, for pagination.
+
+    Returns:
+        List[MessageSearchResult]: The matching messages, most relevant first.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    dialect = db.bind.dialect.name
+    params = {"user_id": user_id, "limit": limit, "offset": offset, "marker": MARKER}
+    columns = (
+        "message.id AS message_id, message.conversation_id, message.role, "
+        "conversation.title"
+    )
+    if dialect == "sqlite":
+        # The words are quoted, so they can't be mistaken for FTS5 syntax.
+        phrases = " ".join(f'"{term}"' for term in terms)
+        params["match"] = f"user_id : u{int(user_id)} AND content : ({phrases}*)"
+        sql = (
+            f"SELECT {columns}, snippet(message_search, 0, '**', '**', '…', "
+            f"{SNIPPET_WORDS}) AS snippet, -bm25(message_search, 1.0, 0.0) AS score "
+            "FROM message_search "
+            "JOIN message ON message.id = message_search.rowid "
+            "JOIN conversation ON conversation.id = message.conversation_id "
+            "WHERE message_search MATCH :match "
+            "ORDER BY score DESC, message.id DESC LIMIT :limit OFFSET :offset"
+        )
+    elif dialect == "mysql":
+        params["match"] = " ".join(f"+{term}" for term in terms) + "*"
+        match = "MATCH (message.content) AGAINST (:match IN BOOLEAN MODE)"
+        sql = (
+            f"SELECT {columns}, message.content, {match} AS score FROM message "
+            "JOIN conversation ON conversation.id = message.conversation_id "
+            f"WHERE conversation.user_id = :user_id AND {match} "
+            "AND SUBSTR(message.content, 1, 1) <> :marker "
+            "ORDER BY score DESC, message.id DESC LIMIT :limit OFFSET :offset"
+        )
+    else:
+        conditions = []
+        for i, term in enumerate(terms):
+            params[f"term{i}"] = f"%{term.lower()}%"
+            conditions.append(f"LOWER(message.content) LIKE :term{i}")
+        sql = (
+            f"SELECT {columns}, message.content, 0 AS score FROM message "
+            "JOIN conversation ON conversation.id = message.conversation_id "
+            f"WHERE conversation.user_id = :user_id AND {' AND '.join(conditions)} "
+            "AND SUBSTR(message.content, 1, 1) <> :marker "
+            "ORDER BY message.id DESC LIMIT :limit OFFSET :offset"
+        )
+
+    connection = await db.connection()
+    rows = (await connection.execute(text(sql), params)).mappings().all()
+    results = []
+    for row in rows:
+        snippet: Optional[str] = row.get("snippet")
+        if snippet is None:
+            snippet = make_snippet(row["content"], terms)
+        results.append(
+            MessageSearchResult(
+                message_id=row["message_id"],
+                conversation_id=row["conversation_id"],
+                conversation_title=row["title"],
+                role=row["role"],
+                snippet=snippet,
+                score=float(row["score"] or 0),
+            )
+        )
+    return results
@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+import zlib
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+
+from sqlalchemy import DateTime, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .archive import read_messages
+from .models import Conversation, Message, User
+from .search import insert_messages
+
+# Here we implement bulk export and import of all users, conversations and messages,
+# e.g. for backups, analytics, or moving from SQLite to MySQL.
+# The format is NDJSON: one JSON object per line, for one row each, with the name of
+# its table in "table", e.g. {"table": "message", "id": 1, "role": "user", ...}. Rows
+# come table by table, in an order where every row comes after the rows it refers to,
+# so an import can simply insert them in the order they're read. Rows keep their IDs.
+# Message content is exported uncompressed, and messages of archived conversations are
+# included, so the export doesn't depend on the settings of the exporting backend.
+# Both directions work on a stream of rows, rather than loading a table into memory:
+# The export reads each table through a server-side cursor (where the database driver
+# supports one), a batch of rows at a time, and the import inserts rows in batches,
+# with one multi-row INSERT per batch. So memory use stays the same for a thousand
+# rows or a hundred million, and the import runs at the speed of the database.
+# Export with `GET /api/admin/export` (see api/routes.py), or on the command line:
+#   python -m tacheles_backend.models.transfer export backup.ndjson.gz
+#   python -m tacheles_backend.models.transfer import backup.ndjson.gz \
+#       --database-url mysql://...
+
+# The exported tables, in an order that respects their foreign keys.
+TABLES = [User.__table__, Conversation.__table__, Message.__table__]
+
+# Number of rows to fetch from the database, or insert into it, at once.
+BATCH_SIZE = 5000
+
+# Size of the chunks of exported data, in bytes (before compression).
+CHUNK_SIZE = 2**16
+
+
+def encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot export {type(value)}")
+
+
+async def export_rows(
+    engine: AsyncEngine, batch_size: int = BATCH_SIZE
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Read every row of every exported table, one at a time.
+
+    Args:
+        engine (AsyncEngine): The database to export.
+        batch_size (int): Number of rows to fetch from the database at once.
+
+    Yields:
+        Dict[str, Any]: Each row, with the name of its table in "table".
+    """
+    async with engine.connect() as conn:
+        for table in TABLES:
+            query = select(table).order_by(table.c.id)
+            result = await conn.stream(query.execution_options(yield_per=batch_size))
+            async for row in result.mappings():
+                row = {"table": table.name, **row}
+                if table is Conversation.__table__:
+                    # We export the messages of archived conversations like any
+                    # others (see below), so they aren't archived after an import.
+                    row["archive_segment"] = row["archive_offset"] = None
+                yield row
+        # The messages of archived conversations aren't in the message table, so we
+        # read them from the archive, see models/archive.py.
+        query = (
+            select(
+                Conversation.id,
+                Conversation.archive_segment,
+                Conversation.archive_offset,
+            )
+            .where(Conversation.archive_segment.is_not(None))
+            .order_by(Conversation.id)
+        )
+        result = await conn.stream(query.execution_options(yield_per=batch_size))
+        async for conversation in result:
+            for message in read_messages(conversation):
+                yield {
+                    "table": "message",
+                    "id": message["id"],
+                    "conversation_id": conversation.id,
+                    **message,
+                }
+
+
+async def export_ndjson(
+    engine: AsyncEngine, compress: bool = False, batch_size: int = BATCH_SIZE
+) -> AsyncIterator[bytes]:
+    """
+    Export the database as NDJSON, in chunks of about CHUNK_SIZE bytes.
+
+    Args:
+        engine (AsyncEngine): The database to export.
+        compress (bool): Whether to gzip the output.
+        batch_size (int): Number of rows to fetch from the database at once.
+
+    Yields:
+        bytes: The next chunk of the export.
+    """
+    # wbits=31 makes zlib write the gzip format, i.e. a regular .gz file.
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    lines: List[bytes] = []
+    size = 0
+    async for row in export_rows(engine, batch_size):
+        line = json.dumps(row, default=encode_value).encode() + b"\n"
+        lines.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            chunk = b"".join(lines)
+            lines, size = [], 0
+            yield compressor.compress(chunk) if compressor else chunk
+    chunk = b"".join(lines)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+async def import_ndjson(
+    engine: AsyncEngine, lines: Iterable[bytes], batch_size: int = BATCH_SIZE
+) -> Dict[str, int]:
+    """
+    Import rows exported by export_ndjson() into a database.
+
+    The database should have all tables set up, and be empty: Rows keep their IDs, so
+    they would clash with existing ones. Each batch is committed on its own, so if the
+    import fails midway, the rows before the failing batch stay imported.
+
+    Args:
+        engine (AsyncEngine): The database to import into.
+        lines (Iterable[bytes]): The lines of the (uncompressed) export.
+        batch_size (int): Number of rows to insert at once.
+
+    Returns:
+        Dict[str, int]: The number of rows imported into each table.
+    """
+    tables = {table.name: table for table in TABLES}
+    counts = {name: 0 for name in tables}
+    # The export has datetimes as strings, which we need to convert back. (Some
+    # column types wrap a DateTime, so we also look at what they wrap.)
+    datetimes = {
+        name: [
+            column.name
+            for column in table.columns
+            if isinstance(getattr(column.type, "impl", column.type), DateTime)
+        ]
+        for name, table in tables.items()
+    }
+    batch: List[Dict[str, Any]] = []
+    batch_table: Optional[str] = None
+
+    async def flush():
+        if batch:
+            async with engine.begin() as conn:
+                if batch_table == Message.__tablename__:
+                    # Messages also go into the search index.
+                    await insert_messages(conn, batch)
+                else:
+                    await conn.execute(insert(tables[batch_table]), batch)
+            counts[batch_table] += len(batch)
+            batch.clear()
+
+    for line in lines:
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        name = row.pop("table")
+        if name not in tables:
+            raise ValueError(f"Unknown table in import: {name}")
+        for column in datetimes[name]:
+            if row.get(column) is not None:
+                row[column] = datetime.fromisoformat(row[column])
+        # A batch only ever holds rows of one table, and we insert it before moving on
+        # to the next table, so rows are inserted after the rows they refer to.
+        if name != batch_table or len(batch) >= batch_size:
+            await flush()
+            batch_table = name
+        batch.append(row)
+    await flush()
+
+    if engine.dialect.name == "postgresql":
+        # PostgreSQL doesn't advance the ID sequences for rows inserted with an ID,
+        # so we do that here. (SQLite and MySQL take the next ID from the table.)
+        async with engine.begin() as conn:
+            for table in TABLES:
+                await conn.execute(
+                    text(
+                        f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                        f"COALESCE((SELECT MAX(id) FROM {table.name}), 0) + 1, false)"
+                    )
+                )
+    return counts
+
+
+def open_file(path: str, mode: str):
+    """Open a file (or stdin/stdout for "-"), gzipped if its name ends in .gz."""
+    if path == "-":
+        return sys.stdin.buffer if "r" in mode else sys.stdout.buffer
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+async def main(argv: Optional[List[str]] = None):
+    # We import this here, so that importing this module doesn't set up a database.
+    from . import database
+
+    parser = argparse.ArgumentParser(
+        prog="python -m tacheles_backend.models.transfer",
+        description="Export or import all users, conversations and messages.",
+    )
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument(
+        "file", nargs="?", default="-", help="NDJSON file, gzipped if it ends in .gz"
+    )
+    parser.add_argument("--database-url", help="Database to use, not DATABASE_URL")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.database_url:
+        database.engine = database.create_engine(args.database_url)
+    engine = database.engine
+    if args.command == "export":
+        with open_file(args.file, "wb") as f:
+            async for chunk in export_ndjson(engine, batch_size=args.batch_size):
+                f.write(chunk)
+    else:
+        # We set up the tables first, in case this is a new database.
+        await database.create_db_and_tables()
+        with open_file(args.file, "rb") as f:
+            counts = await import_ndjson(engine, f, batch_size=args.batch_size)
+        print(", ".join(f"{n} {name} rows" for name, n in counts.items()))
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,294 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..utils.logging import get_logger
+from . import database
+from .models import Conversation, Message
+from .search import insert_messages
+
+# Here we implement optional "write-behind" persistence of chat messages.
+# By default, /api/chat commits the user's message and the LLM's response to the
+# database at the end of every response. On a networked database like MySQL, that's a
+# round trip (and a disk flush) for every single message pair. With write-behind mode
+# (WRITE_BEHIND=1), finished message pairs instead go into an in-memory queue, and a
+# background task writes them to the database in batches: as soon as WRITE_BEHIND_BATCH
+# messages are waiting, or at the latest WRITE_BEHIND_MAX_DELAY_MS after the oldest
+# waiting message was queued. That latter value is our durability bound: If the
+# process crashes, at most this much of the most recent conversation is lost. (On a
+# regular shutdown, we write everything that's left before exiting.)
+# Other replicas only see the messages once they're written, so anyone who tells them
+# about changed conversations (e.g. to invalidate their history caches, see
+# api/routes.py) should subscribe() to be told when a batch has been committed.
+# If a batch fails because the database is unavailable, we put it back and retry it
+# later. If it fails for any other reason (e.g. a message violates a constraint), a
+# retry would fail the same way and hold up everything queued behind it. We then write
+# the batch one turn at a time instead, and drop (and log) the turns that still fail.
+
+logger = get_logger(__name__)
+
+# Errors that mean the database is (temporarily) unavailable, rather than that
+# something is wrong with the messages themselves.
+TRANSIENT_ERRORS = (
+    OperationalError,
+    InterfaceError,
+    DisconnectionError,
+    OSError,
+    asyncio.TimeoutError,
+)
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a failed write might succeed if we simply try again later."""
+    return isinstance(error, TRANSIENT_ERRORS) or getattr(
+        error, "connection_invalidated", False
+    )
+
+
+class MessageWriter:
+    """
+    Batches message inserts and writes them in the background.
+
+    Args:
+        enabled (bool): Whether write-behind mode is on. If not, callers should
+            write messages themselves.
+        session_factory (Callable[[], AsyncSession]): Creates database sessions
+            for the background writes.
+        max_batch (int): Write as soon as this many messages are queued.
+        max_delay (float): Maximum time in seconds a message waits in the queue.
+        max_queue (int): If this many messages are queued, submit() waits for
+            a write, so a slow database slows down new submissions instead of
+            making us run out of memory.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        session_factory: Optional[Callable[[], AsyncSession]] = None,
+        max_batch: int = 500,
+        max_delay: float = 0.5,
+        max_queue: int = 50000,
+    ):
+        self.enabled = enabled
+        self.session_factory = session_factory or (lambda: database.new_session())
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        # The queue holds (time queued, messages) groups, as a message pair should
+        # always end up in the same write.
+        self._queue: Deque[Tuple[float, List[Message]]] = deque()
+        self._pending_conversations: Dict[int, int] = {}
+        self._depth = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._stopping = False
+        self._subscribers: List[Callable[[int], None]] = []
+        # Statistics, see stats().
+        self.max_depth = 0
+        self.messages_written = 0
+        self.batches_written = 0
+        self.write_failures = 0
+        self.messages_dropped = 0
+
+    @classmethod
+    def from_env(cls) -> "MessageWriter":
+        return cls(
+            enabled=os.environ.get("WRITE_BEHIND", "").lower() in ("1", "true", "yes"),
+            max_batch=int(os.environ.get("WRITE_BEHIND_BATCH", 500)),
+            max_delay=int(os.environ.get("WRITE_BEHIND_MAX_DELAY_MS", 500)) / 1000,
+            max_queue=int(os.environ.get("WRITE_BEHIND_MAX_QUEUE", 50000)),
+        )
+
+    @property
+    def depth(self) -> int:
+        """Number of messages waiting to be written."""
+        return self._depth
+
+    async def start(self):
+        """Start the background writer. Call this on application startup."""
+        if not self.enabled or self._task is not None:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Write all queued messages and stop. Call this on application shutdown."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def submit(self, messages: List[Message]):
+        """
+        Queue messages to be written to the database.
+
+        Args:
+            messages (List[Message]): Messages that should be written together,
+                typically a user message and the LLM's response.
+        """
+        if self._task is None:
+            # Not started (or already stopped), so there's no one to write these
+            # later. This happens e.g. when the app runs without lifespan events.
+            await self._write(messages)
+            return
+        self._queue.append((time.monotonic(), messages))
+        self._depth += len(messages)
+        self.max_depth = max(self.max_depth, self._depth)
+        for message in messages:
+            conversation_id = message.conversation_id
+            count = self._pending_conversations.get(conversation_id, 0)
+            self._pending_conversations[conversation_id] = count + 1
+        if self._depth >= self.max_batch:
+            self._wakeup.set()
+        if self._depth >= self.max_queue:
+            await self.flush()
+
+    def subscribe(self, callback: Callable[[int], None]):
+        """Call `callback(conversation_id)` whenever its messages have been written."""
+        self._subscribers.append(callback)
+
+    def has_pending(self, conversation_id: int) -> bool:
+        """Whether there are queued messages for the given conversation."""
+        return conversation_id in self._pending_conversations
+
+    async def flush_conversation(self, conversation_id: int):
+        """
+        Make sure all messages of a conversation are written.
+
+        We call this before reading a conversation from the database, so that users
+        always see their own latest messages.
+        """
+        if self.has_pending(conversation_id):
+            await self.flush()
+
+    async def flush(self):
+        """Write all queued messages now."""
+        while self._queue:
+            await self._write_batch()
+
+    def stats(self) -> Dict[str, float]:
+        oldest = time.monotonic() - self._queue[0][0] if self._queue else 0.0
+        return {
+            "queue_depth": self._depth,
+            "max_queue_depth": self.max_depth,
+            "oldest_queued_seconds": oldest,
+            "messages_written": self.messages_written,
+            "batches_written": self.batches_written,
+            "write_failures": self.write_failures,
+            "messages_dropped": self.messages_dropped,
+        }
+
+    async def _run(self):
+        while not (self._stopping and not self._queue):
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # Wait until the batch is full, or the oldest message has waited long
+            # enough, whichever comes first.
+            timeout = self._queue[0][0] + self.max_delay - time.monotonic()
+            if self._depth < self.max_batch and timeout > 0 and not self._stopping:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._write_batch()
+            except Exception:
+                # The database is unavailable, and _write_batch has put the messages
+                # back into the queue. We back off for a bit, so we don't hammer it.
+                await asyncio.sleep(min(self.max_delay, 1.0))
+
+    async def _write_batch(self):
+        async with self._lock:
+            groups: List[Tuple[float, List[Message]]] = []
+            count = 0
+            while self._queue and count < self.max_batch:
+                groups.append(self._queue.popleft())
+                count += len(groups[-1][1])
+            if not groups:
+                return
+            messages = [message for _, group in groups for message in group]
+            try:
+                await self._write(messages)
+            except Exception as e:
+                self.write_failures += 1
+                logger.error(f"Error writing {count} queued messages: {str(e)}")
+                if is_transient(e):
+                    self._queue.extendleft(reversed(groups))
+                    raise
+                await self._write_groups(groups)
+                return
+            self._done(groups)
+
+    async def _write_groups(self, groups: List[Tuple[float, List[Message]]]):
+        # A batch failed for a reason other than the database being unavailable. We
+        # find the culprit(s) by writing each turn on its own.
+        for i, (queued, group) in enumerate(groups):
+            try:
+                await self._write(group)
+            except Exception as e:
+                self.write_failures += 1
+                if is_transient(e):
+                    self._queue.extendleft(reversed(groups[i:]))
+                    raise
+                self.messages_dropped += len(group)
+                logger.error(
+                    f"Dropping {len(group)} messages of conversation "
+                    f"{group[0].conversation_id} that can't be written: {str(e)}"
+                )
+            self._done([(queued, group)])
+
+    def _done(self, groups: List[Tuple[float, List[Message]]]):
+        # The messages are no longer queued, whether they were written or dropped.
+        conversations: Set[int] = set()
+        for _, group in groups:
+            self._depth -= len(group)
+            for message in group:
+                conversation_id = message.conversation_id
+                conversations.add(conversation_id)
+                self._pending_conversations[conversation_id] -= 1
+        for conversation_id in conversations:
+            if self._pending_conversations[conversation_id] <= 0:
+                del self._pending_conversations[conversation_id]
+
+    async def _write(self, messages: List[Message]):
+        # We use a single multi-row INSERT rather than going through the ORM, which
+        # would insert (and fetch back the ID of) every message individually. We also
+        # update the overview columns of each conversation in the same transaction.
+        by_conversation: Dict[int, List[Message]] = {}
+        for message in messages:
+            by_conversation.setdefault(message.conversation_id, []).append(message)
+        async with self.session_factory() as session:
+            await insert_messages(
+                await session.connection(),
+                [
+                    {
+                        "conversation_id": message.conversation_id,
+                        "role": message.role,
+                        "content": message.content,
+                        "truncated": message.truncated,
+                    }
+                    for message in messages
+                ],
+            )
+            for conversation_id, group in by_conversation.items():
+                await session.exec(Conversation.activity_update(conversation_id, group))
+            await session.commit()
+        self.messages_written += len(messages)
+        self.batches_written += 1
+        for conversation_id in by_conversation:
+            for callback in self._subscribers:
+                callback(conversation_id)
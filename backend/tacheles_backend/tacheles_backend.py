@@ -1,13 +1,20 @@
 import os
 from uuid import uuid4
 
+import itsdangerous
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 
-from .api.routes import router
-from .models.database import create_db_and_tables
+from .api.routes import is_admin, message_writer, profiler, router, state
+from .models.database import check_schema_version, create_db_and_tables
+from .utils.logging import get_logger
+from .utils.metrics import MetricsMiddleware
+from .utils.profiler import ProfilerMiddleware
+from .utils.static import PrecompressedStaticFiles
+
+logger = get_logger(__name__)
 
 # Here we create and set up the FastAPI, and pull together all the components
 # defined in api/routes.py and models/models.py
@@ -20,8 +27,39 @@ app = FastAPI(
 )
 
 # Then we set up a session middleware. We use this for some basic session management
-# and authentication.
-app.add_middleware(SessionMiddleware, secret_key=uuid4().hex)
+# and authentication. Sessions are signed with a secret key. If you run several backend
+# workers (or restart the backend), they all need the same key, or users will be
+# logged out whenever a request reaches a different worker. So in production, set
+# SESSION_SECRET_KEY to a long random string. Without it, we make up a key, which is
+# fine for development with a single worker. If the workers share a state backend (see
+# utils/state.py), the first one makes up a key there, and all others use it too.
+
+
+class SharedKeySessionMiddleware(SessionMiddleware):
+    """SessionMiddleware with a key from the state backend, fetched on first use."""
+
+    def __init__(self, app: ASGIApp, **kwargs):
+        super().__init__(app, secret_key="", **kwargs)
+        self.signer = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if self.signer is None and scope["type"] in ("http", "websocket"):
+            secret_key = await state.shared_secret("session_secret_key")
+            self.signer = itsdangerous.TimestampSigner(secret_key)
+        await super().__call__(scope, receive, send)
+
+
+session_secret_key = os.environ.get("SESSION_SECRET_KEY")
+if session_secret_key:
+    app.add_middleware(SessionMiddleware, secret_key=session_secret_key)
+elif state.shared:
+    app.add_middleware(SharedKeySessionMiddleware)
+else:
+    logger.warning(
+        "SESSION_SECRET_KEY is not set, using a random key. Sessions will not work "
+        "across several workers or restarts."
+    )
+    app.add_middleware(SessionMiddleware, secret_key=uuid4().hex)
 
 # We set up CORS, by default allowing all origins. This is useful for development,
 # but you should restrict this to your frontend domain in production.
@@ -37,16 +75,26 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Clients need to read this header to resume a response, see /api/chat.
+    expose_headers=["X-Generation-Id"],
 )
 
+# We profile a sample of requests, see `utils/profiler.py`.
+app.add_middleware(ProfilerMiddleware, profiler=profiler, authorize=is_admin)
+
+# We time every request, see `utils/metrics.py`. We add this middleware last, so it
+# wraps all the others and sees the full time spent on each request.
+app.add_middleware(MetricsMiddleware)
+
 # We mount the API routes from `api/routes.py`
 app.include_router(router, tags=["api"])
 
-# Optionally, we mount the compiled frontend as a static directory
+# Optionally, we mount the compiled frontend as a static directory. This serves
+# precompressed files with long-lived cache headers, see `utils/static.py`.
 if os.environ.get("HOST_FRONTEND_PATH", False):
     app.mount(
         "/",
-        StaticFiles(
+        PrecompressedStaticFiles.from_env(
             directory=os.environ.get("HOST_FRONTEND_PATH"),
             html=True,
             check_dir=False,
@@ -59,9 +107,24 @@ if os.environ.get("HOST_FRONTEND_PATH", False):
 # This is enabled here as a convenience for development.
 # In practice, you would set up databases manually, or
 # use `python -m tacheles_backend.models.database` to create them.
+# With DB_SCHEMA_CHECK_ONLY set, we then only check that the database has the schema
+# version we expect. This is a single query, so workers start quickly, and several
+# workers starting at once don't all try to create tables at the same time.
 @app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
+async def on_startup():
+    if os.environ.get("DB_SCHEMA_CHECK_ONLY", "").lower() in ("1", "true", "yes"):
+        await check_schema_version()
+    else:
+        await create_db_and_tables()
+    await message_writer.start()
+    await state.start()
+
+
+# On shutdown, we write any chat messages still queued up in write-behind mode.
+@app.on_event("shutdown")
+async def on_shutdown():
+    await message_writer.stop()
+    await state.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,162 @@
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+# Here we implement a small in-memory cache of conversation histories.
+# Every call to /api/chat needs the entire conversation history to build the prompt.
+# Loading it from the database on every turn means reading every message of the
+# conversation again, even though all but the last two are unchanged. Instead, each
+# backend worker can keep recently used conversations in memory, already formatted the
+# way we send them to the LLM, and append the new messages after each turn.
+# The cache is bounded by (approximate) size in bytes, evicting the least recently used
+# conversations first. Set HISTORY_CACHE_BYTES to enable it.
+# If you run several backend workers or replicas, a conversation cached in one worker
+# may be changed through another. Workers must then tell each other about changes: The
+# cache calls its subscribers whenever it changes a conversation locally, so they can
+# pass this on to other workers, which in turn call invalidate() on their own caches.
+
+# Rough per-message overhead of a dict with two short strings in CPython.
+MESSAGE_OVERHEAD_BYTES = 250
+
+
+def message_size(message: Dict[str, str]) -> int:
+    return len(message["content"]) + MESSAGE_OVERHEAD_BYTES
+
+
+@dataclass
+class CachedConversation:
+    """
+    A conversation's history, as needed to build the prompt for the next turn.
+
+    Attributes:
+        user_id (int): The user the conversation belongs to.
+        messages (List[Dict[str, str]]): The messages, formatted for the LLM.
+        summary (str, optional): The conversation's rolling summary.
+        summary_through (int): Number of messages covered by the summary.
+    """
+
+    user_id: int
+    messages: List[Dict[str, str]] = field(default_factory=list)
+    summary: Optional[str] = None
+    summary_through: int = 0
+
+    @property
+    def size(self) -> int:
+        return sum(message_size(m) for m in self.messages) + len(self.summary or "")
+
+
+class HistoryCache:
+    """
+    A per-worker LRU cache of conversation histories, bounded by size in bytes.
+
+    Args:
+        max_bytes (int): Maximum total size of cached conversations. 0 disables
+            the cache.
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[int, CachedConversation]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._subscribers: List[Callable[[int], None]] = []
+
+    @classmethod
+    def from_env(cls) -> "HistoryCache":
+        return cls(max_bytes=int(os.environ.get("HISTORY_CACHE_BYTES", 0)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, conversation_id: int) -> Optional[CachedConversation]:
+        """Return the cached conversation, or None if it isn't cached."""
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(conversation_id)
+        self.hits += 1
+        return entry
+
+    def put(self, conversation_id: int, entry: CachedConversation):
+        """Add a conversation that was just loaded from the database."""
+        if self.max_bytes <= 0:
+            return
+        self._discard(conversation_id)
+        self._entries[conversation_id] = entry
+        self._sizes[conversation_id] = 0
+        self._grow(conversation_id, entry.size)
+
+    def append(self, conversation_id: int, messages: List[Dict[str, str]]):
+        """Append new messages to a cached conversation, if it is cached."""
+        entry = self._entries.get(conversation_id)
+        if entry is not None:
+            entry.messages.extend(messages)
+            self._entries.move_to_end(conversation_id)
+            self._grow(conversation_id, sum(message_size(m) for m in messages))
+        self._notify(conversation_id)
+
+    def update(self, conversation_id: int, **fields):
+        """Update other fields (e.g. the summary) of a cached conversation."""
+        entry = self._entries.get(conversation_id)
+        if entry is not None:
+            old_size = len(entry.summary or "")
+            for name, value in fields.items():
+                setattr(entry, name, value)
+            self._grow(conversation_id, len(entry.summary or "") - old_size)
+        self._notify(conversation_id)
+
+    def invalidate(self, conversation_id: int, notify: bool = True):
+        """
+        Drop a conversation from the cache, e.g. because it changed elsewhere.
+
+        Args:
+            conversation_id (int): The conversation to drop.
+            notify (bool): Whether to tell subscribers. Set this to False when
+                applying an invalidation that came from another worker.
+        """
+        self._discard(conversation_id)
+        if notify:
+            self._notify(conversation_id)
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self.size = 0
+
+    def subscribe(self, callback: Callable[[int], None]):
+        """Call `callback(conversation_id)` whenever a conversation changes here."""
+        self._subscribers.append(callback)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _notify(self, conversation_id: int):
+        for callback in self._subscribers:
+            callback(conversation_id)
+
+    def _discard(self, conversation_id: int):
+        if self._entries.pop(conversation_id, None) is not None:
+            self.size -= self._sizes.pop(conversation_id)
+
+    def _grow(self, conversation_id: int, delta: int):
+        # We track sizes incrementally, so appending to a long conversation doesn't
+        # mean walking all of its messages again.
+        self._sizes[conversation_id] += delta
+        self.size += delta
+        # Evict least recently used conversations until we're within budget. A
+        # conversation larger than the whole cache is not kept at all.
+        while self.size > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._discard(oldest)
+            self.evictions += 1
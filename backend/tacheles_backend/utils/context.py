@@ -0,0 +1,226 @@
+import os
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+# Here we decide which part of a conversation we actually send to the LLM.
+# The simplest approach is to send the entire conversation history every turn, and this
+# is still what we do by default. But this means every turn of a long conversation is
+# slower to prefill than the last, and eventually the conversation won't fit into the
+# model's context window at all.
+# If CONTEXT_TOKEN_BUDGET is set, we instead keep the system prompt, the new user
+# message, and as many of the most recent messages as fit into the budget. Optionally
+# (CONTEXT_SUMMARIZE), the messages we drop are replaced by a rolling summary, which
+# we ask the LLM to write, and store alongside the conversation so it's only updated
+# when more messages fall out of the window.
+
+# Chat templates add a few tokens per message (role markers, separators, ...).
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = (
+    "Summarize the following conversation between a user and an AI assistant. "
+    "Keep all facts, names, decisions and open questions that might be needed to "
+    "continue the conversation. Be concise."
+)
+
+
+def approximate_token_count(text: str) -> int:
+    # Roughly four characters per token for English text. We use this unless a real
+    # tokenizer is configured. It's good enough to stay within a budget that leaves
+    # some headroom below the actual context window.
+    return len(text) // 4 + 1
+
+
+def load_tokenizer(name: Optional[str] = None) -> Callable[[str], int]:
+    """
+    Load a token counting function.
+
+    Both real tokenizers are optional dependencies, and download their vocabulary the
+    first time they're used (tiktoken caches it in TIKTOKEN_CACHE_DIR, if set), so
+    in an offline deployment, make sure it's there beforehand.
+
+    Args:
+        name (str, optional): "hf:<model>" to use a Hugging Face tokenizer (requires
+            the `tokenizers` package), or "tiktoken" or "tiktoken:<encoding>" to use
+            tiktoken (requires the `tiktoken` package, default encoding cl100k_base).
+            By default, we use a character-based approximation.
+
+    Returns:
+        Callable[[str], int]: A function that counts the tokens in a string.
+    """
+    if not name:
+        return approximate_token_count
+    kind, _, argument = name.partition(":")
+    if kind == "hf" and argument:
+        from tokenizers import Tokenizer
+
+        tokenizer = Tokenizer.from_pretrained(argument)
+        return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+    if kind == "tiktoken":
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(argument or "cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    raise ValueError(f"Unknown TOKENIZER: {name}")
+
+
+@dataclass
+class ContextWindow:
+    """
+    The messages to send to the LLM for one turn.
+
+    Attributes:
+        messages (List[Dict[str, str]]): The messages, including the system prompt.
+        start (int): Index of the first history message that was included.
+        unsummarized (bool): Whether messages were dropped that aren't covered by
+            the conversation's summary yet.
+    """
+
+    messages: List[Dict[str, str]] = field(default_factory=list)
+    start: int = 0
+    unsummarized: bool = False
+
+
+class ContextBuilder:
+    """
+    Assemble the LLM context for a conversation turn within a token budget.
+
+    Args:
+        count_tokens (Callable[[str], int]): Function to count tokens in a string.
+        budget (int, optional): Maximum number of prompt tokens. None means no
+            limit, i.e. the entire history is always sent.
+        summarize (bool): Whether to replace dropped messages with a summary.
+        summary_max_tokens (int): Maximum length of a generated summary.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int] = approximate_token_count,
+        budget: Optional[int] = None,
+        summarize: bool = False,
+        summary_max_tokens: int = 256,
+    ):
+        self.count_tokens = count_tokens
+        self.budget = budget
+        self.summarize = summarize
+        self.summary_max_tokens = summary_max_tokens
+
+    @classmethod
+    def from_env(cls) -> "ContextBuilder":
+        budget = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 0)) or None
+        return cls(
+            # We only load a tokenizer if we actually need to count tokens.
+            count_tokens=(
+                load_tokenizer(os.environ.get("TOKENIZER"))
+                if budget
+                else approximate_token_count
+            ),
+            budget=budget,
+            summarize=os.environ.get("CONTEXT_SUMMARIZE", "").lower()
+            in ("1", "true", "yes"),
+            summary_max_tokens=int(os.environ.get("CONTEXT_SUMMARY_MAX_TOKENS", 256)),
+        )
+
+    def message_tokens(self, message: Dict[str, str]) -> int:
+        return self.count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+    def build(
+        self,
+        system_prompt: str,
+        history: List[Dict[str, str]],
+        new_message: Dict[str, str],
+        summary: Optional[str] = None,
+        summary_through: int = 0,
+    ) -> ContextWindow:
+        """
+        Build the context for the next turn.
+
+        Args:
+            system_prompt (str): The system prompt.
+            history (List[Dict[str, str]]): All prior messages of the conversation.
+            new_message (Dict[str, str]): The user's new message.
+            summary (str, optional): The stored summary of the oldest messages.
+            summary_through (int): Number of history messages the summary covers.
+
+        Returns:
+            ContextWindow: The messages to send.
+        """
+        system = {"role": "system", "content": system_prompt}
+        if self.budget is None:
+            return ContextWindow([system] + history + [new_message])
+
+        # The system prompt and the new message are always included.
+        remaining = (
+            self.budget - self.message_tokens(system) - self.message_tokens(new_message)
+        )
+        if self.summarize and summary:
+            summary_tokens = self.count_tokens(summary)
+            if summary_tokens <= remaining:
+                remaining -= summary_tokens
+            else:
+                summary = None
+
+        # Then we add history messages, newest first, until the budget runs out.
+        start = len(history)
+        while start > 0:
+            cost = self.message_tokens(history[start - 1])
+            if cost > remaining:
+                break
+            remaining -= cost
+            start -= 1
+        if start == 0:
+            # Everything fits, no need for a summary.
+            return ContextWindow([system] + history + [new_message])
+
+        # Most chat templates expect the (non-system) messages to start with a user
+        # message, so we don't start the window in the middle of a turn.
+        while start < len(history) and history[start]["role"] != "user":
+            start += 1
+
+        unsummarized = False
+        if self.summarize and summary:
+            # Messages covered by the summary don't need to be repeated verbatim.
+            start = max(start, summary_through)
+            unsummarized = start > summary_through
+            system = {
+                "role": "system",
+                "content": f"{system_prompt}\n\nSummary of the earlier part of "
+                f"this conversation:\n{summary}",
+            }
+        elif self.summarize:
+            unsummarized = True
+
+        return ContextWindow(
+            [system] + history[start:] + [new_message], start, unsummarized
+        )
+
+    async def summarize_messages(
+        self,
+        client,
+        model: str,
+        messages: List[Dict[str, str]],
+        previous_summary: Optional[str] = None,
+    ) -> str:
+        """
+        Ask the LLM to (re-)write the rolling summary of a conversation.
+
+        Args:
+            client (AsyncOpenAI): The inference client.
+            model (str): The model name.
+            messages (List[Dict[str, str]]): Messages not yet covered by the summary.
+            previous_summary (str, optional): The summary so far.
+
+        Returns:
+            str: The new summary, covering previous_summary and messages.
+        """
+        transcript = "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        if previous_summary:
+            transcript = f"Summary so far: {previous_summary}\n\n{transcript}"
+        completion = await client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript},
+            ],
+            max_tokens=self.summary_max_tokens,
+        )
+        return completion.choices[0].message.content or ""
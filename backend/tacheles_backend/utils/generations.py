@@ -0,0 +1,466 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set, Union
+from uuid import uuid4
+
+from .logging import get_logger
+from .state import StateBackend
+
+# A running generation's claim on its idempotency key expires after this many seconds,
+# in case its replica goes away without releasing it. Its frames in the state backend
+# expire after this long, too.
+CLAIM_SECONDS = 600
+
+# How often a reader on another replica checks for new frames, and tells the replica
+# running the generation that it's still reading, in seconds.
+SHARED_POLL_SECONDS = 0.05
+SHARED_HEARTBEAT_SECONDS = 1.0
+
+# Here we keep track of the LLM responses that are currently being generated.
+# Rather than streaming straight from the inference server to the client, each
+# response ("generation") runs as a background task that writes the frames it produces
+# into a buffer, and the HTTP response just reads from that buffer. This decouples the
+# generation from the connection to the client: If the connection drops mid-response,
+# the client can reconnect with the generation's ID and the number of frames it has
+# already received, and continue reading from the buffer, without a second call to
+# the inference server.
+# Buffers are bounded ring buffers, so a very long response doesn't use unbounded
+# memory. A reader that falls too far behind can't resume, and has to start over.
+# If nobody is reading a generation anymore (e.g. the user closed the tab), we keep it
+# running for a short grace period in case the client reconnects, and then abort it.
+# Finished generations are kept around for a while longer, so clients that reconnect
+# just after the end of a response can still read its last frames.
+# Generations can also be looked up by an "idempotency key" that identifies the
+# request that started them. If the same request comes in again (e.g. after a
+# double-click, or a retry by the client or a proxy), we attach it to the existing
+# generation, rather than starting a second one, see /api/chat. With a shared state
+# backend (see utils/state.py), each generation also claims its key there, so a repeat
+# that reaches another replica can be turned away rather than answered a second time.
+# A shared state backend also holds a copy of each generation's ring buffer: A
+# background task copies every frame there (as "frames:<id>:<offset>"), along with the
+# generation's progress ("frames:<id>"), so a client can resume on any replica. A
+# reader on another replica polls the state backend for new frames, and keeps telling
+# the replica running the generation that it's still reading, so that the generation
+# isn't aborted while it does.
+
+logger = get_logger(__name__)
+
+
+class GenerationExpired(Exception):
+    """Raised when reading frames that have already left the ring buffer."""
+
+
+class GenerationFailed(Exception):
+    """Raised to readers when the generation ended with an error."""
+
+
+class Generation:
+    """
+    A response being generated, and the frames it has produced so far.
+
+    Args:
+        id (str): A unique ID, which clients use to resume reading.
+        user_id (int): The user who started the generation.
+        conversation_id (int): The conversation the response belongs to.
+        max_frames (int): Size of the ring buffer.
+        key (str, optional): The idempotency key of the request.
+        parent (int): Number of messages in the conversation before the request.
+    """
+
+    def __init__(
+        self,
+        id: str,
+        user_id: int,
+        conversation_id: int,
+        max_frames: int,
+        key: Optional[str] = None,
+        parent: int = 0,
+    ):
+        self.id = id
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.key = key
+        self.parent = parent
+        # The text of the response so far, one item per content frame. Unlike the
+        # frames, we keep all of it, so a duplicate request can always catch up.
+        self.text: List[str] = []
+        self.frames: Deque[bytes] = deque(maxlen=max_frames)
+        self.next_offset = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.readers = 0
+        self.abandoned = False
+        self.task: Optional[asyncio.Task] = None
+        self.finished_at: Optional[float] = None
+        self._changed = asyncio.Event()
+        self._finished = asyncio.Event()
+
+    @property
+    def first_offset(self) -> int:
+        """Offset of the oldest frame still in the buffer."""
+        return self.next_offset - len(self.frames)
+
+    def append(self, frame: bytes):
+        """Add a frame, and wake up all readers."""
+        self.frames.append(frame)
+        self.next_offset += 1
+        self._wake()
+
+    def finish(self, error: Optional[BaseException] = None):
+        """Mark the generation as complete. No more frames will be added."""
+        self.done = True
+        self.error = error
+        self.finished_at = time.monotonic()
+        self._finished.set()
+        self._wake()
+
+    async def wait(self):
+        """Wait until the generation is complete."""
+        await self._finished.wait()
+
+    async def read(self, offset: int = 0) -> AsyncIterator[bytes]:
+        """
+        Yield all frames from `offset` onwards, waiting for new frames as needed.
+
+        Raises:
+            GenerationExpired: If frames from `offset` are no longer buffered.
+            GenerationFailed: If the generation ended with an error.
+        """
+        while True:
+            while offset < self.next_offset:
+                if offset < self.first_offset:
+                    raise GenerationExpired(f"Frame {offset} is no longer buffered")
+                yield self.frames[offset - self.first_offset]
+                offset += 1
+            if self.done:
+                if self.error is not None:
+                    raise GenerationFailed(str(self.error))
+                return
+            # We swap in a fresh event before waiting, so that every append wakes
+            # up all readers exactly once.
+            await self._changed.wait()
+
+    def _wake(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+
+class SharedGeneration:
+    """
+    A generation running on another replica, read through the state backend.
+
+    Args:
+        id (str): The generation's ID.
+        user_id (int): The user who started the generation.
+        next_offset (int): Number of frames it had produced when we looked it up.
+        max_frames (int): Size of its ring buffer.
+        state (StateBackend): The shared state backend.
+    """
+
+    def __init__(
+        self,
+        id: str,
+        user_id: int,
+        next_offset: int,
+        max_frames: int,
+        state: StateBackend,
+    ):
+        self.id = id
+        self.user_id = user_id
+        self.next_offset = next_offset
+        self.max_frames = max_frames
+        self.state = state
+
+    @property
+    def first_offset(self) -> int:
+        """Offset of the oldest frame still in the buffer."""
+        return max(0, self.next_offset - self.max_frames)
+
+    async def read(self, offset: int = 0) -> AsyncIterator[bytes]:
+        """
+        Yield all frames from `offset` onwards, polling for new frames as needed.
+
+        Raises:
+            GenerationExpired: If frames from `offset` are no longer buffered.
+            GenerationFailed: If the generation ended with an error.
+        """
+        key = f"frames:{self.id}"
+        heartbeat = 0.0
+        while True:
+            if time.monotonic() - heartbeat >= SHARED_HEARTBEAT_SECONDS:
+                heartbeat = time.monotonic()
+                await self.state.set(
+                    f"{key}:reading", "1", ttl=3 * SHARED_HEARTBEAT_SECONDS
+                )
+            progress = await self.state.get(key)
+            if progress is None:
+                raise GenerationExpired(f"Generation {self.id} is no longer buffered")
+            progress = json.loads(progress)
+            # Frames are written before the progress, so these are all there, unless
+            # they have left the ring buffer.
+            while offset < progress["next"]:
+                frame = await self.state.get(f"{key}:{offset}")
+                if frame is None:
+                    raise GenerationExpired(f"Frame {offset} is no longer buffered")
+                yield frame.encode()
+                offset += 1
+            if progress["done"]:
+                if progress["error"] is not None:
+                    raise GenerationFailed(progress["error"])
+                return
+            await asyncio.sleep(SHARED_POLL_SECONDS)
+
+
+class GenerationRegistry:
+    """
+    All generations of this worker, by ID.
+
+    Args:
+        max_frames (int): Ring buffer size per generation.
+        grace (float): Seconds to keep an unread generation running before we abort
+            it. 0 aborts it as soon as the last reader disconnects.
+        retention (float): Seconds to keep finished generations for late readers.
+        state (StateBackend, optional): If shared, claim idempotency keys there, and
+            share the frames of generations with other replicas.
+    """
+
+    def __init__(
+        self,
+        max_frames: int = 4096,
+        grace: float = 5.0,
+        retention=60.0,
+        state: Optional[StateBackend] = None,
+    ):
+        self.max_frames = max_frames
+        self.grace = grace
+        self.retention = retention
+        self.state = state
+        self._generations: Dict[str, Generation] = {}
+        self._by_key: Dict[str, Generation] = {}
+        # Background tasks that copy frames to, or check on readers in, the state
+        # backend. We hold on to them so they aren't garbage collected.
+        self._tasks: Set[asyncio.Task] = set()
+
+    @classmethod
+    def from_env(cls, state: Optional[StateBackend] = None) -> "GenerationRegistry":
+        return cls(
+            max_frames=int(os.environ.get("RESUME_BUFFER_FRAMES", 4096)),
+            grace=float(os.environ.get("RESUME_GRACE_SECONDS", 5)),
+            retention=float(os.environ.get("RESUME_RETENTION_SECONDS", 60)),
+            state=state,
+        )
+
+    def __len__(self):
+        return len(self._generations)
+
+    @property
+    def shared(self) -> bool:
+        """Whether generations are shared with other replicas."""
+        return self.state is not None and self.state.shared
+
+    def create(
+        self,
+        user_id: int,
+        conversation_id: int,
+        key: Optional[str] = None,
+        parent: int = 0,
+    ) -> Generation:
+        """
+        Register a new generation. The caller then starts its task.
+
+        Args:
+            user_id (int): The user who started the generation.
+            conversation_id (int): The conversation the response belongs to.
+            key (str, optional): The idempotency key of the request, see find().
+            parent (int): Number of messages in the conversation before the request.
+        """
+        self._expire()
+        generation = Generation(
+            uuid4().hex,
+            user_id,
+            conversation_id,
+            max_frames=self.max_frames,
+            key=key,
+            parent=parent,
+        )
+        self._generations[generation.id] = generation
+        if key is not None:
+            self._by_key[key] = generation
+        if self.shared:
+            self._start(self._share(generation))
+        return generation
+
+    def get(self, generation_id: str) -> Optional[Generation]:
+        self._expire()
+        return self._generations.get(generation_id)
+
+    async def get_shared(self, generation_id: str) -> Optional[SharedGeneration]:
+        """A generation of another replica, if it's in the shared state backend."""
+        if not self.shared:
+            return None
+        progress = await self.state.get(f"frames:{generation_id}")
+        if progress is None:
+            return None
+        progress = json.loads(progress)
+        return SharedGeneration(
+            generation_id,
+            progress["user_id"],
+            progress["next"],
+            max_frames=self.max_frames,
+            state=self.state,
+        )
+
+    def find(self, key: str) -> Optional[Generation]:
+        """
+        The latest generation started with an idempotency key, if it's still running,
+        or finished successfully within the retention period.
+        """
+        self._expire()
+        generation = self._by_key.get(key)
+        if generation is None or generation.abandoned or generation.error is not None:
+            return None
+        return generation
+
+    async def claim(self, generation: Generation) -> Optional[str]:
+        """
+        Claim a generation's idempotency key on all replicas.
+
+        Returns:
+            str: The ID of the generation that has claimed the key on another replica,
+                or None if the claim succeeded (or there's nothing to claim).
+        """
+        if generation.key is None or self.state is None or not self.state.shared:
+            return None
+        key = f"generation:{generation.key}"
+        if await self.state.add(key, generation.id, ttl=CLAIM_SECONDS):
+            return None
+        return await self.state.get(key) or ""
+
+    async def release(self, generation: Generation, keep: bool = False):
+        """
+        Release a finished generation's claim on its idempotency key.
+
+        Args:
+            keep (bool): Keep the claim for the retention period, for as long as
+                repeats can get this generation.
+        """
+        if generation.key is None or self.state is None or not self.state.shared:
+            return
+        key = f"generation:{generation.key}"
+        if keep:
+            await self.state.set(key, generation.id, ttl=self.retention)
+        elif await self.state.get(key) == generation.id:
+            await self.state.delete(key)
+
+    async def stream(
+        self, generation: Union[Generation, SharedGeneration], offset: int = 0
+    ) -> AsyncIterator[bytes]:
+        """
+        Read a generation on behalf of a client.
+
+        While at least one client is reading a generation, it keeps running. Once the
+        last one is gone, the generation is aborted after the grace period.
+        """
+        if isinstance(generation, SharedGeneration):
+            # Its own replica keeps track of readers, see SharedGeneration.read().
+            async for frame in generation.read(offset):
+                yield frame
+            return
+        generation.readers += 1
+        try:
+            async for frame in generation.read(offset):
+                yield frame
+        finally:
+            generation.readers -= 1
+            if generation.readers == 0 and not generation.done:
+                if self.grace <= 0:
+                    self._abandon(generation)
+                else:
+                    asyncio.get_running_loop().call_later(
+                        self.grace, self._abandon, generation
+                    )
+
+    def _abandon(self, generation: Generation, check_shared: bool = True):
+        if generation.readers or generation.done or generation.abandoned:
+            return
+        if check_shared and self.shared:
+            # A client may be reading it on another replica.
+            self._start(self._abandon_unless_read_elsewhere(generation))
+            return
+        generation.abandoned = True
+        if generation.task is not None:
+            generation.task.cancel()
+
+    async def _abandon_unless_read_elsewhere(self, generation: Generation):
+        try:
+            reading = await self.state.get(f"frames:{generation.id}:reading")
+        except Exception as e:
+            logger.warning(f"Could not check for readers elsewhere: {str(e)}")
+            reading = None
+        if reading is None:
+            self._abandon(generation, check_shared=False)
+        else:
+            # We check again once the grace period has passed.
+            asyncio.get_running_loop().call_later(
+                max(self.grace, SHARED_HEARTBEAT_SECONDS), self._abandon, generation
+            )
+
+    async def _share(self, generation: Generation):
+        # Copy a generation's frames to the state backend as it produces them.
+        key = f"frames:{generation.id}"
+        ttl = CLAIM_SECONDS + self.retention
+
+        async def progress(done: bool = False, error: Optional[str] = None):
+            data = {
+                "user_id": generation.user_id,
+                "next": offset,
+                "done": done,
+                "error": error,
+            }
+            # Like local ones, finished generations are kept for the retention period.
+            await self.state.set(
+                key, json.dumps(data), ttl=self.retention if done else ttl
+            )
+
+        offset = 0
+        try:
+            await progress()
+            try:
+                async for frame in generation.read():
+                    await self.state.set(f"{key}:{offset}", frame.decode(), ttl=ttl)
+                    if offset >= self.max_frames:
+                        await self.state.delete(f"{key}:{offset - self.max_frames}")
+                    offset += 1
+                    await progress()
+            except GenerationFailed as e:
+                await progress(done=True, error=str(e))
+            else:
+                await progress(done=True)
+        except Exception as e:
+            # E.g. we fell behind the ring buffer, or lost the state backend. Readers
+            # on other replicas then can't get the rest of the response.
+            logger.warning(f"Could not share generation {generation.id}: {str(e)}")
+
+    def _start(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _expire(self):
+        # We drop finished generations lazily, whenever the registry is used.
+        cutoff = time.monotonic() - self.retention
+        expired = [
+            generation.id
+            for generation in self._generations.values()
+            if generation.done and generation.finished_at < cutoff
+        ]
+        for generation_id in expired:
+            generation = self._generations.pop(generation_id)
+            if (
+                generation.key is not None
+                and self._by_key.get(generation.key) is generation
+            ):
+                del self._by_key[generation.key]
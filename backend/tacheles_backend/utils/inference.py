@@ -0,0 +1,422 @@
+import asyncio
+import bisect
+import hashlib
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from openai import APIStatusError, AsyncOpenAI
+
+from .logging import get_logger
+
+# Here we manage the connection(s) to the inference server(s).
+# A single vllm or sglang server only gets us so far, and at some point we'll want to
+# run several replicas of the same model. Both engines cache the KV values of prompts
+# they have recently seen, and re-use them when a new prompt starts with the same
+# prefix. In a chat application, every turn of a conversation starts with the entire
+# prior conversation, so this prefix caching saves a lot of work - but only if every
+# turn of a conversation is sent to the same replica.
+# We therefore route requests by consistent hashing on the conversation ID: Each
+# replica gets many points on a hash "ring", and a conversation goes to the first
+# replica at or after its own hash. Adding or removing a replica only moves the
+# conversations in that replica's slices of the ring, not all of them.
+# Replicas also fail, or get slow, and a single slow replica makes for a long wait
+# before the first token. So we can optionally hedge streaming requests: If a replica
+# hasn't sent the first token after INFERENCE_HEDGE_AFTER_MS milliseconds, or fails
+# outright, we send the same request to the next replica on the ring as well (up to
+# INFERENCE_MAX_ATTEMPTS replicas in total). Whichever replica sends a token first
+# wins, and we cancel the others. And each replica has a circuit breaker: After
+# INFERENCE_BREAKER_FAILURES failures in a row, we stop sending it requests for
+# INFERENCE_BREAKER_COOLDOWN seconds, and then try it again.
+
+logger = get_logger(__name__)
+
+
+def is_replica_error(e: BaseException) -> bool:
+    """
+    Whether an error is (likely) the replica's fault, rather than the request's.
+
+    Connection errors, timeouts and server errors count against the replica, and are
+    worth retrying elsewhere. Client errors (4xx, e.g. a prompt that is too long)
+    would fail on every replica.
+    """
+    if isinstance(e, APIStatusError):
+        return e.status_code >= 500 or e.status_code == 429
+    return isinstance(e, Exception)
+
+
+def _hash(key: str) -> int:
+    # Python's built-in hash() is randomized per process, which would send the same
+    # conversation to different replicas from different backend workers.
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class InferenceReplica:
+    """
+    A single inference server, together with the client we use to talk to it.
+
+    Args:
+        base_url (str, optional): The OpenAI-compatible API URL of the replica.
+            None means the official OpenAI API.
+        client (AsyncOpenAI, optional): The client to use. By default, one is
+            created for base_url.
+        max_inflight (int): The number of concurrent requests this replica should
+            handle before we prefer other replicas. 0 means unlimited.
+        failure_threshold (int): Number of failures in a row after which we stop
+            sending requests to this replica for a while. 0 disables this.
+        cooldown (float): Time in seconds before we try a failed replica again.
+    """
+
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        client: Optional[AsyncOpenAI] = None,
+        max_inflight: int = 0,
+        failure_threshold: int = 0,
+        cooldown: float = 30.0,
+    ):
+        self.base_url = base_url
+        self.client = client or AsyncOpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY", "123"),
+            base_url=base_url,
+        )
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.total_failures = 0
+        self.open_until = 0.0
+
+    @property
+    def name(self) -> str:
+        return self.base_url or "openai"
+
+    @property
+    def has_headroom(self) -> bool:
+        return self.max_inflight <= 0 or self.inflight < self.max_inflight
+
+    @property
+    def available(self) -> bool:
+        """False while the circuit breaker is open, i.e. the replica is skipped."""
+        return time.monotonic() >= self.open_until
+
+    def record_success(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self):
+        # Once the cooldown has passed, the next request is a trial: If it fails too,
+        # the breaker opens again right away.
+        self.failures += 1
+        self.total_failures += 1
+        if self.failure_threshold and self.failures >= self.failure_threshold:
+            self.open_until = time.monotonic() + self.cooldown
+
+    def __repr__(self):
+        return f"InferenceReplica({self.name}, inflight={self.inflight})"
+
+
+class InferenceStream:
+    """
+    A streaming response from a replica, of which we may have read ahead.
+
+    Iterate over it to get the chunks of the response, like the OpenAI client's
+    stream.
+    """
+
+    def __init__(self, replica: InferenceReplica, completion):
+        self.replica = replica
+        self.completion = completion
+        self._iterator = completion.__aiter__()
+        self._buffered: List = []
+        self._finished = False
+
+    async def read_first_token(self):
+        """Read ahead until the first chunk with content (or the end)."""
+        while True:
+            try:
+                chunk = await self._iterator.__anext__()
+            except StopAsyncIteration:
+                self._finished = True
+                return
+            self._buffered.append(chunk)
+            if chunk.choices and chunk.choices[0].delta.content:
+                return
+
+    async def __aiter__(self):
+        while self._buffered:
+            yield self._buffered.pop(0)
+        if not self._finished:
+            async for chunk in self._iterator:
+                yield chunk
+
+    async def close(self):
+        await self.completion.close()
+
+
+class InferencePool:
+    """
+    A pool of inference replicas with conversation-affinity routing.
+
+    Args:
+        replicas (List[InferenceReplica]): The initial replicas.
+        vnodes (int): Number of points each replica gets on the hash ring. More points
+            spread conversations more evenly across replicas.
+        hedge_after (float): Time in seconds to wait for the first token of a
+            streaming request before sending it to another replica as well. 0 means
+            we only try another replica if the first one fails.
+        max_attempts (int): Maximum number of replicas to try per streaming request.
+    """
+
+    def __init__(
+        self,
+        replicas: Optional[List[InferenceReplica]] = None,
+        vnodes: int = 100,
+        hedge_after: float = 0.0,
+        max_attempts: int = 1,
+    ):
+        self.vnodes = vnodes
+        self.hedge_after = hedge_after
+        self.max_attempts = max_attempts
+        self.hedged = 0
+        self.failovers = 0
+        # Cancelled attempts that are still closing their connection.
+        self._losers = set()
+        self.replicas: Dict[str, InferenceReplica] = {}
+        self._ring: List[int] = []
+        self._ring_owners: List[str] = []
+        for replica in replicas or []:
+            self.add_replica(replica)
+
+    @classmethod
+    def from_env(cls) -> "InferencePool":
+        """
+        Create a pool from the environment.
+
+        INFERENCE_API_URIS can hold a comma-separated list of replica URLs. If it is
+        not set, we fall back to the single INFERENCE_API_URI (or the OpenAI API).
+        INFERENCE_MAX_INFLIGHT optionally limits concurrent requests per replica.
+        INFERENCE_HEDGE_AFTER_MS and INFERENCE_MAX_ATTEMPTS configure hedging, and
+        INFERENCE_BREAKER_FAILURES and INFERENCE_BREAKER_COOLDOWN the circuit
+        breakers.
+        """
+        uris = os.environ.get("INFERENCE_API_URIS", "")
+        base_urls = [uri.strip() for uri in uris.split(",") if uri.strip()] or [
+            os.environ.get("INFERENCE_API_URI", None)
+        ]
+        max_inflight = int(os.environ.get("INFERENCE_MAX_INFLIGHT", 0))
+        failure_threshold = int(os.environ.get("INFERENCE_BREAKER_FAILURES", 0))
+        cooldown = float(os.environ.get("INFERENCE_BREAKER_COOLDOWN", 30))
+        return cls(
+            [
+                InferenceReplica(
+                    url,
+                    max_inflight=max_inflight,
+                    failure_threshold=failure_threshold,
+                    cooldown=cooldown,
+                )
+                for url in base_urls
+            ],
+            hedge_after=int(os.environ.get("INFERENCE_HEDGE_AFTER_MS", 0)) / 1000,
+            max_attempts=int(os.environ.get("INFERENCE_MAX_ATTEMPTS", 1)),
+        )
+
+    def add_replica(self, replica: InferenceReplica):
+        """Add a replica to the pool, taking over some slices of the hash ring."""
+        if replica.name in self.replicas:
+            raise ValueError(f"Replica {replica.name} is already in the pool")
+        self.replicas[replica.name] = replica
+        for i in range(self.vnodes):
+            point = _hash(f"{replica.name}#{i}")
+            index = bisect.bisect(self._ring, point)
+            self._ring.insert(index, point)
+            self._ring_owners.insert(index, replica.name)
+
+    def remove_replica(self, name: str) -> InferenceReplica:
+        """Remove a replica from the pool. Its conversations move to other replicas."""
+        replica = self.replicas.pop(name)
+        keep = [i for i, owner in enumerate(self._ring_owners) if owner != name]
+        self._ring = [self._ring[i] for i in keep]
+        self._ring_owners = [self._ring_owners[i] for i in keep]
+        return replica
+
+    def candidates(self, key) -> Iterator[InferenceReplica]:
+        """
+        Yield all replicas in order of preference for a given routing key.
+
+        The first replica is the one the key hashes to. The others follow in ring
+        order, so that the fallback for a given key is also stable.
+        """
+        if not self._ring:
+            return
+        start = bisect.bisect(self._ring, _hash(str(key)))
+        seen = set()
+        for i in range(len(self._ring)):
+            owner = self._ring_owners[(start + i) % len(self._ring)]
+            if owner not in seen:
+                seen.add(owner)
+                yield self.replicas[owner]
+                if len(seen) == len(self.replicas):
+                    return
+
+    def ranked(self, key) -> List[InferenceReplica]:
+        """
+        All replicas in the order we should try them for a routing key.
+
+        We prefer the replica the key hashes to, as it likely still has the
+        conversation's prefix cached. If it is overloaded, we fall back to the next
+        replica with headroom. If all replicas are overloaded, we stay with the
+        preferred one, and let the inference server queue the request. Replicas
+        whose circuit breaker is open come last, so we only try them if there is
+        nothing else.
+        """
+        candidates = list(self.candidates(key))
+        available = [replica for replica in candidates if replica.available]
+        return (
+            [replica for replica in available if replica.has_headroom]
+            + [replica for replica in available if not replica.has_headroom]
+            + [replica for replica in candidates if not replica.available]
+        )
+
+    def route(self, key) -> InferenceReplica:
+        """Pick the replica for a routing key (typically the conversation ID)."""
+        ranked = self.ranked(key)
+        if not ranked:
+            raise RuntimeError("No inference replicas configured")
+        return ranked[0]
+
+    @asynccontextmanager
+    async def acquire(self, key):
+        """Route a request, and count it as in flight on the replica until done."""
+        replica = self.route(key)
+        replica.inflight += 1
+        try:
+            yield replica
+        except Exception as e:
+            if is_replica_error(e):
+                replica.record_failure()
+            raise
+        else:
+            replica.record_success()
+        finally:
+            replica.inflight -= 1
+
+    @asynccontextmanager
+    async def stream(self, key, **request) -> AsyncIterator[InferenceStream]:
+        """
+        Send a streaming chat completion request, hedged across replicas.
+
+        Args:
+            key: The routing key, typically the conversation ID.
+            **request: Arguments for `client.chat.completions.create`.
+
+        Yields:
+            InferenceStream: The response of the replica that answered first.
+        """
+        candidates = self.ranked(key)[: max(1, self.max_attempts)]
+        if not candidates:
+            raise RuntimeError("No inference replicas configured")
+        attempts: Dict[asyncio.Task, InferenceReplica] = {}
+        tried = 0
+        error: Optional[BaseException] = None
+        winner: Optional[InferenceStream] = None
+
+        def attempt() -> bool:
+            nonlocal tried
+            if tried >= len(candidates):
+                return False
+            replica = candidates[tried]
+            tried += 1
+            replica.inflight += 1
+            attempts[asyncio.create_task(self._open(replica, request))] = replica
+            return True
+
+        attempt()
+        try:
+            while winner is None:
+                hedge = self.hedge_after > 0 and tried < len(candidates)
+                done, _ = await asyncio.wait(
+                    attempts,
+                    timeout=self.hedge_after if hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                # If no replica has sent a token in time, we ask another one too.
+                if not done:
+                    attempt()
+                    self.hedged += 1
+                    continue
+                for task in done:
+                    replica = attempts.pop(task)
+                    if task.exception() is None and winner is None:
+                        winner = task.result()
+                        continue
+                    replica.inflight -= 1
+                    if task.exception() is None:
+                        # Two replicas answered at the same time.
+                        await task.result().close()
+                        continue
+                    error = task.exception()
+                    logger.error(
+                        f"Error communicating with LLM backend {replica.name}: "
+                        f"{str(error)}"
+                    )
+                    if is_replica_error(error):
+                        replica.record_failure()
+                    elif winner is None:
+                        raise error
+                    # If a replica fails, we try the next one instead.
+                    if winner is None and attempt():
+                        self.failovers += 1
+                if winner is None and not attempts:
+                    raise error
+        finally:
+            # We cancel the requests to all other replicas, which closes their
+            # streams. We don't wait for that to finish.
+            for task, replica in attempts.items():
+                task.cancel()
+                replica.inflight -= 1
+                self._losers.add(task)
+                task.add_done_callback(self._forget_loser)
+
+        try:
+            yield winner
+        except Exception as e:
+            if is_replica_error(e):
+                winner.replica.record_failure()
+            raise
+        else:
+            winner.replica.record_success()
+        finally:
+            winner.replica.inflight -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hedged": self.hedged,
+            "failovers": self.failovers,
+            "breakers_open": sum(not r.available for r in self.replicas.values()),
+            "replica_failures": sum(r.total_failures for r in self.replicas.values()),
+        }
+
+    def _forget_loser(self, task: asyncio.Task):
+        self._losers.discard(task)
+        # Checking for the exception also keeps asyncio from warning about it.
+        if task.cancelled() or task.exception() is not None:
+            return
+        # The request was complete before we could cancel it, so we close it here.
+        closing = asyncio.ensure_future(task.result().close())
+        self._losers.add(closing)
+        closing.add_done_callback(self._losers.discard)
+
+    async def _open(self, replica: InferenceReplica, request: dict) -> InferenceStream:
+        completion = await replica.client.chat.completions.create(
+            stream=True, **request
+        )
+        stream = InferenceStream(replica, completion)
+        try:
+            await stream.read_first_token()
+        except BaseException:
+            await completion.close()
+            raise
+        return stream
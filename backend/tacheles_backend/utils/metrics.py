@@ -0,0 +1,268 @@
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+# Here we collect metrics about where the backend spends its time, and serve them in the
+# Prometheus text format on /api/metrics. You can point Prometheus (or anything that
+# understands its format) at that endpoint, and e.g. plot time to first token
+# percentiles over time.
+# We don't use the prometheus_client package here, as we only need a small part of it:
+# counters, histograms, and gauges read from the stats() of our other components.
+# Recording a value is a dictionary lookup, a binary search over the histogram buckets
+# and a few additions, so this is cheap enough to leave on in production.
+# Note that metrics are per backend worker. Prometheus adds up the workers' metrics if
+# you scrape each of them.
+
+# Default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# The ASGI scope of the request currently being handled, if any. We use this to find
+# out which endpoint a database query belongs to.
+current_scope: ContextVar[Optional[dict]] = ContextVar("current_scope", default=None)
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """
+    A value that only goes up, e.g. the number of requests.
+
+    Args:
+        name (str): The metric name.
+        documentation (str): A short description.
+        labelnames (Sequence[str]): Names of the labels, if any.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    The distribution of a value, e.g. request durations, in buckets.
+
+    Args:
+        name (str): The metric name.
+        documentation (str): A short description.
+        labelnames (Sequence[str]): Names of the labels, if any.
+        buckets (Sequence[float]): Upper bounds of the buckets, in ascending order.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Per label values: [count per bucket (not cumulative) + overflow, sum].
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self, *labels: str) -> int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                label_str = _labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{label_str} {cumulative}")
+            label_str = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """All metrics of this worker."""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._gauges: List[Tuple[str, Callable[[], Dict[str, float]]]] = []
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._add(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def gauges(self, prefix: str, stats: Callable[[], Dict[str, float]]):
+        """
+        Export the values returned by `stats()` as gauges, named `<prefix>_<key>`.
+
+        `stats` is called every time the metrics are rendered.
+        """
+        self._gauges.append((prefix, stats))
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for prefix, stats in self._gauges:
+            for key, value in stats().items():
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _add(self, metric):
+        # Metrics are created at import time, so re-importing a module (e.g. in
+        # tests) re-uses the existing metric rather than adding a second one.
+        return self._metrics.setdefault(metric.name, metric)
+
+
+metrics = MetricsRegistry()
+
+http_request_duration = metrics.histogram(
+    "tacheles_http_request_duration_seconds",
+    "Time to handle an HTTP request, until the end of the response body.",
+    ["endpoint", "method", "status"],
+)
+db_query_duration = metrics.histogram(
+    "tacheles_db_query_duration_seconds",
+    "Time to run a database query, by the endpoint that ran it.",
+    ["endpoint"],
+)
+
+
+def process_stats() -> Dict[str, float]:
+    """CPU time and memory use of this worker process."""
+    stats: Dict[str, float] = {"pid": os.getpid()}
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        stats["cpu_seconds"] = usage.ru_utime + usage.ru_stime
+        # ru_maxrss is the peak, in kilobytes on Linux.
+        stats["max_resident_memory_bytes"] = usage.ru_maxrss * 1024
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        stats["resident_memory_bytes"] = pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    return stats
+
+
+# We report each worker's resource use, so that load tests (see backend/benchmark) can
+# relate throughput to CPU and memory.
+metrics.gauges("tacheles_process", process_stats)
+
+
+def endpoint_label(scope: Optional[dict]) -> str:
+    """The route template (e.g. "/api/chat/{generation_id}") of a request."""
+    if scope is None:
+        return "background"
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that times every HTTP request, and makes the request's scope
+    available to the database instrumentation.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = current_scope.set(scope)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_request_duration.observe(
+                time.perf_counter() - start,
+                endpoint_label(scope),
+                scope["method"],
+                str(status),
+            )
+            current_scope.reset(token)
+
+
+def instrument_engine(engine):
+    """
+    Record the duration of every database query run through `engine`.
+
+    Args:
+        engine (AsyncEngine): The database engine.
+    """
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, params, context, many):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, params, context, many):
+        start = conn.info["query_start_time"].pop()
+        db_query_duration.observe(
+            time.perf_counter() - start, endpoint_label(current_scope.get())
+        )
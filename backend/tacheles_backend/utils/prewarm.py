@@ -0,0 +1,142 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Set
+
+from .logging import get_logger
+
+# Here we implement optional prewarming of the inference server's prefix cache.
+# vllm and sglang keep the KV values of recent prompts, and re-use them for a new
+# prompt that starts with the same prefix (see utils/inference.py). When a user reopens
+# an old conversation, though, the replica has long since evicted it, and the next chat
+# turn pays for a full prefill of the entire history.
+# But we get a hint before that happens: the frontend fetches the conversation's
+# messages when it's opened. With PREWARM set, we take that as our cue to send the
+# conversation history to the inference server in the background, asking for a
+# single token. This fills the prefix cache while the user is still typing, and the
+# actual chat turn then only needs to prefill the new message.
+# Prewarming costs GPU time, so we keep it in check: each conversation is prewarmed at
+# most once every PREWARM_INTERVAL_SECONDS, at most PREWARM_MAX_INFLIGHT prewarms run
+# at once, and at most PREWARM_RATE_PER_MINUTE start per minute. Anything beyond that
+# is simply skipped - prewarming is an optimization, never a requirement.
+
+logger = get_logger(__name__)
+
+
+class Prewarmer:
+    """
+    Runs rate-limited, deduplicated, fire-and-forget prewarm requests.
+
+    Args:
+        enabled (bool): Whether prewarming is on. If not, nothing is ever started.
+        interval (float): Minimum time in seconds between two prewarms of the same
+            conversation.
+        max_inflight (int): Maximum number of prewarms running at once.
+        rate (float): Maximum number of prewarms started per second, on average.
+            0 means no limit.
+        burst (float): Maximum number of prewarms started in a burst. Defaults to
+            max_inflight.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        interval: float = 300.0,
+        max_inflight: int = 4,
+        rate: float = 0.0,
+        burst: float = 0.0,
+    ):
+        self.enabled = enabled
+        self.interval = interval
+        self.max_inflight = max_inflight
+        self.rate = rate
+        self.burst = burst or max_inflight
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        # Conversation -> time of its last prewarm.
+        self._last: Dict[Hashable, float] = {}
+        # We keep references to running tasks, so they aren't garbage collected.
+        self._tasks: Set[asyncio.Task] = set()
+        self.started = 0
+        self.skipped = 0
+        self.failed = 0
+
+    @classmethod
+    def from_env(cls) -> "Prewarmer":
+        return cls(
+            enabled=os.environ.get("PREWARM", "").lower() in ("1", "true", "yes"),
+            interval=float(os.environ.get("PREWARM_INTERVAL_SECONDS", 300)),
+            max_inflight=int(os.environ.get("PREWARM_MAX_INFLIGHT", 4)),
+            rate=float(os.environ.get("PREWARM_RATE_PER_MINUTE", 60)) / 60,
+        )
+
+    @property
+    def inflight(self) -> int:
+        return len(self._tasks)
+
+    def schedule(self, key: Hashable, prewarm: Callable[[], Awaitable]) -> bool:
+        """
+        Start `prewarm()` in the background, unless this would exceed our limits.
+
+        Args:
+            key (Hashable): The conversation to prewarm, for deduplication.
+            prewarm (Callable[[], Awaitable]): The function that sends the prewarm
+                request.
+
+        Returns:
+            bool: Whether the prewarm was started.
+        """
+        if not self.enabled:
+            return False
+        now = time.monotonic()
+        last = self._last.get(key)
+        if (
+            (last is not None and now - last < self.interval)
+            or self.inflight >= self.max_inflight
+            or not self._take_token(now)
+        ):
+            self.skipped += 1
+            return False
+        self._last[key] = now
+        self._forget_old(now)
+        self.started += 1
+        task = asyncio.create_task(self._run(prewarm))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "inflight": self.inflight,
+            "started": self.started,
+            "skipped": self.skipped,
+            "failed": self.failed,
+        }
+
+    async def _run(self, prewarm: Callable[[], Awaitable]):
+        try:
+            await prewarm()
+        except Exception as e:
+            # Nobody is waiting for the result, so we just make a note.
+            self.failed += 1
+            logger.info(f"Prewarm failed: {str(e)}")
+
+    def _take_token(self, now: float) -> bool:
+        if self.rate <= 0:
+            return True
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._refilled_at) * self.rate
+        )
+        self._refilled_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _forget_old(self, now: float):
+        # We only need to remember conversations within the last interval. We clean
+        # up occasionally, so that this doesn't grow without bound.
+        if len(self._last) > 1000:
+            self._last = {
+                key: at for key, at in self._last.items() if now - at < self.interval
+            }
@@ -0,0 +1,311 @@
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+from uuid import uuid4
+
+from .metrics import endpoint_label
+
+# Here we implement an optional sampling profiler for production requests.
+# When a worker's CPU use spikes, metrics tell us which endpoint is slow, but not which
+# part of it. A profiler does, but a regular one (e.g. cProfile) hooks into every
+# function call, which slows everything down several times over. So instead, we
+# sample: A background thread looks at the stack of the event loop's thread every
+# PROFILE_INTERVAL_MS (default 10) milliseconds, and if a profiled request is running
+# at that moment, counts the stack for that request. This costs next to nothing for
+# requests that aren't profiled, and little for those that are. We profile a random
+# PROFILE_SAMPLE_RATE (default 0) fraction of requests, which admins can change at
+# runtime, and any request with an `X-Profile: 1` header and the ADMIN_TOKEN (see
+# api/routes.py).
+# All requests share the event loop's thread, so to know which request a sample
+# belongs to, we keep track of the asyncio tasks of each profiled request: the task
+# that handles it, and all tasks it starts, e.g. the task that streams a chat
+# response. Time spent in other threads (e.g. SQLite queries run by aiosqlite) isn't
+# sampled.
+# Each profile is a count of the stacks we saw, which we serve in the "folded" format
+# that flame graph tools read (one stack per line, outermost function first, separated
+# by semicolons, followed by the count), e.g. flamegraph.pl or speedscope.app. Memory is
+# bounded: We keep the last PROFILE_MAX_PROFILES profiles, each with at most
+# PROFILE_MAX_STACKS different stacks, and count any others as "[other]".
+# Note that profiles are per backend worker.
+
+# The profile of the request the current task belongs to, if it's being profiled.
+current_profile: ContextVar[Optional["Profile"]] = ContextVar(
+    "current_profile", default=None
+)
+
+# Stacks are cut off at this many frames, outermost first.
+MAX_DEPTH = 128
+
+# Stands in for the stacks of a profile beyond its limit.
+OTHER = "[other]"
+
+try:
+    from asyncio.events import Handle
+
+    # Frames outside of this one belong to the event loop, which is the same for
+    # every sample, so we leave them out.
+    LOOP_CODE = Handle._run.__code__
+except AttributeError:  # pragma: no cover
+    LOOP_CODE = None
+
+
+class Profile:
+    """
+    The stacks sampled during one request.
+
+    Args:
+        method (str): The request's HTTP method.
+        path (str): The request's path.
+        max_stacks (int): Maximum number of different stacks to keep.
+    """
+
+    def __init__(self, method: str, path: str, max_stacks: int = 2000):
+        self.id = uuid4().hex
+        self.method = method
+        self.path = path
+        self.endpoint = path
+        self.started = time.time()
+        self.duration: Optional[float] = None
+        self.samples = 0
+        self.max_stacks = max_stacks
+        self.stacks: Counter = Counter()
+        self.active = True
+
+    def add(self, stack: str):
+        self.samples += 1
+        if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+            stack = OTHER
+        self.stacks[stack] += 1
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "method": self.method,
+            "path": self.path,
+            "started": self.started,
+            "duration": self.duration,
+            "samples": self.samples,
+        }
+
+
+class Profiler:
+    """
+    Samples the event loop's stack during profiled requests.
+
+    Args:
+        sample_rate (float): Fraction of requests to profile.
+        interval (float): Time between samples, in seconds.
+        max_profiles (int): Number of finished profiles to keep.
+        max_stacks (int): Maximum number of different stacks per profile.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 0.0,
+        interval: float = 0.01,
+        max_profiles: int = 50,
+        max_stacks: int = 2000,
+    ):
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_profiles = max_profiles
+        self.max_stacks = max_stacks
+        # The sampling thread and the event loop share these, so they take the lock.
+        self._lock = threading.Lock()
+        self._tasks: Dict[asyncio.Task, Profile] = {}
+        self._active = 0
+        self._profiles: "OrderedDict[str, Profile]" = OrderedDict()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._names: Dict[object, str] = {}
+        # Longest first, so we strip as much as possible off each file name.
+        self._prefixes = sorted(
+            (os.path.join(path, "") for path in sys.path if path), key=len, reverse=True
+        )
+        # Statistics, see stats().
+        self.profiled = 0
+        self.samples = 0
+
+    @classmethod
+    def from_env(cls) -> "Profiler":
+        return cls(
+            sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", 0)),
+            interval=float(os.environ.get("PROFILE_INTERVAL_MS", 10)) / 1000,
+            max_profiles=int(os.environ.get("PROFILE_MAX_PROFILES", 50)),
+            max_stacks=int(os.environ.get("PROFILE_MAX_STACKS", 2000)),
+        )
+
+    def sampled(self) -> bool:
+        """Whether to profile a request, at random."""
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self, method: str, path: str) -> Profile:
+        """
+        Start profiling the current request. Tasks it starts from here on are
+        profiled with it.
+        """
+        self._attach(asyncio.get_running_loop())
+        profile = Profile(method, path, max_stacks=self.max_stacks)
+        current_profile.set(profile)
+        with self._lock:
+            self._tasks[asyncio.current_task()] = profile
+            self._active += 1
+            self._wake.set()
+        self.profiled += 1
+        return profile
+
+    def finish(self, profile: Profile, endpoint: Optional[str] = None):
+        """Stop profiling a request, and keep its profile."""
+        with self._lock:
+            profile.active = False
+            profile.duration = time.time() - profile.started
+            if endpoint is not None:
+                profile.endpoint = endpoint
+            for task in [t for t, p in self._tasks.items() if p is profile]:
+                del self._tasks[task]
+            self._active -= 1
+            self._profiles[profile.id] = profile
+            while len(self._profiles) > self.max_profiles:
+                self._profiles.popitem(last=False)
+
+    def profiles(self) -> List[Profile]:
+        """The finished profiles, oldest first."""
+        with self._lock:
+            return list(self._profiles.values())
+
+    def get(self, profile_id: str) -> Optional[Profile]:
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+    def folded(self, profiles: List[Profile]) -> str:
+        """Add up the stacks of profiles, in the folded format of flame graph tools."""
+        stacks: Counter = Counter()
+        with self._lock:
+            for profile in profiles:
+                stacks.update(profile.stacks)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "sample_rate": self.sample_rate,
+            "active": self._active,
+            "stored": len(self._profiles),
+            "profiled": self.profiled,
+            "samples": self.samples,
+        }
+
+    def _attach(self, loop: asyncio.AbstractEventLoop):
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        # We wrap the loop's task factory, so that we see every task a profiled
+        # request starts. The factory runs in the context of the code that starts the
+        # task, which tells us which request (if any) that is.
+        previous = loop.get_task_factory()
+
+        def task_factory(loop, coro, **kwargs):
+            if previous is not None:
+                task = previous(loop, coro, **kwargs)
+            else:
+                task = asyncio.Task(coro, loop=loop, **kwargs)
+            profile = current_profile.get()
+            if profile is not None and profile.active:
+                with self._lock:
+                    self._tasks[task] = profile
+                task.add_done_callback(self._forget)
+            return task
+
+        loop.set_task_factory(task_factory)
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="profiler", daemon=True
+            )
+            self._thread.start()
+
+    def _forget(self, task: asyncio.Task):
+        with self._lock:
+            self._tasks.pop(task, None)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    # Nothing to profile, so we sleep until the next profile starts.
+                    self._wake.clear()
+                    continue
+                task = asyncio.current_task(self._loop)
+                profile = self._tasks.get(task) if task is not None else None
+                if profile is None or not profile.active:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    profile.add(self._fold(frame))
+                    self.samples += 1
+
+    def _fold(self, frame) -> str:
+        codes = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        codes.reverse()
+        if LOOP_CODE in codes:
+            start = codes.index(LOOP_CODE) + 1
+            codes = codes[start:]
+        return ";".join(self._name(code) for code in codes[:MAX_DEPTH])
+
+    def _name(self, code) -> str:
+        name = self._names.get(code)
+        if name is None:
+            filename = code.co_filename
+            for prefix in self._prefixes:
+                if filename.startswith(prefix):
+                    filename = filename.removeprefix(prefix)
+                    break
+            name = f"{code.co_qualname} ({filename}:{code.co_firstlineno})"
+            name = name.replace(";", ":")
+            self._names[code] = name
+        return name
+
+
+class ProfilerMiddleware:
+    """
+    ASGI middleware that profiles a sample of HTTP requests.
+
+    Args:
+        profiler (Profiler): The profiler.
+        authorize (Callable[[str], bool]): Whether an Authorization header may
+            ask for a request to be profiled, with an `X-Profile: 1` header.
+    """
+
+    def __init__(self, app, profiler: Profiler, authorize: Callable[[str], bool]):
+        self.app = app
+        self.profiler = profiler
+        self.authorize = authorize
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.wanted(scope):
+            await self.app(scope, receive, send)
+            return
+        profile = self.profiler.start(scope["method"], scope["path"])
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profiler.finish(profile, endpoint_label(scope))
+
+    def wanted(self, scope) -> bool:
+        headers = dict(scope["headers"])
+        if headers.get(b"x-profile") == b"1":
+            return self.authorize(headers.get(b"authorization", b"").decode())
+        return self.profiler.sampled()
@@ -0,0 +1,279 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from .state import StateBackend
+
+# Here we implement an optional cache of complete LLM responses.
+# Often, many users send exactly the same first message, e.g. when the frontend offers
+# a few canned starter questions, or in demos. Each of these costs a full generation
+# on the inference server, even though the prompt (our fixed system prompt plus that
+# first message) is identical. With RESPONSE_CACHE set, we store the response to each
+# prompt, keyed by a hash of the model, the full list of messages, and the sampling
+# parameters. When the same prompt comes in again, we replay the stored response
+# instead, streamed in the usual way at RESPONSE_CACHE_REPLAY_TOKENS_PER_SECOND, and
+# save it to the conversation like any other response.
+# By default, we only cache prompts of up to RESPONSE_CACHE_MAX_MESSAGES messages
+# (i.e., first turns), as later turns are almost never exact repeats. Note that with
+# the cache on, identical prompts always get identical responses, even if you sample
+# with a temperature above 0.
+# Responses can be kept in memory ("memory"), which is per worker, or in a SQLite file
+# ("sqlite:/path/to/file.db"), which all workers on one machine can share. Either way,
+# entries expire after RESPONSE_CACHE_TTL seconds, and the least recently used entries
+# are evicted once the cache grows beyond RESPONSE_CACHE_BYTES. Or they can be kept in
+# the state backend ("shared", see utils/state.py), which all replicas share. Entries
+# then also expire after RESPONSE_CACHE_TTL seconds, but the total size is up to the
+# state backend, e.g. Redis' maxmemory setting.
+
+
+def cache_key(model: str, messages: List[Dict[str, str]], **params) -> str:
+    """
+    The cache key for a request to the inference server.
+
+    Args:
+        model (str): The model name.
+        messages (List[Dict[str, str]]): All messages sent, including the system prompt.
+        **params: Sampling parameters, e.g. max_tokens or temperature.
+
+    Returns:
+        str: A hex digest identifying the request.
+    """
+    request = {"model": model, "messages": messages, "params": params}
+    encoded = json.dumps(request, sort_keys=True, ensure_ascii=False).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class ResponseCache:
+    """
+    Base class for response caches. This one never caches anything.
+
+    Args:
+        max_bytes (int): Maximum total size of cached responses.
+        ttl (float): Time in seconds after which entries expire.
+        max_messages (int): Only cache requests with at most this many messages.
+        replay_rate (float): Tokens per second when replaying a cached response.
+            0 sends the entire response at once.
+    """
+
+    enabled = False
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 2**20,
+        ttl: float = 3600.0,
+        max_messages: int = 2,
+        replay_rate: float = 100.0,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.replay_rate = replay_rate
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls, state: Optional[StateBackend] = None) -> "ResponseCache":
+        kind = os.environ.get("RESPONSE_CACHE", "")
+        kwargs = dict(
+            max_bytes=int(os.environ.get("RESPONSE_CACHE_BYTES", 64 * 2**20)),
+            ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 3600)),
+            max_messages=int(os.environ.get("RESPONSE_CACHE_MAX_MESSAGES", 2)),
+            replay_rate=float(
+                os.environ.get("RESPONSE_CACHE_REPLAY_TOKENS_PER_SECOND", 100)
+            ),
+        )
+        if kind == "memory":
+            return MemoryResponseCache(**kwargs)
+        if kind.startswith("sqlite:"):
+            return SQLiteResponseCache(kind.split(":", 1)[1], **kwargs)
+        if kind == "shared" and state is not None:
+            return SharedResponseCache(state, **kwargs)
+        if kind:
+            raise ValueError(f"Unknown RESPONSE_CACHE: {kind}")
+        return cls(**kwargs)
+
+    def key(
+        self, model: str, messages: List[Dict[str, str]], **params
+    ) -> Optional[str]:
+        """The cache key for a request, or None if we don't cache this request."""
+        if not self.enabled or len(messages) > self.max_messages:
+            return None
+        return cache_key(model, messages, **params)
+
+    async def get(self, key: str) -> Optional[str]:
+        """Look up a response. Returns None if it isn't cached (or has expired)."""
+        response = await self._get(key)
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    async def put(self, key: str, response: str):
+        """Store a complete response."""
+        if len(response.encode()) <= self.max_bytes:
+            await self._put(key, response)
+
+    async def replay(self, response: str) -> AsyncIterator[str]:
+        """Stream a cached response in pieces, as if it was being generated."""
+        if self.replay_rate <= 0:
+            yield response
+            return
+        # We split the response at word boundaries, which is close enough to tokens.
+        start = time.monotonic()
+        for i, token in enumerate(re.findall(r"\s*\S+|\s+$", response)):
+            delay = start + i / self.replay_rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield token
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    async def _get(self, key: str) -> Optional[str]:
+        return None
+
+    async def _put(self, key: str, response: str):
+        pass
+
+
+class MemoryResponseCache(ResponseCache):
+    """A response cache in the memory of this worker."""
+
+    enabled = True
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.size = 0
+        # Key -> (time stored, response), least recently used first.
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    async def _get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic() - self.ttl:
+            self._discard(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    async def _put(self, key: str, response: str):
+        self._discard(key)
+        self._entries[key] = (time.monotonic(), response)
+        self.size += len(response.encode())
+        while self.size > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1].encode())
+
+
+class SQLiteResponseCache(ResponseCache):
+    """
+    A response cache in a SQLite file, which can be shared between workers.
+
+    Args:
+        path (str): Path to the SQLite file. It is created if it doesn't exist.
+    """
+
+    enabled = True
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        # SQLite calls block, so we run them in a thread, one at a time.
+        self._lock = threading.Lock()
+        # We only connect on first use. SQLite connections must not be shared
+        # between processes, and the backend may be imported before it forks into
+        # several workers.
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            with connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS response_cache ("
+                    "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                    "size INTEGER NOT NULL, created REAL NOT NULL, used REAL NOT NULL)"
+                )
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS ix_response_cache_used "
+                    "ON response_cache (used)"
+                )
+            self._connection = connection
+        return self._connection
+
+    async def _get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get_sync, key)
+
+    async def _put(self, key: str, response: str):
+        await asyncio.to_thread(self._put_sync, key, response)
+
+    def _get_sync(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self._connect():
+            row = self._connection.execute(
+                "SELECT response FROM response_cache WHERE key = ? AND created >= ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is not None:
+                self._connection.execute(
+                    "UPDATE response_cache SET used = ? WHERE key = ?", (now, key)
+                )
+        return row[0] if row else None
+
+    def _put_sync(self, key: str, response: str):
+        now = time.time()
+        with self._lock, self._connect():
+            self._connection.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode()), now, now),
+            )
+            # We evict expired entries, and then the least recently used ones until
+            # we're within budget.
+            self._connection.execute(
+                "DELETE FROM response_cache WHERE created < ?", (now - self.ttl,)
+            )
+            (size,) = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM response_cache"
+            ).fetchone()
+            if size > self.max_bytes:
+                self._connection.execute(
+                    "DELETE FROM response_cache WHERE key IN ("
+                    "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY used DESC) "
+                    "AS total FROM response_cache) WHERE total > ?)",
+                    (self.max_bytes,),
+                )
+
+
+class SharedResponseCache(ResponseCache):
+    """
+    A response cache in the state backend, which all replicas can share.
+
+    Args:
+        state (StateBackend): The state backend.
+    """
+
+    enabled = True
+
+    def __init__(self, state: StateBackend, **kwargs):
+        super().__init__(**kwargs)
+        self.state = state
+
+    async def _get(self, key: str) -> Optional[str]:
+        return await self.state.get(f"response:{key}")
+
+    async def _put(self, key: str, response: str):
+        await self.state.set(f"response:{key}", response, ttl=self.ttl)
@@ -0,0 +1,259 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+from .state import StateBackend
+
+# Here we decide when a chat request may go to the inference server.
+# Without any limit, every request is forwarded right away. During a traffic spike,
+# the inference server's own queue then grows without bound, and every user's time to
+# first token gets worse together. Instead, we can cap the number of responses being
+# generated at once (SCHEDULER_MAX_CONCURRENT). Requests beyond that wait in a queue
+# in the backend. The queue is bounded (SCHEDULER_MAX_QUEUE), and when it's full, we
+# turn new requests away right away with a 503 and a Retry-After header, rather than
+# letting them wait for minutes.
+# Waiting requests are admitted round-robin by user, so a single user sending many
+# requests at once can't push everyone else to the back of the queue. On top of that,
+# each user can be rate limited with a token bucket (USER_RATE_PER_MINUTE requests per
+# minute, with bursts of up to USER_RATE_BURST). Requests over the limit get a 429.
+# Note that the concurrency limit and queue are per backend worker. So are the rate
+# limits, unless the workers share a state backend (see utils/state.py). Then we count
+# each user's requests there, in fixed windows of USER_RATE_BURST requests, which
+# allows the same average rate, if slightly bigger bursts at the edge of a window.
+
+
+class SchedulerRejected(Exception):
+    """
+    Raised when a request is not admitted.
+
+    Attributes:
+        status_code (int): 429 if the user is over their rate limit, 503 if the
+            backend is overloaded.
+        retry_after (int): Suggested number of seconds to wait before retrying.
+    """
+
+    def __init__(self, status_code: int, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class Scheduler:
+    """
+    Admission control for requests to the inference server.
+
+    Args:
+        max_concurrent (int): Maximum number of requests admitted at once. 0 means
+            no limit, i.e. requests are never queued.
+        max_queue (int): Maximum number of requests waiting for admission.
+        queue_timeout (float): Maximum time in seconds a request waits in the queue.
+        rate (float): Requests per second per user. 0 disables rate limiting.
+        burst (float): Maximum burst size per user, i.e. the token bucket size.
+        state (StateBackend, optional): If shared, count requests for the rate limits
+            there, across all replicas.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 0,
+        max_queue: int = 100,
+        queue_timeout: float = 30.0,
+        rate: float = 0.0,
+        burst: float = 0.0,
+        state: Optional[StateBackend] = None,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.state = state
+        self.active = 0
+        # Waiting requests, one queue per user. We admit from the user at the front,
+        # and then move them to the back, which gives us round-robin fairness.
+        self._waiting: "OrderedDict[int, Deque[asyncio.Future]]" = OrderedDict()
+        self._queued = 0
+        # Token buckets: user ID -> (tokens, time of last update).
+        self._buckets: Dict[int, Tuple[float, float]] = {}
+        # Average time a request holds its slot, to estimate Retry-After.
+        self._service_time = 1.0
+        # Statistics, see stats().
+        self.max_queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.rate_limited = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @classmethod
+    def from_env(cls, state: Optional[StateBackend] = None) -> "Scheduler":
+        rate = float(os.environ.get("USER_RATE_PER_MINUTE", 0)) / 60
+        return cls(
+            max_concurrent=int(os.environ.get("SCHEDULER_MAX_CONCURRENT", 0)),
+            max_queue=int(os.environ.get("SCHEDULER_MAX_QUEUE", 100)),
+            queue_timeout=float(os.environ.get("SCHEDULER_QUEUE_TIMEOUT", 30)),
+            rate=rate,
+            burst=float(os.environ.get("USER_RATE_BURST", rate * 60)),
+            state=state,
+        )
+
+    @property
+    def queued(self) -> int:
+        """Number of requests waiting for admission."""
+        return self._queued
+
+    async def admit(self, user_id: int) -> float:
+        """
+        Wait until a request may go to the inference server.
+
+        Every successful call must be matched by a call to release() once the
+        response is complete.
+
+        Args:
+            user_id (int): The user making the request.
+
+        Returns:
+            float: The time the request was admitted, to pass on to release().
+
+        Raises:
+            SchedulerRejected: If the user is over their rate limit, the queue is
+                full, or the request waited too long.
+        """
+        if self.state is not None and self.state.shared:
+            await self._take_shared_token(user_id)
+        else:
+            self._take_token(user_id)
+        if self.max_concurrent <= 0 or (
+            self.active < self.max_concurrent and not self._queued
+        ):
+            return self._start(0.0)
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerRejected(
+                503, "Server is busy, please try again.", self._estimated_wait()
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append(future)
+        self._queued += 1
+        self.max_queued = max(self.max_queued, self._queued)
+        queued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # We were handed a slot just as we gave up, so we pass it on.
+                self._free_slot()
+            else:
+                future.cancel()
+                self._remove(user_id, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+                raise SchedulerRejected(
+                    503, "Server is busy, please try again.", self._estimated_wait()
+                )
+            raise
+        # release() has already counted our slot as active.
+        self.active -= 1
+        return self._start(time.monotonic() - queued_at)
+
+    def release(self, admitted_at: float):
+        """
+        Free the slot of a request admitted at `admitted_at`, and admit the next one.
+        """
+        elapsed = time.monotonic() - admitted_at
+        self._service_time = 0.9 * self._service_time + 0.1 * elapsed
+        self._free_slot()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "active": self.active,
+            "queue_depth": self._queued,
+            "max_queue_depth": self.max_queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "rate_limited": self.rate_limited,
+            "queue_timeouts": self.timeouts,
+            "wait_seconds_total": self.wait_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+    def _free_slot(self):
+        self.active -= 1
+        while self._waiting and self.active < max(self.max_concurrent, 1):
+            user_id, futures = next(iter(self._waiting.items()))
+            future = futures.popleft()
+            if futures:
+                self._waiting.move_to_end(user_id)
+            else:
+                del self._waiting[user_id]
+            self._queued -= 1
+            if not future.done():
+                # We hand the slot straight over to the waiting request, and count it
+                # as active right away, so no new request can take it in between.
+                self.active += 1
+                future.set_result(None)
+                break
+
+    def _start(self, waited: float) -> float:
+        self.active += 1
+        self.admitted += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return time.monotonic()
+
+    def _remove(self, user_id: int, future: asyncio.Future):
+        futures = self._waiting.get(user_id)
+        if futures is not None and future in futures:
+            futures.remove(future)
+            self._queued -= 1
+            if not futures:
+                del self._waiting[user_id]
+
+    def _estimated_wait(self) -> float:
+        # Everyone ahead in the queue needs a slot first, and slots free up at a rate
+        # of max_concurrent per average service time.
+        return self._queued * self._service_time / max(self.max_concurrent, 1)
+
+    def _take_token(self, user_id: int):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        tokens, last = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            self.rate_limited += 1
+            raise SchedulerRejected(
+                429, "Too many requests, please slow down.", (1 - tokens) / self.rate
+            )
+        self._buckets[user_id] = (tokens - 1, now)
+        if len(self._buckets) > 10000:
+            # Users whose bucket has refilled completely don't need an entry.
+            full = now - (self.burst / self.rate)
+            self._buckets = {
+                user: bucket
+                for user, bucket in self._buckets.items()
+                if bucket[1] > full
+            }
+
+    async def _take_shared_token(self, user_id: int):
+        if self.rate <= 0:
+            return
+        # Each window allows `burst` requests, which at `rate` takes this long. We use
+        # wall-clock time, as all replicas need to agree on the windows.
+        window = self.burst / self.rate
+        now = time.time()
+        count = await self.state.incr(
+            f"rate:{user_id}:{int(now // window)}", ttl=window
+        )
+        if count > self.burst:
+            self.rate_limited += 1
+            raise SchedulerRejected(
+                429, "Too many requests, please slow down.", window - now % window
+            )
@@ -0,0 +1,299 @@
+import asyncio
+import json
+import os
+import secrets
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from .logging import get_logger
+
+# Here we implement a small store for state that all backend replicas share.
+# Each backend worker keeps some state in its own memory: the history cache, the rate
+# limits, the responses being generated, and so on. With several workers or replicas,
+# each of them only sees its own. Some of this state is worth sharing, and the SQL
+# database is the wrong place for it: It's on the hot path of every chat request, and
+# it's small, short-lived data that needs to expire on its own. So we use a key-value
+# store with expiry and publish/subscribe messaging, set by STATE_BACKEND:
+# - By default ("memory"), the state is kept in this worker's memory, so nothing is
+#   shared, and everything works as with a single worker.
+# - With a Redis URL (e.g. "redis://redis:6379/0", which needs the `redis` package), all
+#   replicas share one Redis server.
+# The rest of the backend only uses the methods of StateBackend, so it works the same
+# either way. For now, we share:
+# - The session secret, if SESSION_SECRET_KEY isn't set (see tacheles_backend.py): the
+#   first replica makes up a random key, and all others use the same one.
+# - Invalidations of the history cache (see utils/cache.py): when a conversation
+#   changes on one replica, all others drop it from their caches.
+# - Per-user rate limits (see utils/scheduler.py).
+# - Cached responses, with RESPONSE_CACHE=shared (see utils/response_cache.py).
+# - Idempotency keys of chat requests (see utils/generations.py), so a repeat of a
+#   request that reaches another replica doesn't start a second generation.
+# - The frames of responses being generated (see utils/generations.py), so a client
+#   can resume a response on any replica.
+# In tests, several MemoryStateBackends can share one MemoryStore, which then behaves
+# like a shared server, and each backend like a different replica.
+
+logger = get_logger(__name__)
+
+
+class MemoryStore:
+    """The data of MemoryStateBackends, which several of them can share."""
+
+    def __init__(self):
+        # Key -> (value, expiry time or None).
+        self.values: Dict[str, Tuple[str, Optional[float]]] = {}
+        # Channel -> the backends subscribed to it.
+        self.subscribers: Dict[str, List["MemoryStateBackend"]] = defaultdict(list)
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.values.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self.values[key]
+            return None
+        return entry[0]
+
+
+class StateBackend:
+    """
+    Base class for state backends: a key-value store with expiry, and messages to
+    other replicas.
+
+    Values are strings, and `ttl` is always in seconds. Messages are delivered to
+    the other replicas subscribed to a channel, but not to the one that sent them.
+    Delivery is best-effort: A replica that isn't connected at the time misses them.
+    """
+
+    # Whether the state is shared with other replicas.
+    shared = False
+
+    def __init__(self):
+        # Identifies this replica in messages, so it can skip its own.
+        self.replica = uuid4().hex
+        self._callbacks: Dict[str, List[Callable[[str], None]]] = defaultdict(list)
+        # Statistics, see stats().
+        self.published = 0
+        self.received = 0
+
+    @classmethod
+    def from_env(cls) -> "StateBackend":
+        kind = os.environ.get("STATE_BACKEND", "memory")
+        if kind == "memory":
+            return MemoryStateBackend()
+        if kind.startswith(("redis://", "rediss://", "unix://")):
+            return RedisStateBackend(kind)
+        raise ValueError(f"Unknown STATE_BACKEND: {kind}")
+
+    async def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    async def add(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        """Set a key only if it isn't set yet. Returns whether it was set."""
+        raise NotImplementedError
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """
+        Add to a counter, and return its new value. A new counter starts at 0, and
+        expires after `ttl`.
+        """
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    def publish(self, channel: str, message: str):
+        """Send a message to the other replicas. This doesn't wait for delivery."""
+        raise NotImplementedError
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]):
+        """Call `callback(message)` for every message from other replicas."""
+        self._callbacks[channel].append(callback)
+
+    async def shared_secret(self, key: str) -> str:
+        """A random secret that's the same for all replicas."""
+        await self.add(key, secrets.token_hex(32))
+        return await self.get(key)
+
+    async def start(self):
+        """Start receiving messages."""
+
+    async def stop(self):
+        """Stop receiving messages, and close connections."""
+
+    def stats(self) -> Dict[str, int]:
+        return {"published": self.published, "received": self.received}
+
+    def _deliver(self, channel: str, message: str):
+        self.received += 1
+        for callback in self._callbacks.get(channel, []):
+            callback(message)
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    A state backend in memory.
+
+    Args:
+        store (MemoryStore, optional): The store to use. By default, each backend has
+            its own, so nothing is shared.
+    """
+
+    def __init__(self, store: Optional[MemoryStore] = None):
+        super().__init__()
+        self.shared = store is not None
+        self.store = store or MemoryStore()
+
+    async def get(self, key: str) -> Optional[str]:
+        return self.store.get(key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        expires = None if ttl is None else time.monotonic() + ttl
+        self.store.values[key] = (value, expires)
+
+    async def add(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        if self.store.get(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        value = self.store.get(key)
+        if value is None:
+            await self.set(key, str(amount), ttl)
+            return amount
+        value = str(int(value) + amount)
+        self.store.values[key] = (value, self.store.values[key][1])
+        return int(value)
+
+    async def delete(self, key: str):
+        self.store.values.pop(key, None)
+
+    def publish(self, channel: str, message: str):
+        self.published += 1
+        for backend in self.store.subscribers.get(channel, []):
+            if backend is not self:
+                backend._deliver(channel, message)
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]):
+        super().subscribe(channel, callback)
+        if self not in self.store.subscribers[channel]:
+            self.store.subscribers[channel].append(self)
+
+
+class RedisStateBackend(StateBackend):
+    """
+    A state backend on a Redis server, shared by all replicas that use it.
+
+    Args:
+        url (str): The Redis URL, e.g. "redis://localhost:6379/0".
+        prefix (str): Prefix for all keys and channels, so several deployments can
+            share a server.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "tacheles:"):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        # We only connect on first use, as the backend may be imported before it
+        # forks into several workers, and connections can't be shared between
+        # processes.
+        self._client = None
+        self._listener: Optional[asyncio.Task] = None
+        self._pubsub = None
+        # Messages being sent. We hold on to them so they aren't garbage collected
+        # before they're done.
+        self._sending: Set[asyncio.Task] = set()
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis.asyncio
+
+            self._client = redis.asyncio.from_url(self.url, decode_responses=True)
+        return self._client
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        await self.client.set(self.prefix + key, value, px=_milliseconds(ttl))
+
+    async def add(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        return bool(
+            await self.client.set(
+                self.prefix + key, value, px=_milliseconds(ttl), nx=True
+            )
+        )
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        value = await self.client.incrby(self.prefix + key, amount)
+        # Only the request that created the counter sets its expiry, so the counter
+        # expires `ttl` after it was created, not after it was last changed.
+        if value == amount and ttl is not None:
+            await self.client.pexpire(self.prefix + key, _milliseconds(ttl))
+        return value
+
+    async def delete(self, key: str):
+        await self.client.delete(self.prefix + key)
+
+    def publish(self, channel: str, message: str):
+        self.published += 1
+        data = json.dumps([self.replica, message])
+        task = asyncio.get_running_loop().create_task(
+            self.client.publish(self.prefix + channel, data)
+        )
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]):
+        super().subscribe(channel, callback)
+        if self._pubsub is not None:
+            asyncio.get_running_loop().create_task(
+                self._pubsub.subscribe(self.prefix + channel)
+            )
+
+    async def start(self):
+        if self._listener is not None or not self._callbacks:
+            return
+        self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(*(self.prefix + c for c in self._callbacks))
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _listen(self):
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    replica, data = json.loads(message["data"])
+                    if replica != self.replica:
+                        channel = message["channel"].removeprefix(self.prefix)
+                        self._deliver(channel, data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # We lost the connection. The client reconnects, and resubscribes, on
+                # the next read. Messages sent meanwhile are lost.
+                logger.warning(f"Lost connection to the state backend: {str(e)}")
+                await asyncio.sleep(1)
+
+
+def _milliseconds(ttl: Optional[float]) -> Optional[int]:
+    return None if ttl is None else max(1, int(ttl * 1000))
@@ -0,0 +1,291 @@
+import argparse
+import gzip
+import hashlib
+import os
+import re
+import stat
+from collections import OrderedDict
+from mimetypes import guess_type
+from typing import Dict, List, Optional, Tuple
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Scope
+
+from .logging import get_logger
+
+# Here we implement serving the compiled frontend (see HOST_FRONTEND_PATH), as a
+# drop-in replacement for FastAPI's StaticFiles that's better suited for production:
+# - The frontend's JS and CSS bundles compress to a fraction of their size, but
+#   compressing them on every request would cost far more CPU time than serving them.
+#   So we compress every file once, ahead of time, with gzip and (if the `brotli`
+#   package is installed) brotli, and store the results next to the originals, as
+#   `main.js.gz` and `main.js.br`. We then serve the smallest version the browser
+#   accepts, according to its Accept-Encoding header. You can precompress at build
+#   time with `python -m tacheles_backend.utils.static <directory>` (the Dockerfile
+#   does this), or let the backend do it on startup (STATIC_PRECOMPRESS, on by
+#   default), which skips files that are already precompressed.
+# - Every file gets a strong ETag, from a hash of its content, so browsers can check
+#   whether their copy is still current without downloading the file again. The
+#   build puts a hash of its content into the name of every JS and CSS bundle (e.g.
+#   `main.1a2b3c4d.js`), so such a file can never change. Browsers may cache those
+#   forever (`Cache-Control: immutable`), and don't even need to ask. Everything
+#   else, e.g. `index.html`, needs to be revalidated every time.
+# - Small files (up to STATIC_CACHE_MAX_FILE_BYTES, 64 KiB by default) are kept in
+#   memory. Larger ones are sent by the ASGI server straight from the file, which
+#   servers that support the "pathsend" extension do with zero-copy sendfile().
+
+logger = get_logger(__name__)
+
+# Only these files are worth compressing. Images and fonts are compressed already.
+COMPRESSIBLE = {
+    ".css",
+    ".html",
+    ".ico",
+    ".js",
+    ".json",
+    ".map",
+    ".mjs",
+    ".svg",
+    ".txt",
+    ".wasm",
+    ".webmanifest",
+    ".xml",
+}
+
+# Content encodings, and the extensions of their precompressed files, from best to
+# worst compression.
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+# The names of build files with a content hash, e.g. `main.1a2b3c4d.js` or
+# `453.1a2b3c4d.chunk.js`.
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.")
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+def compress(data: bytes, encoding: str) -> Optional[bytes]:
+    """Compress data with a content encoding, or None if it's not available."""
+    if encoding == "gzip":
+        # We don't record a modification time, so the output is always the same.
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli.compress(data, quality=11)
+
+
+def precompress_directory(directory: str, min_bytes: int = 256) -> int:
+    """
+    Write compressed versions of all compressible files in a directory.
+
+    Files whose compressed versions are at least as new as the file are skipped.
+
+    Args:
+        directory (str): The directory, e.g. the frontend build.
+        min_bytes (int): Don't compress files smaller than this.
+
+    Returns:
+        int: The number of compressed files written.
+    """
+    written = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.splitext(name)[1] not in COMPRESSIBLE:
+                continue
+            source = os.stat(path)
+            if source.st_size < min_bytes:
+                continue
+            data = None
+            for encoding, extension in ENCODINGS:
+                target = path + extension
+                if (
+                    os.path.exists(target)
+                    and os.stat(target).st_mtime >= source.st_mtime
+                ):
+                    continue
+                if data is None:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                compressed = compress(data, encoding)
+                # Some files don't get any smaller, and then we serve the original.
+                if compressed is None or len(compressed) >= len(data):
+                    continue
+                # We write to a temporary file first, so that a worker serving files
+                # meanwhile never sees a partially written one.
+                temporary = f"{target}.{os.getpid()}.tmp"
+                with open(temporary, "wb") as f:
+                    f.write(compressed)
+                os.replace(temporary, target)
+                written += 1
+    return written
+
+
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    """The content encodings an Accept-Encoding header allows."""
+    accepted = []
+    for part in accept_encoding.split(","):
+        name, _, parameters = part.strip().partition(";")
+        quality = parameters.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.append(name.strip().lower())
+    return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles that serves precompressed files, with strong ETags, long-lived cache
+    headers for hashed files, and an in-memory cache for small files.
+
+    Args:
+        precompress (bool): Whether to precompress the directory on startup.
+        cache_max_file_bytes (int): Keep files up to this size in memory.
+        cache_max_bytes (int): Maximum total size of the files kept in memory.
+        All other arguments are passed on to StaticFiles.
+    """
+
+    def __init__(
+        self,
+        *args,
+        precompress: bool = False,
+        cache_max_file_bytes: int = 64 * 2**10,
+        cache_max_bytes: int = 16 * 2**20,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.cache_max_file_bytes = cache_max_file_bytes
+        self.cache_max_bytes = cache_max_bytes
+        # (path, modification time, size) -> ETag, or file content. We compute each
+        # file's ETag (and read small files) only once, when it's first requested.
+        self._etags: Dict[Tuple[str, int, int], str] = {}
+        self._cache: "OrderedDict[Tuple[str, int, int], bytes]" = OrderedDict()
+        self._cache_bytes = 0
+        if precompress and self.directory is not None:
+            try:
+                written = precompress_directory(str(self.directory))
+                logger.info(f"Precompressed {written} static files")
+            except OSError as e:
+                # E.g. a read-only directory. We then serve what's there.
+                logger.warning(f"Could not precompress static files: {str(e)}")
+
+    @classmethod
+    def from_env(cls, directory: str, **kwargs) -> "PrecompressedStaticFiles":
+        return cls(
+            directory=directory,
+            precompress=os.environ.get("STATIC_PRECOMPRESS", "1").lower()
+            in ("1", "true", "yes"),
+            cache_max_file_bytes=int(
+                os.environ.get("STATIC_CACHE_MAX_FILE_BYTES", 64 * 2**10)
+            ),
+            **kwargs,
+        )
+
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        path, stat_result, encoding = self.choose_encoding(
+            full_path, stat_result, request_headers.get("accept-encoding", "")
+        )
+        name = os.path.basename(full_path)
+        headers = {
+            "etag": self.etag(path, stat_result),
+            "cache-control": IMMUTABLE if HASHED_NAME.search(name) else REVALIDATE,
+            "vary": "Accept-Encoding",
+        }
+        if encoding is not None:
+            headers["content-encoding"] = encoding
+        # The media type is that of the original file, whatever the encoding.
+        media_type = guess_type(name)[0] or "text/plain"
+        content = self.cached_content(path, stat_result)
+        if content is not None:
+            response: Response = Response(content, status_code, headers, media_type)
+        else:
+            response = FileResponse(
+                path, status_code, headers, media_type, stat_result=stat_result
+            )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    def choose_encoding(
+        self, full_path: str, stat_result: os.stat_result, accept_encoding: str
+    ) -> Tuple[str, os.stat_result, Optional[str]]:
+        """
+        Pick the best precompressed version of a file that the client accepts.
+
+        Returns:
+            Tuple[str, os.stat_result, Optional[str]]: The path and stat of the
+                file to serve, and its content encoding (None for the original).
+        """
+        accepted = accepted_encodings(accept_encoding)
+        for encoding, extension in ENCODINGS:
+            if encoding not in accepted and "*" not in accepted:
+                continue
+            try:
+                variant = os.stat(full_path + extension)
+            except OSError:
+                continue
+            # We ignore compressed files that are older than the original.
+            if (
+                stat.S_ISREG(variant.st_mode)
+                and variant.st_mtime >= stat_result.st_mtime
+            ):
+                return full_path + extension, variant, encoding
+        return full_path, stat_result, None
+
+    def etag(self, path: str, stat_result: os.stat_result) -> str:
+        """A strong ETag for a file, from a hash of its content."""
+        key = (path, stat_result.st_mtime_ns, stat_result.st_size)
+        etag = self._etags.get(key)
+        if etag is None:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                while chunk := f.read(2**20):
+                    digest.update(chunk)
+            etag = f'"{digest.hexdigest()[:32]}"'
+            self._etags[key] = etag
+        return etag
+
+    def cached_content(self, path: str, stat_result: os.stat_result) -> Optional[bytes]:
+        """The content of a small file, from memory if possible."""
+        if stat_result.st_size > self.cache_max_file_bytes:
+            return None
+        key = (path, stat_result.st_mtime_ns, stat_result.st_size)
+        content = self._cache.get(key)
+        if content is not None:
+            self._cache.move_to_end(key)
+            return content
+        with open(path, "rb") as f:
+            content = f.read()
+        self._cache[key] = content
+        self._cache_bytes += len(content)
+        while self._cache_bytes > self.cache_max_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted)
+        return content
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="python -m tacheles_backend.utils.static",
+        description="Precompress the frontend build for PrecompressedStaticFiles.",
+    )
+    parser.add_argument("directory")
+    args = parser.parse_args()
+    print(f"Precompressed {precompress_directory(args.directory)} files")
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import os
+from typing import AsyncIterator
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Here we implement the low-level details of how we stream responses to the frontend.
+# Responses are streamed as "ndjson" (newline-delimited JSON): one JSON object per line,
+# each with a `type` ("content" or "end") and `data`.
+# The inference server sends us one chunk per token. At high token rates across many
+# concurrent streams, encoding and sending each token as its own tiny frame takes up a
+# good share of the backend's CPU time. We can optionally coalesce tokens: Instead of
+# forwarding each token right away, we collect tokens for up to STREAM_COALESCE_MS
+# milliseconds (or until we have STREAM_COALESCE_BYTES characters), and send them as
+# one frame. To the user, a window of around 20ms is indistinguishable from
+# token-by-token streaming. The very first token is always sent right away, so
+# coalescing doesn't add to the time to first token.
+
+
+def encode_frame(type: str, data: str) -> bytes:
+    """
+    Encode a single ndjson frame.
+
+    Args:
+        type (str): The frame type, e.g. "content" or "end".
+        data (str): The frame data.
+
+    Returns:
+        bytes: The encoded frame, including the trailing newline.
+    """
+    if orjson is not None:
+        return orjson.dumps({"type": type, "data": data}) + b" \n"
+    return json.dumps({"type": type, "data": data}).encode() + b" \n"
+
+
+class Coalescer:
+    """
+    Batches a stream of text deltas by time window and size.
+
+    Args:
+        window (float): Maximum time in seconds to hold back a delta. 0 disables
+            coalescing, i.e. every delta is passed on right away.
+        max_bytes (int): Pass on the batch as soon as it has this many characters,
+            even if the window hasn't passed yet. 0 means no limit.
+    """
+
+    def __init__(self, window: float = 0.0, max_bytes: int = 0):
+        self.window = window
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_env(cls) -> "Coalescer":
+        return cls(
+            window=int(os.environ.get("STREAM_COALESCE_MS", 0)) / 1000,
+            max_bytes=int(os.environ.get("STREAM_COALESCE_BYTES", 0)),
+        )
+
+    async def coalesce(self, deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Yield the deltas from `deltas`, joined into batches."""
+        if self.window <= 0:
+            async for delta in deltas:
+                yield delta
+            return
+
+        loop = asyncio.get_running_loop()
+        iterator = deltas.__aiter__()
+        first = True
+        buffer = []
+        size = 0
+        deadline = 0.0
+        # We wait for the next delta in a separate task, so we can stop waiting when
+        # the window has passed and send what we have so far.
+        pending = asyncio.ensure_future(iterator.__anext__())
+        try:
+            while True:
+                timeout = max(deadline - loop.time(), 0) if buffer else None
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    yield "".join(buffer)
+                    buffer, size = [], 0
+                    continue
+                try:
+                    delta = pending.result()
+                except StopAsyncIteration:
+                    break
+                pending = asyncio.ensure_future(iterator.__anext__())
+                if first:
+                    first = False
+                    yield delta
+                    continue
+                if not buffer:
+                    deadline = loop.time() + self.window
+                buffer.append(delta)
+                size += len(delta)
+                if self.max_bytes and size >= self.max_bytes:
+                    yield "".join(buffer)
+                    buffer, size = [], 0
+            if buffer:
+                yield "".join(buffer)
+        finally:
+            if not pending.done():
+                pending.cancel()
+                try:
+                    await pending
+                except (asyncio.CancelledError, StopAsyncIteration):
+                    pass
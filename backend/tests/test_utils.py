@@ -0,0 +1,777 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+# Here we test the helper modules in tacheles_backend/utils in isolation, without
+# going through the API endpoints.
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from tacheles_backend.utils.cache import (  # noqa
+    MESSAGE_OVERHEAD_BYTES,
+    CachedConversation,
+    HistoryCache,
+)
+from tacheles_backend.utils.context import (  # noqa
+    ContextBuilder,
+    approximate_token_count,
+    load_tokenizer,
+)
+from tacheles_backend.utils.generations import (  # noqa
+    GenerationExpired,
+    GenerationRegistry,
+)
+from tacheles_backend.utils.inference import InferencePool, InferenceReplica  # noqa
+from tacheles_backend.utils.metrics import MetricsRegistry  # noqa
+from tacheles_backend.utils.prewarm import Prewarmer  # noqa
+from tacheles_backend.utils.profiler import Profiler  # noqa
+from tacheles_backend.utils.response_cache import (  # noqa
+    MemoryResponseCache,
+    ResponseCache,
+    SharedResponseCache,
+    SQLiteResponseCache,
+)
+from tacheles_backend.utils.scheduler import Scheduler, SchedulerRejected  # noqa
+from tacheles_backend.utils.state import MemoryStateBackend, MemoryStore  # noqa
+from tacheles_backend.utils.static import (  # noqa
+    PrecompressedStaticFiles,
+    accepted_encodings,
+)
+from tacheles_backend.utils.streaming import Coalescer, encode_frame  # noqa
+
+
+def make_pool(n, **kwargs):
+    return InferencePool(
+        [
+            InferenceReplica(f"http://replica{i}:8000/v1", client=object(), **kwargs)
+            for i in range(n)
+        ]
+    )
+
+
+# Every turn of a conversation should go to the same replica, and conversations
+# should be spread over all replicas.
+def test_inference_pool_affinity():
+    pool = make_pool(4)
+    routes = {i: pool.route(i).name for i in range(1000)}
+    assert all(pool.route(i).name == routes[i] for i in range(1000))
+    assert len(set(routes.values())) == 4
+
+
+# Adding a replica should only move the conversations it takes over, and removing
+# it again should move exactly those conversations back.
+def test_inference_pool_add_remove_replica():
+    pool = make_pool(4)
+    before = {i: pool.route(i).name for i in range(1000)}
+    pool.add_replica(InferenceReplica("http://replica4:8000/v1", client=object()))
+    after = {i: pool.route(i).name for i in range(1000)}
+    moved = [i for i in before if before[i] != after[i]]
+    assert all(after[i] == "http://replica4:8000/v1" for i in moved)
+    assert 0 < len(moved) < 400
+
+    pool.remove_replica("http://replica4:8000/v1")
+    assert {i: pool.route(i).name for i in range(1000)} == before
+
+
+# If the preferred replica is at capacity, we fall back to one with headroom.
+def test_inference_pool_overload_fallback():
+    pool = make_pool(3, max_inflight=1)
+    preferred = pool.route(42)
+    preferred.inflight = 1
+    fallback = pool.route(42)
+    assert fallback is not preferred
+    # If every replica is full, we stick with the preferred one.
+    for replica in pool.replicas.values():
+        replica.inflight = 1
+    assert pool.route(42) is preferred
+
+
+# After too many failures in a row, a replica is skipped until its cooldown has passed,
+# unless there is no other replica.
+def test_inference_pool_circuit_breaker():
+    pool = make_pool(3, failure_threshold=2, cooldown=60)
+    preferred = pool.route(42)
+    preferred.record_failure()
+    assert pool.route(42) is preferred
+    preferred.record_failure()
+    assert not preferred.available
+    assert pool.route(42) is not preferred
+    assert pool.stats()["breakers_open"] == 1
+    for replica in pool.replicas.values():
+        replica.open_until = float("inf")
+    assert pool.route(42) is preferred
+    preferred.record_success()
+    assert preferred.available and preferred.failures == 0
+
+
+# A fake OpenAI client, which streams its chunks after `delay` seconds, or fails.
+class FakeStream:
+    def __init__(self, contents, delay):
+        self.contents = list(contents)
+        self.delay = delay
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(self.delay)
+        self.delay = 0
+        if not self.contents:
+            raise StopAsyncIteration
+        delta = SimpleNamespace(content=self.contents.pop(0))
+        return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    def __init__(self, contents=("Hi",), delay=0.0, error=None):
+        self.chat = SimpleNamespace(completions=self)
+        self.contents = contents
+        self.delay = delay
+        self.error = error
+        self.streams = []
+
+    async def create(self, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.streams.append(FakeStream(self.contents, self.delay))
+        return self.streams[-1]
+
+
+def make_fake_pool(clients, **kwargs):
+    pool = InferencePool(
+        [
+            InferenceReplica(f"http://replica{i}:8000/v1", client=object())
+            for i in range(len(clients))
+        ],
+        **kwargs,
+    )
+    # We hand out the clients in order of preference for our routing key.
+    for replica, client in zip(pool.ranked(42), clients):
+        replica.client = client
+    return pool
+
+
+async def read_stream(pool):
+    async with pool.stream(42, model="m", messages=[]) as stream:
+        chunks = [chunk.choices[0].delta.content async for chunk in stream]
+    await asyncio.sleep(0.01)
+    return stream.replica, chunks
+
+
+# If the preferred replica is slow to send its first token, we ask the next one as
+# well, use whichever answers first, and cancel the other.
+def test_inference_pool_hedging():
+    slow = FakeClient(["Slow"], delay=1)
+    fast = FakeClient(["Fast", "!"])
+    pool = make_fake_pool([slow, fast], hedge_after=0.01, max_attempts=2)
+    replica, chunks = asyncio.run(read_stream(pool))
+    assert replica.client is fast
+    assert chunks == ["Fast", "!"]
+    assert slow.streams[0].closed
+    assert pool.stats()["hedged"] == 1
+    assert all(replica.inflight == 0 for replica in pool.replicas.values())
+
+
+# If a replica fails, we fail over to the next one.
+def test_inference_pool_failover():
+    broken = FakeClient(error=ConnectionError("Connection refused"))
+    pool = make_fake_pool([broken, FakeClient(["Hi"])], max_attempts=2)
+    replica, chunks = asyncio.run(read_stream(pool))
+    assert chunks == ["Hi"]
+    assert pool.stats()["failovers"] == 1
+    assert pool.stats()["replica_failures"] == 1
+
+    # Without further attempts, the error is passed on.
+    pool = make_fake_pool([broken, FakeClient(["Hi"])])
+    try:
+        asyncio.run(read_stream(pool))
+    except ConnectionError:
+        pass
+    else:
+        raise AssertionError("Expected a ConnectionError")
+
+
+def make_history(n):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}"}
+        for i in range(n)
+    ]
+
+
+# Without a budget, the entire history is sent.
+def test_context_builder_unlimited():
+    builder = ContextBuilder()
+    window = builder.build(
+        "system", make_history(10), {"role": "user", "content": "new"}
+    )
+    assert len(window.messages) == 12
+    assert window.start == 0
+
+
+# With a budget, we keep the system prompt, the new message, and the newest turns.
+# We count each message as one token plus the per-message overhead here.
+def test_context_builder_budget():
+    builder = ContextBuilder(count_tokens=lambda text: 1, budget=5 * 6)
+    history = make_history(10)
+    window = builder.build("system", history, {"role": "user", "content": "new"})
+    assert window.messages[0]["content"] == "system"
+    assert window.messages[-1]["content"] == "new"
+    # Four history messages fit, and the window starts with a user message.
+    assert window.messages[1:-1] == history[6:]
+    assert window.start == 6
+    assert not window.unsummarized
+
+
+# With summarization, dropped messages are flagged until they're in the summary, and
+# the summary is then sent along with the system prompt instead.
+def test_context_builder_summary():
+    builder = ContextBuilder(count_tokens=lambda text: 1, budget=5 * 6, summarize=True)
+    history = make_history(10)
+    new = {"role": "user", "content": "new"}
+    window = builder.build("system", history, new)
+    assert window.unsummarized and window.start == 6
+
+    # The summary takes up budget as well, so fewer messages fit verbatim.
+    window = builder.build("system", history, new, "summary", 8)
+    assert not window.unsummarized
+    assert "summary" in window.messages[0]["content"]
+    assert window.messages[1:-1] == history[8:]
+
+
+# By default, tokens are approximated. A tokenizer is only loaded when configured,
+# with or without its options.
+def test_load_tokenizer(monkeypatch):
+    assert load_tokenizer() is approximate_token_count
+    encodings = []
+
+    def get_encoding(name):
+        encodings.append(name)
+        return SimpleNamespace(encode=lambda text, disallowed_special: text.split())
+
+    monkeypatch.setitem(
+        sys.modules, "tiktoken", SimpleNamespace(get_encoding=get_encoding)
+    )
+    assert load_tokenizer("tiktoken")("one two three") == 3
+    load_tokenizer("tiktoken:o200k_base")
+    assert encodings == ["cl100k_base", "o200k_base"]
+    with pytest.raises(ValueError):
+        load_tokenizer("unknown")
+
+
+# The history cache evicts the least recently used conversations once it's full, and
+# keeps track of its size as messages are appended.
+def test_history_cache_lru():
+    entry_size = 10 + MESSAGE_OVERHEAD_BYTES
+    cache = HistoryCache(max_bytes=3 * entry_size)
+    for i in range(3):
+        cache.put(i, CachedConversation(1, [{"role": "user", "content": "x" * 10}]))
+    assert cache.size == 3 * entry_size
+    cache.get(0)
+    cache.put(3, CachedConversation(1, [{"role": "user", "content": "x" * 10}]))
+    assert cache.get(1) is None
+    assert cache.get(0) is not None
+
+    cache.append(0, [{"role": "assistant", "content": "x" * 10}])
+    assert len(cache.get(0).messages) == 2
+    assert cache.size <= cache.max_bytes
+    assert cache.evictions == 2
+
+
+# Local changes are passed on to subscribers, e.g. so other workers can invalidate
+# their copy of the conversation.
+def test_history_cache_invalidation():
+    cache = HistoryCache(max_bytes=10000)
+    changed = []
+    cache.subscribe(changed.append)
+    cache.put(1, CachedConversation(1, []))
+    cache.append(1, [{"role": "user", "content": "Hi"}])
+    cache.invalidate(2, notify=False)
+    cache.invalidate(1)
+    assert changed == [1, 1]
+    assert cache.get(1) is None and cache.size == 0
+
+
+async def slow_deltas(deltas, delay):
+    for delta in deltas:
+        await asyncio.sleep(delay)
+        yield delta
+
+
+async def collect(iterator):
+    return [item async for item in iterator]
+
+
+# Frames stay compatible with the frontend's ndjson parsing.
+def test_encode_frame():
+    frame = encode_frame("content", 'Say "hi"\n')
+    assert frame.endswith(b"\n")
+    assert json.loads(frame) == {"type": "content", "data": 'Say "hi"\n'}
+
+
+# Without a window, every delta is passed on as is.
+def test_coalescer_disabled():
+    deltas = asyncio.run(collect(Coalescer().coalesce(slow_deltas("abc", 0))))
+    assert deltas == ["a", "b", "c"]
+
+
+# With a window, the first delta is sent right away, and the rest in batches.
+def test_coalescer_window():
+    coalescer = Coalescer(window=0.05)
+    deltas = asyncio.run(collect(coalescer.coalesce(slow_deltas("abcdefghij", 0.001))))
+    assert deltas[0] == "a"
+    assert "".join(deltas) == "abcdefghij"
+    assert len(deltas) < 5
+
+    # A gap longer than the window flushes the batch without waiting for more.
+    async def gap():
+        yield "a"
+        yield "b"
+        await asyncio.sleep(0.2)
+        yield "c"
+
+    assert asyncio.run(collect(coalescer.coalesce(gap()))) == ["a", "b", "c"]
+
+
+# The size limit sends a batch early.
+def test_coalescer_max_bytes():
+    coalescer = Coalescer(window=10, max_bytes=3)
+    deltas = asyncio.run(collect(coalescer.coalesce(slow_deltas("abcdefg", 0))))
+    assert deltas == ["a", "bcd", "efg"]
+
+
+# A generation's ring buffer keeps only the most recent frames. Readers can start at
+# any buffered frame, but not at one that has already been dropped.
+def test_generation_ring_buffer():
+    async def run():
+        registry = GenerationRegistry(max_frames=3)
+        generation = registry.create(user_id=1, conversation_id=1)
+        for frame in [b"a", b"b", b"c", b"d"]:
+            generation.append(frame)
+        generation.finish()
+        assert generation.first_offset == 1
+        assert [frame async for frame in generation.read(2)] == [b"c", b"d"]
+        try:
+            [frame async for frame in generation.read(0)]
+        except GenerationExpired:
+            return True
+
+    assert asyncio.run(run())
+
+
+# Generations can be found by their idempotency key, unless they failed or were
+# abandoned, and until they expire.
+def test_generation_idempotency_key():
+    async def run():
+        registry = GenerationRegistry(retention=0.05)
+        generation = registry.create(user_id=1, conversation_id=1, key="a", parent=2)
+        assert registry.find("a") is generation
+        assert registry.find("b") is None
+        generation.finish()
+        assert registry.find("a") is generation
+        await asyncio.sleep(0.1)
+        assert registry.find("a") is None
+
+        failed = registry.create(user_id=1, conversation_id=1, key="b")
+        failed.finish(RuntimeError("Inference server unavailable"))
+        assert registry.find("b") is None
+        abandoned = registry.create(user_id=1, conversation_id=1, key="c")
+        registry._abandon(abandoned)
+        assert registry.find("c") is None
+        return True
+
+    assert asyncio.run(run())
+
+
+# With one slot, waiting requests are admitted round-robin by user: user 1 queued three
+# requests before user 2 queued one, but user 2 doesn't have to wait for all of them.
+def test_scheduler_fairness():
+    async def run():
+        scheduler = Scheduler(max_concurrent=1)
+        admitted = []
+
+        async def request(user_id):
+            admitted_at = await scheduler.admit(user_id)
+            admitted.append(user_id)
+            await asyncio.sleep(0)
+            scheduler.release(admitted_at)
+
+        first = await scheduler.admit(0)
+        tasks = [asyncio.create_task(request(user)) for user in [1, 1, 1, 2]]
+        await asyncio.sleep(0)
+        assert scheduler.queued == 4
+        scheduler.release(first)
+        await asyncio.gather(*tasks)
+        return admitted, scheduler
+
+    admitted, scheduler = asyncio.run(run())
+    assert admitted == [1, 2, 1, 1]
+    assert scheduler.active == 0 and scheduler.queued == 0
+    assert scheduler.stats()["max_queue_depth"] == 4
+
+
+# When the queue is full, requests are turned away right away with a 503.
+def test_scheduler_queue_full():
+    async def run():
+        scheduler = Scheduler(max_concurrent=1, max_queue=1)
+        await scheduler.admit(1)
+        waiting = asyncio.create_task(scheduler.admit(2))
+        await asyncio.sleep(0)
+        try:
+            await scheduler.admit(3)
+        except SchedulerRejected as e:
+            waiting.cancel()
+            return e
+
+    rejected = asyncio.run(run())
+    assert rejected.status_code == 503
+    assert rejected.retry_after >= 1
+
+
+# Each user gets a burst of requests, and then one more per 1/rate seconds.
+def test_scheduler_rate_limit():
+    async def run():
+        scheduler = Scheduler(rate=0.1, burst=2)
+        for _ in range(2):
+            scheduler.release(await scheduler.admit(1))
+        await scheduler.admit(2)
+        try:
+            await scheduler.admit(1)
+        except SchedulerRejected as e:
+            return e
+
+    rejected = asyncio.run(run())
+    assert rejected.status_code == 429
+    assert 9 <= rejected.retry_after <= 10
+
+
+# With a shared state backend, the rate limit counts a user's requests on all replicas.
+def test_scheduler_shared_rate_limit():
+    async def run():
+        store = MemoryStore()
+        replicas = [
+            Scheduler(rate=0.1, burst=2, state=MemoryStateBackend(store))
+            for _ in range(2)
+        ]
+        for scheduler in replicas:
+            scheduler.release(await scheduler.admit(1))
+        await replicas[0].admit(2)
+        try:
+            await replicas[1].admit(1)
+        except SchedulerRejected as e:
+            return e
+
+    rejected = asyncio.run(run())
+    assert rejected.status_code == 429
+    assert 1 <= rejected.retry_after <= 20
+
+
+# Several memory state backends sharing a store behave like replicas sharing a server:
+# they see each other's keys, and messages go to all replicas but the sender.
+def test_state_backend():
+    async def run():
+        store = MemoryStore()
+        a, b = MemoryStateBackend(store), MemoryStateBackend(store)
+        assert a.shared and not MemoryStateBackend().shared
+
+        await a.set("key", "value", ttl=0.05)
+        assert await b.get("key") == "value"
+        assert not await b.add("key", "other")
+        await asyncio.sleep(0.1)
+        assert await b.get("key") is None
+        assert await b.add("key", "other")
+
+        assert await a.incr("counter") == 1
+        assert await b.incr("counter", 2) == 3
+        await b.delete("counter")
+        assert await a.get("counter") is None
+
+        received = {"a": [], "b": []}
+        a.subscribe("channel", received["a"].append)
+        b.subscribe("channel", received["b"].append)
+        a.publish("channel", "hello")
+        assert received == {"a": [], "b": ["hello"]}
+
+        assert await a.shared_secret("secret") == await b.shared_secret("secret")
+
+        cache = SharedResponseCache(b)
+        await SharedResponseCache(a).put("prompt", "response")
+        assert await cache.get("prompt") == "response"
+        return True
+
+    assert asyncio.run(run())
+
+
+# Each generation claims its idempotency key on all replicas, so a repeat on another
+# replica sees that the request is already being answered.
+def test_generation_claim():
+    async def run():
+        store = MemoryStore()
+        a = GenerationRegistry(state=MemoryStateBackend(store))
+        b = GenerationRegistry(state=MemoryStateBackend(store))
+        original = a.create(user_id=1, conversation_id=1, key="k")
+        repeat = b.create(user_id=1, conversation_id=1, key="k")
+        assert await a.claim(original) is None
+        assert await b.claim(repeat) == original.id
+        # Releasing the repeat doesn't release the original's claim.
+        await b.release(repeat)
+        assert await b.claim(repeat) == original.id
+        await a.release(original)
+        assert await b.claim(repeat) is None
+        return True
+
+    assert asyncio.run(run())
+
+
+# With a shared state backend, a client can resume a generation on another replica,
+# which keeps the generation running on its own replica while it reads.
+def test_generation_shared_resume():
+    async def run():
+        store = MemoryStore()
+        a = GenerationRegistry(grace=0, state=MemoryStateBackend(store))
+        b = GenerationRegistry(grace=0, state=MemoryStateBackend(store))
+        generation = a.create(user_id=1, conversation_id=1)
+        generation.task = asyncio.create_task(generation.wait())
+        generation.append(b"a")
+        generation.append(b"b")
+        await asyncio.sleep(0.01)
+        assert await b.get_shared("unknown") is None
+        shared = await b.get_shared(generation.id)
+        assert shared.user_id == 1 and shared.first_offset == 0
+
+        # The client reads the first frame from replica a, and loses the connection.
+        stream = a.stream(generation)
+        assert await stream.__anext__() == b"a"
+        reader = asyncio.create_task(asyncio.wait_for(collect(b.stream(shared, 1)), 5))
+        await asyncio.sleep(0.1)
+        await stream.aclose()
+        await asyncio.sleep(0.1)
+        assert not generation.abandoned
+        generation.append(b"c")
+        generation.finish()
+        assert await reader == [b"b", b"c"]
+
+        # Without a reader, the generation is aborted.
+        abandoned = a.create(user_id=1, conversation_id=1)
+        abandoned.task = asyncio.create_task(abandoned.wait())
+        stream = a.stream(abandoned)
+        abandoned.append(b"a")
+        await stream.__anext__()
+        await stream.aclose()
+        await asyncio.sleep(0.01)
+        assert abandoned.abandoned and abandoned.task.cancelled()
+        return True
+
+    async def collect(frames):
+        return [frame async for frame in frames]
+
+    assert asyncio.run(run())
+
+
+# Histograms are rendered with cumulative bucket counts, as Prometheus expects.
+def test_metrics_histogram():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency", "Latency.", ["endpoint"], [0.1, 1])
+    for value in [0.05, 0.5, 0.5, 5]:
+        histogram.observe(value, "/api/chat")
+    registry.gauges("cache", lambda: {"hits": 3})
+    lines = registry.render().splitlines()
+    assert "# TYPE latency histogram" in lines
+    assert 'latency_bucket{endpoint="/api/chat",le="0.1"} 1' in lines
+    assert 'latency_bucket{endpoint="/api/chat",le="1.0"} 3' in lines
+    assert 'latency_bucket{endpoint="/api/chat",le="+Inf"} 4' in lines
+    assert 'latency_count{endpoint="/api/chat"} 4' in lines
+    assert "cache_hits 3.0" in lines
+
+
+# The response cache only caches short prompts, evicts the least recently used entries
+# once it's full, and drops expired entries.
+def test_memory_response_cache():
+    async def run():
+        cache = MemoryResponseCache(max_bytes=10, max_messages=2)
+        messages = [{"role": "user", "content": "Hi"}]
+        assert cache.key("m", messages) == cache.key("m", list(messages))
+        assert cache.key("m", messages) != cache.key("m", messages, max_tokens=5)
+        assert cache.key("m", messages * 3) is None
+        assert ResponseCache().key("m", messages) is None
+
+        await cache.put("a", "12345")
+        await cache.put("b", "12345")
+        assert await cache.get("a") == "12345"
+        await cache.put("c", "12345")
+        assert await cache.get("b") is None
+        assert await cache.get("a") == "12345"
+        await cache.put("d", "12345678901")
+        assert await cache.get("d") is None
+
+        cache.ttl = -1
+        assert await cache.get("a") is None
+        return cache
+
+    cache = asyncio.run(run())
+    assert cache.stats() == {"hits": 2, "misses": 3}
+    assert cache.size == 5
+
+
+def test_sqlite_response_cache(tmp_path):
+    async def run():
+        path = str(tmp_path / "cache.db")
+        cache = SQLiteResponseCache(path, max_bytes=10)
+        await cache.put("a", "12345")
+        await cache.put("b", "12345")
+        assert await cache.get("a") == "12345"
+        await cache.put("c", "12345")
+        # A second cache on the same file (e.g. in another worker) sees the same
+        # entries.
+        other = SQLiteResponseCache(path, max_bytes=10)
+        return [await other.get(key) for key in ["a", "b", "c"]]
+
+    assert asyncio.run(run()) == ["12345", None, "12345"]
+
+
+# Replaying a response streams it in word-sized pieces that add up to the original.
+def test_response_cache_replay():
+    async def run(rate):
+        cache = ResponseCache(replay_rate=rate)
+        return [piece async for piece in cache.replay(" Hello,  world!\n\nBye ")]
+
+    pieces = asyncio.run(run(10000))
+    assert pieces == [" Hello,", "  world!", "\n\nBye", " "]
+    assert asyncio.run(run(0)) == [" Hello,  world!\n\nBye "]
+
+
+# Each conversation is prewarmed at most once per interval, and prewarms are limited in
+# number and rate. Failed prewarms are just counted.
+def test_prewarmer_limits():
+    async def run():
+        prewarmer = Prewarmer(enabled=True, interval=60, max_inflight=2, rate=0.001)
+        release = asyncio.Event()
+        calls = []
+
+        async def prewarm(key):
+            calls.append(key)
+            await release.wait()
+            if key == 2:
+                raise RuntimeError("Inference server unavailable")
+
+        started = [
+            prewarmer.schedule(key, lambda key=key: prewarm(key))
+            for key in [1, 1, 2, 3]
+        ]
+        await asyncio.sleep(0)
+        assert prewarmer.inflight == 2
+        release.set()
+        await asyncio.sleep(0.01)
+        # Both in-flight slots are free again, but the rate limit isn't.
+        started.append(prewarmer.schedule(3, lambda: prewarm(3)))
+        return started, calls, prewarmer
+
+    started, calls, prewarmer = asyncio.run(run())
+    assert started == [True, False, True, False, False]
+    assert calls == [1, 2]
+    assert prewarmer.stats() == {"inflight": 0, "started": 2, "skipped": 3, "failed": 1}
+    assert not Prewarmer().schedule(1, lambda: None)
+
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, deflate, br") == ["gzip", "deflate", "br"]
+    assert accepted_encodings("br;q=0, gzip;q=0.5") == ["gzip"]
+
+
+def test_precompressed_static_files(tmp_path):
+    script = "console.log('Hello, world!');\n" * 100
+    os.makedirs(tmp_path / "static" / "js")
+    (tmp_path / "static" / "js" / "main.1a2b3c4d.js").write_text(script)
+    (tmp_path / "index.html").write_text("<html>" + "<p>Hello</p>" * 100 + "</html>")
+    app = FastAPI()
+    files = PrecompressedStaticFiles(
+        directory=str(tmp_path), html=True, precompress=True, cache_max_file_bytes=100
+    )
+    app.mount("/", files)
+    client = TestClient(app)
+    assert (tmp_path / "static" / "js" / "main.1a2b3c4d.js.br").exists()
+    assert (tmp_path / "index.html.gz").exists()
+
+    # We serve the best encoding the client accepts, and the client gets the same
+    # content either way.
+    for accept, encoding in [("gzip, br", "br"), ("gzip", "gzip"), ("identity", None)]:
+        response = client.get(
+            "/static/js/main.1a2b3c4d.js", headers={"Accept-Encoding": accept}
+        )
+        assert response.text == script
+        assert response.headers.get("content-encoding") == encoding
+        assert response.headers["content-type"].startswith("text/javascript")
+        assert (
+            response.headers["cache-control"] == "public, max-age=31536000, immutable"
+        )
+        assert response.headers["vary"] == "Accept-Encoding"
+
+    # Other files need to be revalidated, which their ETag makes cheap.
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["cache-control"] == "no-cache"
+    etag = response.headers["etag"]
+    response = client.get(
+        "/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    # The ETags of different encodings differ.
+    response = client.get("/", headers={"Accept-Encoding": "identity"})
+    assert response.headers["etag"] != etag
+
+    # A file changed after precompression is served as is.
+    os.utime(tmp_path / "index.html", (time.time() + 10, time.time() + 10))
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.headers.get("content-encoding") is None
+
+
+# The profiler counts the stacks of a profiled request, including those of the tasks
+# it starts, but not those of other requests, and keeps a bounded number of profiles.
+def test_profiler():
+    profiler = Profiler(interval=0.001, max_profiles=2)
+
+    def busy(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    async def streaming():
+        busy(0.05)
+
+    async def profiled():
+        profile = profiler.start("POST", "/api/chat")
+        busy(0.05)
+        await asyncio.create_task(streaming())
+        profiler.finish(profile, "/api/chat")
+        return profile
+
+    async def unprofiled():
+        busy(0.05)
+
+    async def run():
+        profiles = []
+        for _ in range(3):
+            profiles.append(await asyncio.create_task(profiled()))
+            await asyncio.create_task(unprofiled())
+        return profiles
+
+    profiles = asyncio.run(run())
+
+    assert profiler.profiles() == profiles[1:]
+    folded = profiler.folded(profiles[-1:])
+    stacks = dict(line.rsplit(" ", 1) for line in folded.splitlines())
+    assert sum(int(count) for count in stacks.values()) == profiles[-1].samples > 0
+    assert any("test_profiler.<locals>.profiled" in stack for stack in stacks)
+    assert any("test_profiler.<locals>.streaming" in stack for stack in stacks)
+    assert not any("unprofiled" in stack for stack in stacks)
+    # Stacks start at the request's coroutine, not in the event loop.
+    assert not any("run_forever" in stack for stack in stacks)
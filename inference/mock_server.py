@@ -0,0 +1,114 @@
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from uuid import uuid4
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# This is a mock inference server, which implements just enough of the OpenAI chat
+# completions API to stand in for vllm or sglang: in development, in the end-to-end
+# tests, and for load testing the backend (see backend/benchmark).
+# It answers every request with one of the responses in mock_contents.txt (separated by
+# MOCK_FILE_SEPARATOR), streamed word by word. To make it behave like a real model, it
+# waits MOCK_TTFT_MS milliseconds before the first token, and then sends
+# MOCK_TOKENS_PER_SECOND tokens per second (0 sends them as fast as possible).
+# Run it with `python mock_server.py`, or `uvicorn mock_server:app`.
+
+TTFT = int(os.environ.get("MOCK_TTFT_MS", 200)) / 1000
+TOKENS_PER_SECOND = float(os.environ.get("MOCK_TOKENS_PER_SECOND", 50))
+FILE_PATH = os.environ.get(
+    "MOCK_FILE_PATH", os.path.join(os.path.dirname(__file__), "mock_contents.txt")
+)
+SEPARATOR = os.environ.get("MOCK_FILE_SEPARATOR", "@@@@")
+
+with open(FILE_PATH) as f:
+    CONTENTS = [content.strip() for content in f.read().split(SEPARATOR)]
+# We split responses into "tokens" at word boundaries, keeping the whitespace.
+TOKENS = [re.findall(r"\s*\S+", content) for content in CONTENTS if content]
+
+app = FastAPI(title="Mock inference server")
+
+
+def chunk(id: str, model: str, delta: dict, finish_reason=None) -> str:
+    data = {
+        "id": id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(data)}\n\n"
+
+
+async def stream(id: str, model: str, tokens: list):
+    await asyncio.sleep(TTFT)
+    # We schedule each token relative to the first, so that the token rate stays
+    # accurate even if the event loop is busy.
+    start = time.monotonic()
+    yield chunk(id, model, {"role": "assistant", "content": ""})
+    for i, token in enumerate(tokens):
+        if TOKENS_PER_SECOND > 0:
+            delay = start + i / TOKENS_PER_SECOND - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield chunk(id, model, {"content": token})
+    yield chunk(id, model, {}, finish_reason="stop")
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "mock")
+    tokens = random.choice(TOKENS)
+    max_tokens = body.get("max_tokens")
+    if max_tokens:
+        tokens = tokens[:max_tokens]
+    id = f"chatcmpl-{uuid4().hex}"
+    if body.get("stream"):
+        return StreamingResponse(
+            stream(id, model, tokens), media_type="text/event-stream"
+        )
+
+    duration = len(tokens) / TOKENS_PER_SECOND if TOKENS_PER_SECOND > 0 else 0
+    await asyncio.sleep(TTFT + duration)
+    return JSONResponse(
+        {
+            "id": id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": 0,
+                "completion_tokens": len(tokens),
+                "total_tokens": len(tokens),
+            },
+        }
+    )
+
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": "mock", "object": "model"}]}
+
+
+@app.get("/health")
+async def health():
+    return "OK"
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("SERVER_PORT", 8000)))